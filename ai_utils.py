@@ -1,5 +1,9 @@
 import ollama
+import telemetry
 
+logger = telemetry.get_logger(__name__)
+
+@telemetry.timed("llm.tags")
 def generate_tags_for_text(text: str) -> list[str]:
     max_text_length = 8000
     truncated_text = text[:max_text_length]
@@ -41,10 +45,11 @@ def generate_tags_for_text(text: str) -> list[str]:
         return tags_list
 
     except Exception as e:
-        print(f"Error communicating with Ollama for tagging: {e}")
+        logger.error("Error communicating with Ollama for tagging: %s", e)
         return []
 
 
+@telemetry.timed("llm.summary")
 def generate_summary_for_text(text: str) -> str:
     """
     Uses a local Ollama model to generate a summary for a given text.
@@ -96,5 +101,123 @@ def generate_summary_for_text(text: str) -> str:
         return summary
 
     except Exception as e:
-        print(f"Error generating summary: {e}")
-        return ""
\ No newline at end of file
+        logger.error("Error generating summary: %s", e)
+        return ""
+
+# Shared with rag.py, so precomputed answers are grounded the same way live ones are
+GROUNDED_SYSTEM_PROMPT = """You are an assistant for 'intelliDocs'. Your task is to answer questions based ONLY on the provided context.Do not use any outside knowledge. If the answer is not in the context, state that clearly."""
+
+
+@telemetry.timed("llm.section_summary")
+def generate_section_summary(text: str) -> str:
+    """Summarizes one section of a document in two or three sentences."""
+    max_text_length = 8000
+    truncated_text = text[:max_text_length]
+
+    prompt = f"""
+    Summarize the following section of a document in two or three sentences.
+    Provide ONLY the summary text itself, with no title or preamble.
+
+    Section Text:
+    ---
+    {truncated_text}
+    ---
+    """
+
+    try:
+        response = ollama.chat(
+            model='qwen2.5:1.5b',
+            messages=[{'role': 'user', 'content': prompt}],
+            options={'temperature': 0.2}
+        )
+        return response['message']['content'].strip()
+
+    except Exception as e:
+        logger.error("Error generating section summary: %s", e)
+        return ""
+
+
+@telemetry.timed("llm.key_points")
+def generate_key_points(section_summaries: list[str]) -> str:
+    """Turns the section summaries of a document into a short list of its key points."""
+    outline = "\n".join(f"- {summary}" for summary in section_summaries)
+
+    prompt = f"""
+    Below are summaries of the sections of a document, in order.
+    List the 3 to 6 most important points of the document as short bullet points starting with "- ".
+    Use ONLY the information in the summaries and provide ONLY the list.
+
+    Section Summaries:
+    ---
+    {outline}
+    ---
+    """
+
+    try:
+        response = ollama.chat(
+            model='qwen2.5:1.5b',
+            messages=[{'role': 'user', 'content': prompt}],
+            options={'temperature': 0.2}
+        )
+        return response['message']['content'].strip()
+
+    except Exception as e:
+        logger.error("Error generating key points: %s", e)
+        return ""
+
+
+@telemetry.timed("llm.questions")
+def generate_questions_for_text(text: str, count: int = 3) -> list[str]:
+    """Suggests up to `count` questions a reader might ask about the document outlined in `text`."""
+    max_text_length = 8000
+    truncated_text = text[:max_text_length]
+
+    prompt = f"""
+    Below is an outline of a document. Write {count} short, specific questions a reader might ask about it,
+    each of which the document itself answers.
+    Write one question per line, with no numbering, explanation or preamble.
+
+    Document Outline:
+    ---
+    {truncated_text}
+    ---
+    """
+
+    try:
+        response = ollama.chat(
+            model='qwen2.5:1.5b',
+            messages=[{'role': 'user', 'content': prompt}],
+            options={'temperature': 0.3}
+        )
+        questions = []
+        for line in response['message']['content'].splitlines():
+            # Drop any numbering or bullets the model adds anyway
+            question = line.strip().lstrip("-*•0123456789.) ").strip()
+            if question.endswith("?") and question not in questions:
+                questions.append(question)
+        return questions[:count]
+
+    except Exception as e:
+        logger.error("Error generating suggested questions: %s", e)
+        return []
+
+
+@telemetry.timed("llm.grounded_answer")
+def generate_grounded_answer(question: str, context_chunks: list[str]) -> str:
+    """Answers a question from the given document chunks only, as rag.py does for a live search."""
+    context = "\n\n---\n\n".join(context_chunks)
+
+    try:
+        response = ollama.chat(
+            model='qwen2.5:1.5b',
+            messages=[
+                {'role': 'system', 'content': GROUNDED_SYSTEM_PROMPT},
+                {'role': 'user', 'content': f"CONTEXT:\n{context}\n\nQUESTION:\n{question}"},
+            ],
+            options={'temperature': 0.2}
+        )
+        return response['message']['content'].strip()
+
+    except Exception as e:
+        logger.error("Error generating a grounded answer: %s", e)
+        return ""
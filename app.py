@@ -1,4 +1,6 @@
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
 from dotenv import load_dotenv
 import os
 load_dotenv()
@@ -7,36 +9,126 @@ from flask import Flask,session
 from flask import render_template, render_template_string
 from flask import request,redirect
 from flask import flash,url_for
-import cloudinary
-import cloudinary.uploader
-import cloudinary.api
-from flask_bcrypt import Bcrypt
+from flask import abort, send_file, make_response, Response
+import cache
 import database
 import os
 import secrets
 import processing
-import fitz
-import ai_utils
+import extractors
+import ingestion
 import vector_store
 import rag
+import reindex
+import storage
 import mongodb
 import email_server
+import passwords
+import progress
 import secrets
 import hashlib
+import threading
+import telemetry
+
+logger = telemetry.get_logger(__name__)
 
 database.init_db()  # Ensures DB and tables exist
+mongodb.init_chat_store()  # Ensures chat history indexes exist
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY')
-bcrypt = Bcrypt(app)
+# Reject oversized uploads before they are read (413 Request Entity Too Large)
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_UPLOAD_MB', 200)) * 1024 * 1024
+# Let a fronting nginx/Apache send locally stored files itself (X-Sendfile)
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
+
+# Locally stored files never change under their URL, so clients may cache them this long
+FILE_CACHE_MAX_AGE = int(os.getenv('FILE_CACHE_MAX_AGE', 31536000))
+
+
+# Rebuild documents indexed with an older chunker/embedding model in the
+# background. With several workers, enable it in one (or run reindex.py).
+if os.getenv('REINDEX_ON_STARTUP', '').lower() in ('1', 'true', 'yes'):
+    reindex.start_background_job()
+
+
+# --- Request-scoped DB connection ---
+# Every database call made while handling one request shares a single pooled
+# connection, which is returned at teardown. Routes that go on to slow work
+# (Ollama, ingestion, bcrypt) give it back first with
+# database.release_request_connection().
+@app.before_request
+def open_db_scope():
+    database.begin_request_scope()
+
+@app.teardown_request
+def close_db_scope(error=None):
+    database.end_request_scope(error)
+
+
+def render_conditional(etag, stamp, render):
+    """
+    Answers 304 Not Modified, without touching MySQL or Jinja, when the
+    browser's copy of a page is current (If-None-Match, else If-Modified-Since);
+    otherwise returns render(). `stamp` is the cache generation (ns) the page
+    was built from. Pages with pending flash messages are always rendered.
+    """
+    last_modified = datetime.fromtimestamp(stamp // 1_000_000_000, tz=timezone.utc)
+    if session.get('_flashes'):
+        current = False
+    elif request.if_none_match:
+        current = etag in request.if_none_match
+    else:
+        current = request.if_modified_since is not None and request.if_modified_since >= last_modified
+
+    response = app.response_class(status=304) if current else make_response(render())
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # Per-user pages: browsers may keep them but must revalidate every time
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+# Metrics are only served to these addresses, or to a client presenting METRICS_TOKEN
+METRICS_ALLOWED_IPS = {ip.strip() for ip in os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if ip.strip()}
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
 
+def _require_metrics_access():
+    if request.remote_addr in METRICS_ALLOWED_IPS:
+        return
+    if METRICS_TOKEN and secrets.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        return
+    abort(403)
 
-# --- Cloudinary Configuration ---
-cloudinary.config(
-    cloud_name=os.getenv('CLOUDINARY_CLOUD_NAME'),
-    api_key=os.getenv('CLOUDINARY_API_KEY'),
-    api_secret=os.getenv('CLOUDINARY_API_SECRET')
-)
+
+@app.route('/metrics/db')
+def db_pool_metrics():
+    _require_metrics_access()
+    return database.get_pool_stats()
+
+
+@app.route('/metrics/reindex')
+def reindex_progress():
+    """Progress of the background re-index job (see reindex.py)."""
+    _require_metrics_access()
+    job = reindex.get_job()
+    if job is None:
+        return {"status": "idle", "target_version": processing.INDEX_VERSION,
+                "remaining": database.count_documents_to_reindex(processing.INDEX_VERSION)}
+    return job.to_dict()
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint: per-stage timing histograms plus pool gauges."""
+    _require_metrics_access()
+    pool_stats = database.get_pool_stats()
+    gauges = {f"intellidocs_db_pool_{name}": value for name, value in pool_stats.items()}
+    return telemetry.render_prometheus(gauges), 200, {
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'
+    }
 
 
 @app.route('/')
@@ -44,6 +136,19 @@ def index():
     return render_template('signup.html')
 
 
+def _throttled(template, retry_after, **context):
+    """429 page for a client that made too many attempts (see passwords.py)."""
+    minutes = max(1, round(retry_after / 60))
+    error_message = f"Too many attempts. Please try again in {minutes} minute{'s' if minutes > 1 else ''}."
+    return render_template(template, error_message=error_message, **context), 429, {'Retry-After': str(retry_after)}
+
+
+def _busy(template, error_message="We're handling a lot of sign-ins right now. Please try again in a moment.",
+          **context):
+    """503 page for when the password hashing (or reset email) pool is saturated."""
+    return render_template(template, error_message=error_message, **context), 503, {'Retry-After': '5'}
+
+
 @app.route('/signup', methods=['GET','POST'])
 def register():
        if request.method=='POST': 
@@ -56,6 +161,11 @@ def register():
             error_message = "Passwords do not match."
             return render_template('signup.html', error_message=error_message, email=email)
         
+        # Every signup costs a bcrypt hash, so it counts against the IP like a login
+        retry_after = passwords.login_retry_after(request.remote_addr)
+        if retry_after:
+            return _throttled('signup.html', retry_after, email=email)
+
         # Check if user already exists
         existing_user = database.get_user_by_email(email)
         if existing_user:
@@ -64,7 +174,12 @@ def register():
         
         
         # Hash the password
-        password_hash = bcrypt.generate_password_hash(password).decode('utf-8')
+        try:
+            # bcrypt can take a while; don't hold a pooled connection meanwhile
+            database.release_request_connection()
+            password_hash = passwords.hash_password(password)
+        except passwords.PasswordHasherBusy:
+            return _busy('signup.html', email=email)
 
         # Add user to the database
         new_user_id=database.add_user(email, password_hash)
@@ -89,10 +204,27 @@ def login():
        
         email = request.form['email']
         password = request.form['password']
+
+        # Floods are turned away here, before any database or bcrypt work
+        retry_after = passwords.login_retry_after(request.remote_addr, email)
+        if retry_after:
+            return _throttled('login.html', retry_after)
+
         user = database.get_user_by_email(email)
 
-        if user and bcrypt.check_password_hash(user['password_hash'], password):
-          
+        # Unknown emails are checked against a dummy hash, so they take as long
+        try:
+            database.release_request_connection()
+            matches, new_hash = passwords.verify_password(user['password_hash'] if user else None, password)
+        except passwords.PasswordHasherBusy:
+            return _busy('login.html')
+        passwords.record_login(email, matches)
+
+        if user and matches:
+            # The stored hash was made at an older BCRYPT_ROUNDS: upgrade it
+            if new_hash:
+                database.update_user_password(user['id'], new_hash)
+
             session['user_id'] = user['id']
             session['user_email'] = user['email']
             
@@ -129,28 +261,68 @@ def generate_secure_reset_token():
     
     return raw_token, token_hash
 
+# Password reset requests are worked off here, in the order they arrive. At
+# most RESET_QUEUE wait for a worker; beyond that requests are turned away
+# instead of queueing without bound.
+RESET_WORKERS = int(os.getenv('RESET_WORKERS', 2))
+RESET_QUEUE = int(os.getenv('RESET_QUEUE', 100))
+_reset_pool = ThreadPoolExecutor(max_workers=RESET_WORKERS, thread_name_prefix="reset")
+_reset_slots = threading.BoundedSemaphore(RESET_WORKERS + RESET_QUEUE)
+
+def _submit_password_reset(email, reset_url) -> bool:
+    """Queues _issue_password_reset(); False if the queue is full."""
+    if not _reset_slots.acquire(blocking=False):
+        return False
+
+    def run():
+        try:
+            _issue_password_reset(email, reset_url)
+        finally:
+            _reset_slots.release()
+
+    try:
+        _reset_pool.submit(run)
+    except Exception:
+        _reset_slots.release()
+        raise
+    return True
+
+def _issue_password_reset(email, reset_url):
+    """Stores a reset token for the account (if there is one) and queues the email."""
+    try:
+        # Limited per address before anything is stored or sent
+        if not passwords.allow_reset_email(email):
+            return
+        user = database.get_user_by_email(email)
+        if not user:
+            return
+
+        token, token_hash = generate_secure_reset_token()
+        expires_at = datetime.now() + timedelta(minutes=15)
+
+        if database.store_reset_token(user['id'], token_hash, expires_at):
+            email_server.send_reset_email(email, f"{reset_url}?{urlencode({'token': token})}")
+        else:
+            logger.error("Could not store a reset token for user %s.", user['id'])
+    except Exception as e:
+        logger.error("Password reset request failed: %s", e)
+
 @app.route("/forgot_password", methods=['GET', 'POST'])
 def forgot_password():
     
     if request.method == 'POST':
         
         email = request.form.get('email')
-        user=database.get_user_by_email(email)
-        
-        if user:
-
-            token, token_hash = generate_secure_reset_token()
-            expires_at = datetime.now() + timedelta(minutes=15)
+        retry_after = passwords.reset_retry_after(request.remote_addr)
+        if retry_after:
+            return _throttled('forgot_password.html', retry_after)
 
-            stored_successfully = database.store_reset_token(user['id'], token_hash, expires_at)
-
-            if stored_successfully:
-             reset_link = url_for('reset_password', token=token, _external=True)
-             email_server.send_reset_email(email, reset_link)
-
-            else:
-             flash("An error occurred. Please try again.", "error")
-             return redirect(url_for('forgot_password'))
+        # The lookup, token and email all happen off the request thread, so the
+        # response takes the same time whether or not the account exists.
+        if email and not _submit_password_reset(email, url_for('reset_password', _external=True)):
+            logger.warning("Password reset queue is full; turning a request away.")
+            return _busy('forgot_password.html',
+                         error_message="We're handling a lot of requests right now. Please try again in a moment.")
 
         return render_template_string("""
     <!DOCTYPE html>
@@ -233,7 +405,12 @@ def reset_password():
         user_id = reset_request['user_id']
         
         # Securely hash the new password using Bcrypt
-        hashed_password = bcrypt.generate_password_hash(new_password).decode('utf-8')
+        try:
+            database.release_request_connection()
+            hashed_password = passwords.hash_password(new_password)
+        except passwords.PasswordHasherBusy:
+            flash("We're handling a lot of requests right now. Please try again in a moment.", "error")
+            return render_template("reset_password_form.html", token=token), 503
         
         database.update_user_password(user_id, hashed_password)
         
@@ -279,46 +456,42 @@ def dashboard():
         flash('Please log in to access this page.', 'warning')
         return redirect(url_for('login'))
     
-    documents = database.get_documents_by_user(user_id)
-    documents_for_template=[]
-    for doc in documents:
-        tags=doc["tags"]
-        tags_list = [tag.strip() for tag in tags.split(',')]
-
-        clean_document = {
-        'id': doc["id"],
-        'filename': doc["filename"],
-        'url':doc["url"],
-        'tags': tags_list,
-        'created_at': doc["created_at"]
-        }
-        print(clean_document)
-        documents_for_template.append(clean_document)
-    
-    return render_template('dashboard.html', documents=documents_for_template)
-
-# Helper function to check for allowed file types
-ALLOWED_EXTENSIONS = {'pdf'}
-def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    # Tags are stored normalized; 'Finance ' and 'finance' are the same filter
+    active_tag = database.normalize_tag(request.args.get('tag', '')) or None
+    stamp = cache.user_stamp(user_id)
+    etag = f"dashboard-{user_id}-{stamp}-{hashlib.sha1((active_tag or '').encode()).hexdigest()[:12]}"
+
+    def render():
+        documents, tag_counts = cache.get_listing(user_id, active_tag, stamp)
+        return render_template('dashboard.html', documents=documents,
+                               tag_counts=tag_counts, active_tag=active_tag,
+                               upload_accept=",".join(extractors.extensions() + ['.zip']))
+
+    return render_conditional(etag, stamp, render)
+
+@app.route('/dashboard/tags')
+def dashboard_tags():
+    """JSON tag facets for the logged-in user, optionally with the matching documents."""
+    if 'user_id' not in session:
+        return {"error": "Unauthorized. Please log in."}, 401
 
-def generate_unique_public_id(original_filename):
-    """
-    Takes a filename, sanitizes it, and adds a unique suffix.
-    Returns a string suitable for a Cloudinary public_id.
-    """
-    # 1. Get the original filename and separate its name and extension
-    filename_without_ext, file_ext = os.path.splitext(original_filename)
-    
-    # 2. Sanitize the base filename (replace non-alphanumeric chars with '_')
-    sanitized_filename = "".join(c if c.isalnum() else "_" for c in filename_without_ext)
-    
-    # 3. Create a unique suffix using 4 random bytes (8 hex characters)
-    unique_suffix = secrets.token_hex(4)
-    
-    # 4. Construct and return the final, unique public_id
-    return f"{sanitized_filename}_{unique_suffix}"
+    user_id = session['user_id']
+    tag = database.normalize_tag(request.args.get('tag', '')) or None
+    documents, tag_counts = cache.get_listing(user_id, tag)
+    response = {"tags": tag_counts}
+
+    if tag:
+        response["documents"] = [
+            {
+                'id': doc['id'],
+                'filename': doc['filename'],
+                'tags': doc['tags'],
+                'created_at': doc['created_at'].isoformat(),
+                'processing_status': doc['processing_status'],
+            }
+            for doc in documents
+        ]
+    return response
 
 @app.route('/upload', methods=['POST'])
 def upload_document():
@@ -339,58 +512,126 @@ def upload_document():
         return redirect(url_for('dashboard'))
 
     # 4. Validate the file type
-    if file and allowed_file(file.filename):
+    if file and ingestion.allowed_file(file.filename):
+        rss_start = telemetry.current_rss_bytes()
+        rss_peak = rss_start
+        # Spool the upload to disk once; every stage reads it by path
+        upload = None
         try:
-           
-            file_bytes=file.read()
-          
-            final_public_id = generate_unique_public_id(file.filename)
-
-            # --- AI LOGIC ---
-            text_content = ""
-            with fitz.open(stream=file_bytes, filetype="pdf") as doc:
-                for page in doc:
-                    text_content += page.get_text()
-            
-            tags_list = ai_utils.generate_tags_for_text(text_content)
-            tags_string = ",".join(tags_list)
+            upload = processing.SpooledUpload(file)
+            # Ingestion waits on Ollama; its own database calls check connections out as needed
+            database.release_request_connection()
+            ingestion.ingest_file(session['user_id'], upload)
+            rss_peak = max(rss_peak, telemetry.current_rss_bytes())
 
-            summary = ai_utils.generate_summary_for_text(text_content)
+            flash('File uploaded successfully! Processing for search has begun.', 'success')
 
-            # --- Rewind the file stream back to the beginning IMP---
-            file.seek(0)
-
-            # Upload the file to Cloudinary
-            # 'raw' because it's a non-image file (PDF)
-            upload_result = cloudinary.uploader.upload(
-                file, 
-                public_id=final_public_id,
-                resource_type='raw',
-                )
-        
-            
-            url = upload_result.get('secure_url')
-            public_id = upload_result.get('public_id')
-            user_id = session['user_id']
+        except Exception as e:
+            flash(f'An error occurred during upload: {e}', 'danger')
+        finally:
+            if upload is not None:
+                upload.cleanup()
+            # RSS growth is sampled at stage boundaries, so it is a lower bound
+            telemetry.set_gauge("intellidocs_upload_rss_growth_bytes", rss_peak - rss_start)
+            telemetry.max_gauge("intellidocs_upload_rss_growth_bytes_max", rss_peak - rss_start)
             
-            new_doc_id=database.add_document(user_id, file.filename, url, public_id, tags_string,summary)
+        return redirect(url_for('dashboard'))
+    else:
+        flash(f"Invalid file type. Supported types: {', '.join(extractors.extensions())}.", 'danger')
+        return redirect(url_for('dashboard'))
+
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """
+    Accepts many PDFs and/or zip archives of PDFs under the 'files' field and
+    ingests them in the background. Returns the batch id and its progress URL.
+    """
+    if 'user_id' not in session:
+        return {"error": "Unauthorized. Please log in."}, 401
 
-            if new_doc_id:
-                database.update_document_status(new_doc_id, 'PROCESSING')
-                processing.process_and_index_pdf(new_doc_id, file_bytes)
+    files = [f for f in request.files.getlist('files') if f.filename]
+    if not files:
+        return {"error": "No files provided."}, 400
 
-                flash('File uploaded successfully! Processing for search has begun.', 'success')
+    uploads, archives, skipped = [], [], []
+    try:
+        for file in files:
+            if ingestion.allowed_file(file.filename):
+                uploads.append(processing.SpooledUpload(file))
+            elif file.filename.lower().endswith('.zip'):
+                archives.append(processing.SpooledUpload(file, suffix='.zip'))
             else:
-                flash('Failed to save file information to the database.', 'danger')
+                skipped.append(file.filename)
+
+        batch = ingestion.start_batch(session['user_id'], uploads, archives, skipped)
+    except Exception:
+        # Until the batch has started, the spooled files are still ours to remove
+        for spooled in uploads + archives:
+            spooled.cleanup()
+        raise
+    return {
+        "batch_id": batch.id,
+        "progress_url": url_for('batch_progress', batch_id=batch.id),
+    }, 202
+
+@app.route('/upload/batch/<batch_id>')
+def batch_progress(batch_id):
+    if 'user_id' not in session:
+        return {"error": "Unauthorized. Please log in."}, 401
 
-        except Exception as e:
-            flash(f'An error occurred during upload: {e}', 'danger')
-            
+    status = ingestion.get_batch_status(batch_id, session['user_id'])
+    if status is None:
+        return {"error": "Batch not found."}, 404
+    return status
+
+@app.route('/events/ingestion')
+def ingestion_events():
+    """
+    Server-Sent Events stream of the logged-in user's ingestion updates (see
+    progress.py). The session is read up front: the stream runs after the
+    request scope, and its database connection, are gone.
+    """
+    if 'user_id' not in session:
+        return {"error": "Unauthorized. Please log in."}, 401
+
+    # Each open stream holds a request thread; past the cap the browser retries later
+    if not progress.acquire_stream_slot():
+        return {"error": "Too many live progress streams; try again shortly."}, 503, {'Retry-After': '10'}
+
+    response = Response(progress.stream(session['user_id']), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Tell nginx to pass events through as they come instead of buffering them
+        'X-Accel-Buffering': 'no',
+    })
+    # Runs when the server closes the response, even if the stream never started
+    response.call_on_close(progress.release_stream_slot)
+    return response
+
+@app.route('/document/<int:doc_id>/retry', methods=['POST'])
+def retry_document(doc_id):
+    if 'user_id' not in session:
+        flash('Please log in to retry processing.', 'danger')
+        return redirect(url_for('login'))
+
+    # Check ownership first; only the owner's request reads the row
+    document = database.get_document_by_id(doc_id) if cache.owns_document(session['user_id'], doc_id) else None
+    if not document or document['user_id'] != session['user_id']:
+        flash('Document not found or you are not authorized.', 'danger')
         return redirect(url_for('dashboard'))
-    else:
-        flash('Invalid file type. Only PDF files are allowed.', 'danger')
+
+    if document['processing_status'] != 'FAILED':
+        flash('This document does not need to be retried.', 'info')
         return redirect(url_for('dashboard'))
 
+    try:
+        # Only the branch that failed (storage and/or AI processing) is re-run
+        database.release_request_connection()
+        ingestion.retry_document(document)
+        flash('Document processed successfully.', 'success')
+    except Exception as e:
+        flash(f'Retry failed: {e}', 'danger')
+    return redirect(url_for('dashboard'))
+
 @app.route('/delete/<int:doc_id>', methods=['POST'])
 def delete_document(doc_id):
     
@@ -399,43 +640,83 @@ def delete_document(doc_id):
         flash('You must be logged in to delete files.', 'danger')
         return redirect(url_for('login'))
     
-    # 2. Fetch the document's metadata from our database
+    # 2. CRUCIAL SECURITY CHECK: Verify the logged-in user owns this document,
+    # from the cached ownership index before any row is fetched
+    if not cache.owns_document(session['user_id'], doc_id):
+        flash('Document not found or you are not authorized to delete it.', 'warning')
+        return redirect(url_for('dashboard'))
+
+    # 3. Fetch the document's metadata from our database
     document_to_delete = database.get_document_by_id(doc_id)
     
-    # 3. Check if the document exists
-    if not document_to_delete:
+    # 4. Check if the document exists, and is still this user's
+    if not document_to_delete or document_to_delete['user_id'] != session['user_id']:
         flash('Document not found or it may have already been deleted.', 'warning')
         return redirect(url_for('dashboard'))
-
-    # 4. CRUCIAL SECURITY CHECK: Verify the logged-in user owns this document
-    if document_to_delete['user_id'] != session['user_id']:
-        flash('You are not authorized to delete this document.', 'danger')
-        return redirect(url_for('dashboard'))
     
-    print("DEBUG: Security check passed. Proceeding with deletion.")
+    logger.debug("Security check passed. Proceeding with deletion.")
     try:
-        # 5. If all checks pass, delete the file from Cloudinary
-        public_id = document_to_delete['public_id']
-        cloudinary.uploader.destroy(public_id, resource_type='raw')
-        
-        # 6. If Cloudinary deletion is successful, delete the record from our database
-        if database.delete_document_record(doc_id):
+        # 5. If all checks pass, delete the record and its stored file together.
+        # A content-addressed file shared with another document is kept; the
+        # references are counted and the file removed while the rows are locked.
+        if database.delete_document_record(doc_id, release_file=storage.delete_file):
+            cache.invalidate_document(doc_id, document_to_delete['user_id'])
+            # Its chunks would otherwise stay in the vector index for good,
+            # and the copy kept for a retry on disk
+            vector_store.delete_document_chunks(doc_id)
+            ingestion.discard_retry_file(doc_id)
             flash('Document deleted successfully.', 'success')
         else:
-            flash('File was deleted from storage, but failed to be removed from the database.', 'danger')
+            flash('The document could not be deleted. Please try again.', 'danger')
 
     except Exception as e:
         flash(f'An error occurred while deleting the file: {e}', 'danger')
     
-    # 7. Finally, redirect back to the dashboard
+    # 6. Finally, redirect back to the dashboard
     return redirect(url_for('dashboard'))
 
+@app.route('/files/<public_id>')
+def serve_file(public_id):
+    """
+    Serves a file kept by the local storage backend. send_file handles Range
+    requests (so PDF.js can fetch pages on demand), ETag/If-None-Match and
+    Last-Modified, and streams the file through the server's file wrapper
+    (sendfile) or X-Sendfile instead of reading it into memory.
+    """
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    path = storage.local_path(public_id)
+    filename = database.get_filename_for_public_id(session['user_id'], public_id) \
+        if path and os.path.exists(path) else None
+    if not filename:
+        abort(404)
+
+    # The public_id is the SHA-256 of the content, so it is a strong ETag. Only
+    # PDFs are shown inline (in PDF.js); anything else, HTML in particular, is
+    # a download so it never renders on this origin.
+    extractor = extractors.lookup(filename)
+    mimetype = extractor.mimetype if extractor else 'application/octet-stream'
+    response = send_file(path, mimetype=mimetype, as_attachment=mimetype != 'application/pdf',
+                         download_name=filename, conditional=True, etag=public_id,
+                         max_age=FILE_CACHE_MAX_AGE)
+    # Private: files are per-user, so shared caches must not keep them
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/view/<int:doc_id>')
 def view_document(doc_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    document = database.get_document_by_id(doc_id)
+    if not cache.owns_document(session['user_id'], doc_id):
+        flash('Document not found or you are not authorized to view it.', 'danger')
+        return redirect(url_for('dashboard'))
+
+    stamp = cache.document_stamp(doc_id)
+    document = cache.get_document(doc_id, stamp)
     
     if not document or document['user_id'] != session['user_id']:
         flash('Document not found or you are not authorized to view it.', 'danger')
@@ -443,16 +724,17 @@ def view_document(doc_id):
     
     
    
-    return render_template(
+    return render_conditional(f"view-{doc_id}-{stamp}", stamp, lambda: render_template(
         'view_document.html', 
         document=document,
         document_url=document['url'], 
         document_filename=document['filename'],
         document_summary=document['summary'],
+        insights=cache.get_insights(doc_id, stamp),
         search_query="",     
         search_results=[],    
         search_error=None     
-    )
+    ))
 
 @app.route('/document/<int:doc_id>/search', methods=['POST'])
 def search_in_document(doc_id):
@@ -462,9 +744,8 @@ def search_in_document(doc_id):
         flash('Please log in to search.', 'danger')
         return redirect(url_for('login'))
 
-    document = database.get_document_by_id(doc_id)
-    
-    if not document or document['user_id'] != session['user_id']:
+    owned, index_version = cache.owned_version(session['user_id'], doc_id)
+    if not owned:
         flash('Document not found or you are not authorized.', 'danger')
         return redirect(url_for('dashboard'))
 
@@ -481,21 +762,27 @@ def search_in_document(doc_id):
             search_results = vector_store.search_document(
                 doc_id=doc_id,
                 query_text=query,
-                top_k=3  # Get the top 3 results
+                top_k=3,  # Get the top 3 results
+                version=index_version
             )
             if not search_results:
                 search_error = "No relevant results found."
         except Exception as e:
-            print(f"Search error for doc {doc_id}: {e}") # Log the error
+            logger.error("Search error for doc %s: %s", doc_id, e) # Log the error
             search_error = "An error occurred during search."
 
     # 4. Re-render the same page, but pass in the search data
+    document = cache.get_document(doc_id)
+    if not document:
+        flash('Document not found or you are not authorized.', 'danger')
+        return redirect(url_for('dashboard'))
     return render_template(
         'view_document.html',
         document=document,
         document_url=document['url'],
         document_filename=document['filename'],
         document_summary=document['summary'],
+        insights=cache.get_insights(doc_id),
         search_query=query,       
         search_results=search_results,
         search_error=search_error    
@@ -510,9 +797,9 @@ def chat_with_document(doc_id):
         # User not logged in
         return {"error": "Unauthorized. Please log in."}, 401
 
-    document = database.get_document_by_id(doc_id)
-    
-    if not document or document['user_id'] != session['user_id']:
+    # The ownership index also carries the index version, so no row is fetched
+    owned, index_version = cache.owned_version(session['user_id'], doc_id)
+    if not owned:
        return {"error": "Document not found or access denied."}, 404
 
     # 2. Get the user's message from the JSON body
@@ -524,16 +811,26 @@ def chat_with_document(doc_id):
 
     try:
 
-        mongodb.save_message_to_history(str(doc_id), "user", message)
-        ai_reply = rag.answer_from_document(doc_id,message)
+        # Histories are private to this user and this login's chat session
+        if 'chat_session' not in session:
+            session['chat_session'] = secrets.token_hex(8)
+        session_id = mongodb.chat_session_key(session['user_id'], doc_id, session['chat_session'])
+
+        # The answer may wait on Ollama; don't hold a pooled connection meanwhile
+        database.release_request_connection()
+        # Precomputed answers (cached with the document) are tried before live generation
+        ai_reply = rag.answer_from_document(doc_id, message, session_id,
+                                            index_version=index_version,
+                                            insights=cache.get_insights(doc_id))
 
-        mongodb.save_message_to_history(str(doc_id), "assistant", ai_reply)
+        # Store the question and the reply together in one round trip
+        mongodb.save_exchange_to_history(session_id, message, ai_reply)
         
         # 4. Return the AI's response
         return {"reply": ai_reply}
 
     except Exception as e:
-        print(f"Error in chat endpoint for doc {doc_id}: {e}")
+        logger.error("Error in chat endpoint for doc %s: %s", doc_id, e)
         return {"error": f"An internal server error occurred: {str(e)}"}, 500
 
 
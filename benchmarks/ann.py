@@ -0,0 +1,161 @@
+"""
+Compares the vector index engines in vector_store on the same data:
+
+  chroma                 one Chroma collection, doc_id metadata filter
+  shards-float16         ShardedIndex, float16 matrices
+  shards-int8            int8 matrices with per-vector scales
+  shards-int8-rescore    int8 candidates rescored with float32 vectors on disk
+  shards-binary          1-bit codes, Hamming distance only
+  shards-binary-rescore  1-bit candidates rescored with float32 vectors on disk
+  shards-hnsw            float16 with an HNSW graph on every shard
+
+    python -m benchmarks.ann --docs 1000 --chunks-per-doc 300
+    python -m benchmarks.ann --docs 20 --chunks-per-doc 50000 --engines shards-float16,shards-hnsw
+
+For every engine it reports query latency (p50/p95/p99), recall@k against
+exact float32 search over the same document, index build time, the on-disk
+size of the searched matrices (index_mb) and the total size on disk (disk_mb,
+including chunk texts and rescoring vectors). Memory is measured after every
+document has been searched once: resident_mb is what the loaded shards hold
+(matrices, scales, offsets, graphs), and rss_growth_mb is how much the
+process grew, which also counts memory-mapped rescoring pages that were read.
+Vectors are seeded random unit vectors; queries are chunk vectors
+with noise added, so each has a few genuinely close neighbours.
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks import stats
+
+ENGINES = ("chroma", "shards-float16", "shards-int8", "shards-int8-rescore",
+           "shards-binary", "shards-binary-rescore", "shards-hnsw")
+
+
+def make_index(vector_store, engine, root):
+    if engine == "chroma":
+        return vector_store.ChromaIndex(path=root)
+    # The shard cache holds every document, so resident_mb covers all of them
+    if engine == "shards-hnsw":
+        if vector_store.hnswlib is None:
+            return None
+        return vector_store.ShardedIndex(root=root, dtype="float16", hnsw_min_chunks=1, cache_mb=2**20)
+    _, dtype, *rest = engine.split("-")
+    return vector_store.ShardedIndex(root=root, dtype=dtype, hnsw_min_chunks=sys.maxsize,
+                                     cache_mb=2**20, rescore=rest == ["rescore"])
+
+
+def doc_vectors(seed, doc_id, n, dim):
+    """The same seeded vectors for a document, however often it is asked for."""
+    rng = np.random.default_rng([seed, doc_id])
+    vectors = rng.standard_normal((n, dim), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def dir_size(path, names=None) -> int:
+    """Bytes under path, optionally counting only files called one of `names`."""
+    total = 0
+    for folder, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(folder, f)) for f in files if names is None or f in names)
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=200)
+    parser.add_argument("--chunks-per-doc", type=int, default=300)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--noise", type=float, default=0.05, help="noise added to query vectors")
+    parser.add_argument("--engines", default=",".join(ENGINES))
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default=None, help="JSON output path (default benchmarks/results/ann-<time>.json)")
+    args = parser.parse_args(argv)
+
+    scratch = tempfile.mkdtemp(prefix="intellidocs_ann_")
+    # Keep the module-level index away from the real ./chroma_db and ./vector_shards.
+    os.environ["CHROMA_PATH"] = os.path.join(scratch, "default_chroma")
+    os.environ["VECTOR_SHARD_PATH"] = os.path.join(scratch, "default_shards")
+    os.environ["VECTOR_FAST_PATH_DIR"] = os.path.join(scratch, "default_fastpath")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    import telemetry
+    import vector_store
+
+    pick = random.Random(args.seed)
+    noise_rng = np.random.default_rng(args.seed)
+    queries = []
+    for _ in range(args.queries):
+        doc_id = pick.randrange(args.docs)
+        vectors = doc_vectors(args.seed, doc_id, args.chunks_per_doc, args.dim)
+        query = vectors[pick.randrange(args.chunks_per_doc)] + noise_rng.normal(0, args.noise, args.dim)
+        query = (query / np.linalg.norm(query)).astype(np.float32)
+        exact = np.argsort(-(vectors @ query))[:args.top_k]
+        queries.append((doc_id, query, set(int(i) for i in exact)))
+
+    benchmarks = {}
+    try:
+        for engine in [e for e in args.engines.split(",") if e]:
+            root = os.path.join(scratch, engine)
+            index = make_index(vector_store, engine, root)
+            if index is None:
+                print(f"Skipping {engine}: hnswlib is not installed.")
+                continue
+
+            started = time.perf_counter()
+            for doc_id in range(args.docs):
+                vectors = doc_vectors(args.seed, doc_id, args.chunks_per_doc, args.dim)
+                chunks = [f"doc {doc_id} chunk {i}" for i in range(args.chunks_per_doc)]
+                index.add(doc_id, chunks, vectors)
+            build_seconds = time.perf_counter() - started
+
+            # Load every document once (this also warms up), then measure what stayed in memory
+            rss_before = telemetry.current_rss_bytes()
+            for doc_id in range(args.docs):
+                index.search(doc_id, queries[0][1], args.top_k)
+            rss_growth = telemetry.current_rss_bytes() - rss_before
+            resident = sum(entry.nbytes for entry in getattr(index, "_cache", {}).values())
+
+            samples, hits = [], 0
+            for doc_id, query, exact in queries:
+                started = time.perf_counter()
+                results = index.search(doc_id, query, args.top_k)
+                samples.append(time.perf_counter() - started)
+                hits += len(exact & {position for position, _ in results})
+
+            summary = stats.summarize(samples)
+            summary["recall_at_k"] = round(hits / (len(queries) * args.top_k), 4)
+            summary["build_seconds"] = round(build_seconds, 2)
+            summary["disk_mb"] = round(dir_size(root) / 2**20, 2)
+            summary["rss_growth_mb"] = round(rss_growth / 2**20, 2)
+            if engine != "chroma":
+                summary["index_mb"] = round(dir_size(root, {"vectors.npy", "scales.npy", "hnsw.bin"}) / 2**20, 2)
+                summary["resident_mb"] = round(resident / 2**20, 2)
+            benchmarks[engine] = summary
+            print(f"  {engine:<22} recall@{args.top_k} {summary['recall_at_k']:.3f}  "
+                  f"index {summary.get('index_mb', summary['disk_mb']):.1f} MB  "
+                  f"resident {summary.get('resident_mb', summary['rss_growth_mb']):.1f} MB  "
+                  f"disk {summary['disk_mb']:.1f} MB  build {summary['build_seconds']:.1f}s")
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    results = {
+        "environment": stats.environment(),
+        "parameters": vars(args),
+        "benchmarks": benchmarks,
+    }
+    stats.print_table(f"Vector index engines ({args.docs} docs x {args.chunks_per_doc} chunks)", benchmarks)
+    out = args.out or os.path.join(os.path.dirname(__file__), "results", f"ann-{int(time.time())}.json")
+    stats.save_results(out, results)
+    print(f"\nResults written to {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+"""
+Login throughput under mixed load. One process serves a burst of logins
+together with search requests (a NumPy top-k over a chunk matrix, standing
+in for vector search), the way a worker's request threads do:
+
+    python -m benchmarks.auth --logins 200 --searches 400 --threads 16
+    python -m benchmarks.auth --rounds 12 --workers 2 --flood 20000
+
+Each mix is run twice:
+  inline  bcrypt on the request thread (the previous behaviour)
+  pool    passwords.PasswordHasher, bcrypt on a bounded worker pool
+and once with searches alone as the baseline. Reports latency per request
+kind and login throughput. It also measures how fast a flood of logins from
+one IP is turned away by the throttle, before any bcrypt work.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from benchmarks import stats
+
+
+def make_jobs(args, login, search):
+    jobs = [("login", login)] * args.logins + [("search", search)] * args.searches
+    random.Random(args.seed).shuffle(jobs)
+    return jobs
+
+
+def run_mix(jobs, threads):
+    """Runs (kind, fn) jobs on `threads` request threads. Returns per-kind samples and wall seconds per kind."""
+    started = time.perf_counter()
+
+    def run(job):
+        kind, fn = job
+        t = time.perf_counter()
+        fn()
+        done = time.perf_counter()
+        return kind, done - t, done - started
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(run, jobs))
+    samples, finished = {}, {}
+    for kind, seconds, at in results:
+        samples.setdefault(kind, []).append(seconds)
+        finished[kind] = max(finished.get(kind, 0.0), at)
+    return {kind: stats.summarize(values, finished[kind]) for kind, values in samples.items()}
+
+
+def bench_flood(passwords, attempts):
+    """Login attempts from one IP against one account, through the throttle only."""
+    samples = []
+    rejected = 0
+    for _ in range(attempts):
+        t = time.perf_counter()
+        if passwords.login_retry_after("203.0.113.7", "victim@example.com"):
+            rejected += 1
+        else:
+            passwords.record_login("victim@example.com", False)
+        samples.append(time.perf_counter() - t)
+    summary = stats.summarize(samples, sum(samples))
+    summary["rejected"] = rejected
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--searches", type=int, default=400)
+    parser.add_argument("--threads", type=int, default=16, help="request threads in the worker")
+    parser.add_argument("--rounds", type=int, default=10, help="bcrypt cost")
+    parser.add_argument("--workers", type=int, default=2, help="PASSWORD_HASH_WORKERS for the pool run")
+    parser.add_argument("--chunks", type=int, default=50000, help="rows in the search matrix")
+    parser.add_argument("--flood", type=int, default=10000, help="throttled attempts to time")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default=None, help="JSON output path (default benchmarks/results/auth-<time>.json)")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("LOG_LEVEL", "ERROR")
+    import bcrypt
+    import passwords
+
+    rng = np.random.default_rng(args.seed)
+    matrix = rng.standard_normal((args.chunks, 384), dtype=np.float32)
+    query = rng.standard_normal(384, dtype=np.float32)
+
+    def search():
+        scores = matrix @ query
+        np.argpartition(scores, -5)[-5:]
+
+    password = "correct horse battery staple"
+    stored = bcrypt.hashpw(password.encode(), bcrypt.gensalt(args.rounds))
+    hasher = passwords.PasswordHasher(rounds=args.rounds, workers=args.workers,
+                                      max_waiting=args.threads, timeout=600)
+    stored_text = stored.decode()
+
+    benchmarks = {}
+    for kind, summary in run_mix([("search", search)] * args.searches, args.threads).items():
+        benchmarks[f"baseline/{kind}"] = summary
+    for kind, summary in run_mix(make_jobs(args, lambda: bcrypt.checkpw(password.encode(), stored), search),
+                                 args.threads).items():
+        benchmarks[f"inline/{kind}"] = summary
+    for kind, summary in run_mix(make_jobs(args, lambda: hasher.verify(stored_text, password), search),
+                                 args.threads).items():
+        benchmarks[f"pool/{kind}"] = summary
+    benchmarks["throttled/login"] = bench_flood(passwords, args.flood)
+
+    results = {
+        "environment": stats.environment(),
+        "parameters": vars(args),
+        "benchmarks": benchmarks,
+    }
+    stats.print_table(f"Logins under mixed load (cost {args.rounds}, {args.threads} threads, "
+                      f"{args.workers} hash workers)", benchmarks)
+    print(f"  throttle rejected {benchmarks['throttled/login']['rejected']} of {args.flood} flood attempts")
+    out = args.out or os.path.join(os.path.dirname(__file__), "results", f"auth-{int(time.time())}.json")
+    stats.save_results(out, results)
+    print(f"\nResults written to {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
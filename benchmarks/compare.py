@@ -0,0 +1,46 @@
+"""
+Compares two benchmark result files (from benchmarks.micro or benchmarks.e2e).
+
+    python -m benchmarks.compare before.json after.json [--metric p50_ms] [--tolerance 0.1]
+
+Prints every shared entry with its change and exits 1 if any got slower than
+the tolerance allows.
+"""
+import argparse
+import sys
+
+from benchmarks import stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--metric", default="p50_ms")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown (0.1 = 10%%)")
+    args = parser.parse_args(argv)
+
+    before = stats.load_results(args.before)
+    after = stats.load_results(args.after)
+
+    print(f"  {'name':<52}{'before':>12}{'after':>12}{'change':>10}")
+    for section, entries in sorted(after.items()):
+        if section not in before or not isinstance(entries, dict):
+            continue
+        for name, figures in sorted(entries.items()):
+            old = before[section].get(name)
+            if not isinstance(figures, dict) or not isinstance(old, dict) or not old.get(args.metric):
+                continue
+            change = (figures[args.metric] - old[args.metric]) / old[args.metric]
+            print(f"  {section + '/' + name:<52}{old[args.metric]:>12.3f}{figures[args.metric]:>12.3f}{change:>+10.1%}")
+
+    regressions = stats.compare(before, after, metric=args.metric, tolerance=args.tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} entries regressed by more than {args.tolerance:.0%} on {args.metric}.")
+        return 1
+    print(f"\nNo regressions beyond {args.tolerance:.0%} on {args.metric}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
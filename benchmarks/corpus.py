@@ -0,0 +1,97 @@
+import html
+import io
+import random
+import zipfile
+
+import fitz
+
+# A fixed vocabulary built from syllables, so generated text has a realistic
+# spread of word lengths without needing any external word list.
+_SYLLABLES = ["ka", "lo", "mi", "ren", "tas", "vo", "qui", "ber", "son", "al",
+              "dra", "pex", "nu", "tor", "li", "gem", "sha", "wil", "ox", "ter"]
+
+
+def vocabulary(size: int = 2000, seed: int = 7) -> list[str]:
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(1, 4))))
+    return sorted(words)
+
+
+def random_text(rng: random.Random, n_words: int, words: list[str]) -> str:
+    """Sentences of 8-20 words drawn from `words`."""
+    out = []
+    while len(out) < n_words:
+        sentence = rng.choices(words, k=rng.randint(8, 20))
+        sentence[0] = sentence[0].capitalize()
+        sentence[-1] += "."
+        out.extend(sentence)
+    return " ".join(out[:n_words])
+
+
+def make_pdf(rng: random.Random, pages: int, words_per_page: int, words: list[str]) -> bytes:
+    """Builds a text PDF in memory with PyMuPDF."""
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page()
+        page.insert_textbox(page.rect + (50, 50, -50, -50), random_text(rng, words_per_page, words), fontsize=9)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+_DOCX_HEAD = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+              '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>')
+
+
+def make_document(fmt: str, rng: random.Random, n_words: int, words: list[str], words_per_section: int = 400) -> bytes:
+    """
+    A document of about n_words words in `fmt` (pdf, docx, txt, md or html),
+    in sections of words_per_section words, each under a heading.
+    """
+    if fmt == "pdf":
+        return make_pdf(rng, max(1, n_words // words_per_section), words_per_section, words)
+    sections = [(f"Section {i + 1}", random_text(rng, words_per_section, words))
+                for i in range(max(1, n_words // words_per_section))]
+    if fmt == "txt":
+        return "".join(f"{title}\n\n{text}\n\n" for title, text in sections).encode()
+    if fmt == "md":
+        return "".join(f"## {title}\n\n{text}\n\n" for title, text in sections).encode()
+    if fmt == "html":
+        body = "".join(f"<h2>{title}</h2><p>{html.escape(text)}</p>" for title, text in sections)
+        return f"<html><head><title>Bench</title></head><body>{body}</body></html>".encode()
+    if fmt == "docx":
+        paragraphs = "".join(
+            f'<w:p><w:pPr><w:pStyle w:val="Heading2"/></w:pPr><w:r><w:t>{title}</w:t></w:r></w:p>'
+            f'<w:p><w:r><w:t>{html.escape(text)}</w:t></w:r></w:p>'
+            for title, text in sections
+        )
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("word/document.xml", f"{_DOCX_HEAD}{paragraphs}</w:body></w:document>")
+        return buffer.getvalue()
+    raise ValueError(f"Unknown format: {fmt}")
+
+
+def make_corpus(n_docs: int, pages: int = 5, words_per_page: int = 400, seed: int = 42) -> list[tuple[str, bytes]]:
+    """Returns [(filename, pdf_bytes)] — identical for the same arguments."""
+    rng = random.Random(seed)
+    words = vocabulary(seed=seed)
+    return [
+        (f"bench_{i:05d}.pdf", make_pdf(rng, pages, words_per_page, words))
+        for i in range(n_docs)
+    ]
+
+
+def make_chunks(n_chunks: int, words_per_chunk: int = 300, seed: int = 42) -> list[str]:
+    """Chunk-sized passages for vector store benchmarks, without going through a PDF."""
+    rng = random.Random(seed)
+    words = vocabulary(seed=seed)
+    return [random_text(rng, words_per_chunk, words) for _ in range(n_chunks)]
+
+
+def make_queries(n_queries: int, seed: int = 1234) -> list[str]:
+    rng = random.Random(seed)
+    words = vocabulary(seed=42)
+    return [random_text(rng, rng.randint(4, 12), words) for _ in range(n_queries)]
@@ -0,0 +1,212 @@
+"""
+End-to-end benchmark: drives the real Flask app through its HTTP routes with
+every external service replaced by a local stand-in (see benchmarks/stubs.py).
+
+    python -m benchmarks.e2e --docs 40 --users 4 --concurrency 4
+    python -m benchmarks.e2e --save-baseline        # write benchmarks/baselines/e2e.json
+    python -m benchmarks.e2e --compare              # exit 1 if p95 regressed
+
+Reports p50/p95/p99 latency and throughput per route and per pipeline stage
+(the stages come from telemetry.timed).
+"""
+import argparse
+import io
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import stubs, stats, corpus
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baselines", "e2e.json")
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+class Recorder:
+    """Thread-safe collector of raw latency samples."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.samples[name].append(seconds)
+
+    def on_stage(self, stage, outcome, seconds):
+        if outcome == "ok":
+            self.add(stage, seconds)
+
+
+def run_phase(name, jobs, concurrency, recorder):
+    """Runs callables concurrently, timing each under `name`. Returns wall seconds."""
+    def timed_job(job):
+        started = time.perf_counter()
+        ok = job()
+        recorder.add(name if ok else f"{name} (failed)", time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(timed_job, jobs))
+    return time.perf_counter() - started
+
+
+def wait_until_ingested(users, timeout, database, interval=0.2):
+    """
+    Polls every user's documents until none is still pending or processing,
+    then keeps only the COMPLETED ones in user["doc_ids"]. Returns the seconds
+    waited.
+    """
+    started = time.perf_counter()
+    while True:
+        pending = 0
+        for user in users:
+            documents = database.get_documents_by_user(user["user_id"]) or []
+            pending += sum(d["processing_status"] not in ("COMPLETED", "FAILED") for d in documents)
+            user["doc_ids"] = [d["id"] for d in documents if d["processing_status"] == "COMPLETED"]
+        if not pending:
+            break
+        if time.perf_counter() - started > timeout:
+            print(f"{pending} documents still processing after {timeout}s; benchmarking the rest.",
+                  file=sys.stderr)
+            break
+        time.sleep(interval)
+    return time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=20, help="PDFs to upload")
+    parser.add_argument("--pages", type=int, default=5, help="pages per PDF")
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=50, help="requests per read phase")
+    parser.add_argument("--token-latency", type=float, default=0.002, help="fake Ollama seconds per token")
+    parser.add_argument("--first-token-latency", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--ready-timeout", type=float, default=600,
+                        help="seconds to wait for uploads to finish ingesting")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p95 slowdown (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    handles = stubs.install_all({
+        "token_latency": args.token_latency,
+        "first_token_latency": args.first_token_latency,
+    })
+    try:
+        return run(args, handles)
+    finally:
+        stubs.teardown(handles)
+
+
+def run(args, handles):
+    # Imported only now: the app connects to its services at import time.
+    import telemetry
+    from app import app
+    import database
+
+    recorder = Recorder()
+    telemetry.add_listener(recorder.on_stage)
+
+    # --- Users ---
+    users = []
+    for i in range(args.users):
+        client = app.test_client()
+        client.post("/signup", data={
+            "email": f"bench{i}@example.com", "password": "bench-pass", "confirm_password": "bench-pass"
+        })
+        with client.session_transaction() as sess:
+            users.append({"client": client, "lock": threading.Lock(), "user_id": sess["user_id"]})
+
+    # Flask's test client keeps cookies per instance, so each job holds its user's lock.
+    def as_user(user, fn):
+        def job():
+            with user["lock"]:
+                return fn(user["client"])
+        return job
+
+    # --- Upload ---
+    pdfs = corpus.make_corpus(args.docs, pages=args.pages, seed=args.seed)
+    upload_jobs = [
+        as_user(users[i % len(users)], lambda c, name=name, data=data: c.post(
+            "/upload", data={"file": (io.BytesIO(data), name)}, content_type="multipart/form-data"
+        ).status_code == 302)
+        for i, (name, data) in enumerate(pdfs)
+    ]
+    walls = {"POST /upload": run_phase("POST /upload", upload_jobs, args.concurrency, recorder)}
+
+    # Uploads can return before ingestion has finished; search and chat are only
+    # timed against documents that are fully indexed.
+    ingest_wait = wait_until_ingested(users, args.ready_timeout, database)
+    users = [u for u in users if u["doc_ids"]]
+    if not users:
+        print("No documents were ingested; check the stand-in services.", file=sys.stderr)
+        return 1
+
+    queries = corpus.make_queries(args.requests, seed=args.seed)
+
+    def pick(i):
+        user = users[i % len(users)]
+        return user, user["doc_ids"][i % len(user["doc_ids"])]
+
+    # --- Dashboard ---
+    jobs = [as_user(users[i % len(users)], lambda c: c.get("/dashboard").status_code == 200)
+            for i in range(args.requests)]
+    walls["GET /dashboard"] = run_phase("GET /dashboard", jobs, args.concurrency, recorder)
+
+    # --- Search ---
+    jobs = []
+    for i in range(args.requests):
+        user, doc_id = pick(i)
+        jobs.append(as_user(user, lambda c, d=doc_id, q=queries[i]: c.post(
+            f"/document/{d}/search", data={"query": q}).status_code == 200))
+    walls["POST /document/<id>/search"] = run_phase("POST /document/<id>/search", jobs, args.concurrency, recorder)
+
+    # --- Chat ---
+    jobs = []
+    for i in range(args.requests):
+        user, doc_id = pick(i)
+        jobs.append(as_user(user, lambda c, d=doc_id, q=queries[i]: c.post(
+            f"/chat/{d}", json={"message": q}).status_code == 200))
+    walls["POST /chat/<id>"] = run_phase("POST /chat/<id>", jobs, args.concurrency, recorder)
+
+    telemetry.remove_listener(recorder.on_stage)
+
+    results = {
+        "environment": stats.environment(),
+        "parameters": {k: v for k, v in vars(args).items() if k not in ("save_baseline", "compare")},
+        "endpoints": {name: stats.summarize(recorder.samples[name], walls.get(name))
+                      for name in recorder.samples if name.startswith(("GET", "POST"))},
+        "stages": {name: stats.summarize(samples)
+                   for name, samples in recorder.samples.items() if not name.startswith(("GET", "POST"))},
+    }
+    results["parameters"]["mongo"] = handles["mongo"]
+    results["ingest_wait_s"] = round(ingest_wait, 3)
+
+    stats.print_table("Endpoints", results["endpoints"])
+    stats.print_table("Stages", results["stages"])
+    stats.save_results(os.path.join(RESULTS_DIR, f"e2e-{int(time.time())}.json"), results)
+
+    if args.save_baseline:
+        stats.save_results(BASELINE_PATH, results)
+        print(f"\nBaseline written to {BASELINE_PATH}")
+
+    if args.compare:
+        if not os.path.exists(BASELINE_PATH):
+            print("No baseline recorded yet; run with --save-baseline first.", file=sys.stderr)
+            return 1
+        regressions = stats.compare(stats.load_results(BASELINE_PATH), results, tolerance=args.tolerance)
+        for section, name, old, new, change in regressions:
+            print(f"REGRESSION {section}/{name}: p95 {old:.2f}ms -> {new:.2f}ms (+{change:.0%})")
+        if regressions:
+            return 1
+        print("\nNo p95 regressions against the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""
+Sends password-reset emails through email_server.MailQueue to a local
+aiosmtpd sink with a configurable per-message delay, and compares it with
+the old behaviour of opening one SMTP connection per email on the caller's
+thread:
+
+    python -m benchmarks.mail --emails 200 --smtp-delay-ms 20
+    python -m benchmarks.mail --drop-every 50      # sink hangs up every 50th message
+
+Reports how long the caller is blocked per email (what /forgot_password
+used to wait for), delivery throughput, and how many SMTP connections were
+opened. Needs `pip install aiosmtpd`.
+"""
+import argparse
+import asyncio
+import os
+import smtplib
+import socket
+import sys
+import time
+from email.message import EmailMessage
+
+from benchmarks import stats
+
+
+class SlowSink:
+    """aiosmtpd handler that takes `delay` seconds per message and can hang up now and then."""
+
+    def __init__(self, delay, drop_every=0):
+        self.delay = delay
+        self.drop_every = drop_every
+        self.received = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        await asyncio.sleep(self.delay)
+        self.received += 1
+        if self.drop_every and self.received % self.drop_every == 0:
+            return "421 Closing connection"
+        return "250 OK"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_message(i) -> EmailMessage:
+    message = EmailMessage()
+    message.set_content(f"Click this link to reset your password: http://localhost/reset-password?token={i}")
+    message['Subject'] = 'Your Password Reset Link'
+    message['From'] = 'no-reply@my-local-app.com'
+    message['To'] = f"user{i}@example.com"
+    return message
+
+
+def run_per_call(host, port, n):
+    """The previous send_reset_email: a fresh connection per email, on the caller's thread."""
+    samples = []
+    started = time.perf_counter()
+    for i in range(n):
+        t = time.perf_counter()
+        server = smtplib.SMTP(host, port)
+        try:
+            server.send_message(make_message(i))
+            server.quit()
+        except smtplib.SMTPException:
+            server.close()
+        samples.append(time.perf_counter() - t)
+    summary = stats.summarize(samples)
+    summary["delivered_per_s"] = round(n / (time.perf_counter() - started), 1)
+    summary["connections"] = n
+    return summary
+
+
+def run_queue(email_server, host, port, n, retry_seconds):
+    mail_queue = email_server.MailQueue(host=host, port=port, retry_seconds=retry_seconds,
+                                        per_recipient_per_hour=n, queue_size=n)
+    samples = []
+    started = time.perf_counter()
+    for i in range(n):
+        t = time.perf_counter()
+        mail_queue.submit(make_message(i))
+        samples.append(time.perf_counter() - t)
+    mail_queue.flush(timeout=600)
+    elapsed = time.perf_counter() - started
+    mail_queue.stop()
+    summary = stats.summarize(samples)
+    summary["delivered_per_s"] = round(mail_queue.sent / elapsed, 1)
+    summary["connections"] = mail_queue.connections
+    summary["sent"] = mail_queue.sent
+    summary["failed"] = mail_queue.failed
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--emails", type=int, default=200)
+    parser.add_argument("--smtp-delay-ms", type=float, default=20, help="sink latency per message")
+    parser.add_argument("--drop-every", type=int, default=0, help="sink answers 421 to every Nth message")
+    parser.add_argument("--retry-seconds", type=float, default=0.05)
+    parser.add_argument("--out", default=None, help="JSON output path (default benchmarks/results/mail-<time>.json)")
+    args = parser.parse_args(argv)
+
+    from aiosmtpd.controller import Controller
+
+    os.environ.setdefault("LOG_LEVEL", "ERROR")
+    import email_server
+
+    sink = SlowSink(args.smtp_delay_ms / 1000, args.drop_every)
+    host, port = "127.0.0.1", free_port()
+    controller = Controller(sink, hostname=host, port=port)
+    controller.start()
+    try:
+        benchmarks = {
+            "per_call/caller_blocked": run_per_call(host, port, args.emails),
+            "queue/caller_blocked": run_queue(email_server, host, port, args.emails, args.retry_seconds),
+        }
+    finally:
+        controller.stop()
+
+    results = {
+        "environment": stats.environment(),
+        "parameters": vars(args),
+        "benchmarks": benchmarks,
+    }
+    stats.print_table(f"Reset emails ({args.emails}, sink {args.smtp_delay_ms} ms/message)", benchmarks)
+    for name, summary in benchmarks.items():
+        print(f"  {name:<24} {summary['delivered_per_s']} delivered/s over {summary['connections']} connections")
+    out = args.out or os.path.join(os.path.dirname(__file__), "results", f"mail-{int(time.time())}.json")
+    stats.save_results(out, results)
+    print(f"\nResults written to {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,249 @@
+"""
+Micro-benchmarks for the CPU hot paths of ingestion and search:
+
+  extract  processing.extract_text on synthetic PDFs of several sizes
+  formats  processing.read_document (extract + chunk, streaming) per file format
+  chunk    processing.chunk_text on extracted-size texts
+  embed    vector_store.embed_chunks and vector_store.insert_chunks, separately
+  queries  query embedding under 1..N concurrent requests: one encode call per
+           query (the old path) against vector_store.encode_query's micro-batches
+  search   vector_store.search_document as the index grows (10k .. 5M chunks),
+           on the engine chosen by VECTOR_INDEX_ENGINE (see benchmarks.ann to compare them)
+
+    python -m benchmarks.micro --out benchmarks/results/micro-before.json
+    python -m benchmarks.micro --suite search --sizes 10000,100000,1000000,5000000
+    python -m benchmarks.compare benchmarks/results/micro-before.json benchmarks/results/micro-after.json
+
+All inputs come from fixed seeds, so two runs on the same machine see
+identical data. The search suite fills the collection with seeded random unit
+vectors (encoding millions of real chunks would take hours) and queries it
+with real encoded questions through the normal search path.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from benchmarks import stats, corpus
+
+CHUNKS_PER_DOC = 300
+
+
+def time_calls(fn, repeat: int) -> list:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def bench_extract(processing, repeat, seed):
+    results = {}
+    for pages in (1, 10, 50, 200):
+        pdf = corpus.make_corpus(1, pages=pages, seed=seed)[0][1]
+        samples = time_calls(lambda: processing.extract_text(pdf, "bench.pdf"), repeat)
+        summary = stats.summarize(samples)
+        summary["pages_per_s"] = round(pages / (sum(samples) / len(samples)), 1)
+        results[f"extract/{pages}_pages"] = summary
+    return results
+
+
+def bench_formats(processing, repeat, seed):
+    """Extraction plus chunking throughput for every supported format, and peak memory of one run."""
+    results = {}
+    words = corpus.vocabulary(seed=seed)
+    for fmt in ("pdf", "docx", "txt", "md", "html"):
+        for n_words in (10_000, 200_000):
+            data = corpus.make_document(fmt, random.Random(seed), n_words, words)
+            filename = f"bench.{fmt}"
+            samples = time_calls(lambda: processing.read_document(data, filename), repeat)
+
+            tracemalloc.start()
+            processing.read_document(data, filename)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            mean = sum(samples) / len(samples)
+            summary = stats.summarize(samples)
+            summary["words_per_s"] = round(n_words / mean)
+            summary["mb_per_s"] = round(len(data) / mean / 2**20, 2)
+            summary["peak_mb"] = round(peak / 2**20, 2)
+            results[f"formats/{fmt}_{n_words}_words"] = summary
+    return results
+
+
+def bench_chunk(processing, repeat, seed):
+    results = {}
+    rng = random.Random(seed)
+    words = corpus.vocabulary(seed=seed)
+    for n_words in (1_000, 20_000, 200_000, 1_000_000):
+        text = corpus.random_text(rng, n_words, words)
+        samples = time_calls(lambda: processing.chunk_text(text), repeat)
+        summary = stats.summarize(samples)
+        summary["words_per_s"] = round(n_words / (sum(samples) / len(samples)))
+        results[f"chunk/{n_words}_words"] = summary
+    return results
+
+
+def bench_embed(vector_store, repeat, seed):
+    results = {}
+    doc_id = 10_000_000
+    for n_chunks in (10, 100, 500):
+        chunks = corpus.make_chunks(n_chunks, seed=seed)
+        vector_store.embed_chunks(chunks[:2])  # warm up the model
+
+        encode_samples, insert_samples = [], []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            embeddings = vector_store.embed_chunks(chunks)
+            encode_samples.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            vector_store.insert_chunks(doc_id, chunks, embeddings)
+            insert_samples.append(time.perf_counter() - started)
+            doc_id += 1
+
+        for name, samples in (("encode", encode_samples), ("insert", insert_samples)):
+            summary = stats.summarize(samples)
+            summary["chunks_per_s"] = round(n_chunks / (sum(samples) / len(samples)), 1)
+            results[f"embed/{name}_{n_chunks}_chunks"] = summary
+    return results
+
+
+def bench_queries(vector_store, repeat, seed, concurrency):
+    results = {}
+    model = vector_store.get_model()
+    queries = corpus.make_queries(repeat * max(concurrency), seed=seed)
+    paths = {
+        "per_call": lambda q: model.encode([q], convert_to_numpy=True)[0],
+        "batched": vector_store.encode_query,
+    }
+    for path in paths.values():
+        path(queries[0])  # warm up the model and start the batcher thread
+
+    for threads in concurrency:
+        for name, encode in paths.items():
+            batcher = vector_store.get_batcher()
+            batches_before, queries_before = batcher.batches, batcher.queries
+
+            def timed_encode(query):
+                started = time.perf_counter()
+                encode(query)
+                return time.perf_counter() - started
+
+            n = repeat * threads
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                samples = list(pool.map(timed_encode, queries[:n]))
+            summary = stats.summarize(samples, time.perf_counter() - started)
+            if name == "batched" and batcher.batches > batches_before:
+                summary["mean_batch"] = round((batcher.queries - queries_before) / (batcher.batches - batches_before), 1)
+            results[f"queries/{name}_{threads}_concurrent"] = summary
+    return results
+
+
+def _fill_collection(vector_store, first_doc, stop_doc, dim, rng):
+    """Adds documents [first_doc, stop_doc) of CHUNKS_PER_DOC seeded random unit vectors each."""
+    for doc_id in range(first_doc, stop_doc):
+        vectors = rng.standard_normal((CHUNKS_PER_DOC, dim), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        chunks = [f"synthetic chunk {doc_id}_{i}" for i in range(CHUNKS_PER_DOC)]
+        vector_store.insert_chunks(doc_id, chunks, vectors)
+
+
+def bench_search(vector_store, telemetry, repeat, seed, sizes):
+    results = {}
+    dim = vector_store.EMBEDDING_MODEL.get_sentence_embedding_dimension()
+    rng = np.random.default_rng(seed)
+    pick = random.Random(seed)
+    queries = corpus.make_queries(max(repeat, 1), seed=seed)
+
+    stage_samples = {}
+    def on_stage(stage, outcome, seconds):
+        stage_samples.setdefault(stage, []).append(seconds)
+    telemetry.add_listener(on_stage)
+
+    filled_docs = 0
+    for size in sorted(sizes):
+        # Sizes are rounded up to whole documents
+        n_docs = max(1, -(-size // CHUNKS_PER_DOC))
+        started = time.perf_counter()
+        _fill_collection(vector_store, filled_docs, n_docs, dim, rng)
+        fill_seconds = time.perf_counter() - started
+        filled_docs = max(filled_docs, n_docs)
+
+        vector_store.search_document(0, queries[0], top_k=3)  # warm up
+        stage_samples.clear()
+        samples = time_calls(
+            lambda: vector_store.search_document(pick.randrange(n_docs), pick.choice(queries), top_k=3),
+            repeat,
+        )
+        summary = stats.summarize(samples)
+        summary["fill_seconds"] = round(fill_seconds, 2)
+        results[f"search/{size}_chunks"] = summary
+        for stage in ("embedding.encode_query", "fastpath.query", f"{vector_store.INDEX.name}.query"):
+            results[f"search/{size}_chunks/{stage}"] = stats.summarize(stage_samples.get(stage, []))
+
+    telemetry.remove_listener(on_stage)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--suite", default="all", choices=["all", "extract", "formats", "chunk", "embed", "queries", "search"])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated request counts for the queries suite")
+    parser.add_argument("--sizes", default="10000,100000", help="comma-separated collection sizes for the search suite")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default=None, help="JSON output path (default benchmarks/results/micro-<time>.json)")
+    args = parser.parse_args(argv)
+
+    # A scratch index keeps the benchmark away from the real ./chroma_db and ./vector_shards.
+    scratch = tempfile.mkdtemp(prefix="intellidocs_micro_")
+    os.environ["CHROMA_PATH"] = os.path.join(scratch, "chroma_db")
+    os.environ["VECTOR_SHARD_PATH"] = os.path.join(scratch, "vector_shards")
+    os.environ["VECTOR_FAST_PATH_DIR"] = os.path.join(scratch, "vector_fastpath")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    import telemetry
+    import processing
+    import vector_store
+
+    suites = ["extract", "formats", "chunk", "embed", "queries", "search"] if args.suite == "all" else [args.suite]
+    benchmarks = {}
+    for suite in suites:
+        if suite == "extract":
+            benchmarks.update(bench_extract(processing, args.repeat, args.seed))
+        elif suite == "formats":
+            benchmarks.update(bench_formats(processing, max(1, args.repeat // 4), args.seed))
+        elif suite == "chunk":
+            benchmarks.update(bench_chunk(processing, args.repeat, args.seed))
+        elif suite == "embed":
+            benchmarks.update(bench_embed(vector_store, max(1, args.repeat // 4), args.seed))
+        elif suite == "queries":
+            concurrency = [int(c) for c in args.concurrency.split(",") if c]
+            benchmarks.update(bench_queries(vector_store, args.repeat, args.seed, concurrency))
+        elif suite == "search":
+            sizes = [int(s) for s in args.sizes.split(",") if s]
+            benchmarks.update(bench_search(vector_store, telemetry, args.repeat, args.seed, sizes))
+
+    results = {
+        "environment": stats.environment(),
+        "parameters": vars(args),
+        "benchmarks": benchmarks,
+    }
+    stats.print_table("Micro-benchmarks", benchmarks)
+    out = args.out or os.path.join(os.path.dirname(__file__), "results", f"micro-{int(time.time())}.json")
+    stats.save_results(out, results)
+    print(f"\nResults written to {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+import json
+import math
+import os
+import platform
+from datetime import datetime
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    """Nearest-rank percentile of an already sorted list (q in 0-100)."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(q * len(sorted_values) / 100))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(samples: list, wall_seconds: float = None) -> dict:
+    """
+    Turns raw durations (seconds) into the figures we track: count, mean and
+    p50/p95/p99 in milliseconds, plus throughput when the wall time is known.
+    """
+    values = sorted(samples)
+    summary = {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        "p50_ms": round(percentile(values, 50) * 1000, 3),
+        "p95_ms": round(percentile(values, 95) * 1000, 3),
+        "p99_ms": round(percentile(values, 99) * 1000, 3),
+    }
+    if wall_seconds:
+        summary["throughput_per_s"] = round(len(values) / wall_seconds, 3)
+    return summary
+
+
+def environment() -> dict:
+    """Machine details stored next to every result so runs can be compared fairly."""
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "recorded_at": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def save_results(path: str, results: dict):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load_results(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline: dict, current: dict, metric: str = "p95_ms", tolerance: float = 0.2) -> list:
+    """
+    Compares two result trees section by section (e.g. "endpoints", "stages").
+    Returns a list of (section, name, baseline_value, current_value, change)
+    for every entry whose `metric` got worse by more than `tolerance`.
+    """
+    regressions = []
+    for section, entries in current.items():
+        if not isinstance(entries, dict) or section not in baseline:
+            continue
+        for name, figures in entries.items():
+            old = baseline[section].get(name, {})
+            if not isinstance(figures, dict) or metric not in figures or not old.get(metric):
+                continue
+            change = (figures[metric] - old[metric]) / old[metric]
+            if change > tolerance:
+                regressions.append((section, name, old[metric], figures[metric], change))
+    return regressions
+
+
+def print_table(title: str, entries: dict):
+    print(f"\n{title}")
+    print(f"  {'name':<36}{'count':>8}{'p50 ms':>11}{'p95 ms':>11}{'p99 ms':>11}{'per s':>10}")
+    for name, s in sorted(entries.items()):
+        print(f"  {name:<36}{s['count']:>8}{s['p50_ms']:>11.2f}{s['p95_ms']:>11.2f}"
+              f"{s['p99_ms']:>11.2f}{s.get('throughput_per_s', 0):>10.2f}")
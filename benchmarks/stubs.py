@@ -0,0 +1,154 @@
+"""
+Local, deterministic stand-ins for the services the app talks to, so the
+benchmarks measure our own code rather than network weather:
+
+  * Ollama      -> FakeOllamaServer, an HTTP server speaking /api/chat
+  * Cloudinary  -> the local storage backend, rooted in a scratch directory
+  * MongoDB     -> mongomock (pip install mongomock) or BENCH_MONGO_URI
+  * MySQL       -> a disposable local server given by BENCH_DB_* variables
+
+Everything here must be installed *before* `app` is imported, because the app
+modules connect to their services at import time.
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# --- Ollama ---
+
+class _OllamaHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        prompt = " ".join(m.get("content", "") for m in request.get("messages", []))
+        server = self.server
+
+        # Answer in the shape each caller expects to parse.
+        if "'router' AI" in prompt:
+            content = "search"
+        elif "comma-separated string" in prompt:
+            content = "benchmark,synthetic,corpus,testing,performance"
+        else:
+            content = " ".join(["lorem"] * server.reply_tokens)
+
+        tokens = len(content.split())
+        time.sleep(server.first_token_latency + tokens * server.token_latency)
+
+        body = json.dumps({
+            "model": request.get("model", "fake"),
+            "created_at": "2024-01-01T00:00:00Z",
+            "message": {"role": "assistant", "content": content},
+            "done": True,
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeOllamaServer:
+    """
+    Serves /api/chat on localhost. Each reply sleeps
+    first_token_latency + tokens * token_latency to mimic generation speed.
+    """
+
+    def __init__(self, token_latency=0.005, first_token_latency=0.05, reply_tokens=120, port=0):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), _OllamaHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.token_latency = token_latency
+        self.httpd.first_token_latency = first_token_latency
+        self.httpd.reply_tokens = reply_tokens
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        # The ollama client reads OLLAMA_HOST when it is first imported.
+        os.environ["OLLAMA_HOST"] = self.url
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# --- MongoDB ---
+
+def install_mongo():
+    """
+    Uses BENCH_MONGO_URI (a local mongod) when given, otherwise swaps
+    pymongo.MongoClient for mongomock's in-memory client.
+    """
+    uri = os.getenv("BENCH_MONGO_URI")
+    os.environ["MONGO_DB_NAME"] = "intellidocs_bench"
+    if uri:
+        os.environ["MONGO_URI"] = uri
+        return "mongod"
+
+    import mongomock
+    import pymongo
+    pymongo.MongoClient = mongomock.MongoClient
+    os.environ["MONGO_URI"] = "mongodb://mongomock.local"
+    return "mongomock"
+
+
+# --- MySQL ---
+
+def install_mysql():
+    """
+    Points the app at BENCH_DB_HOST/USER/PASSWORD and a throw-away
+    'intellidocs_bench' database, dropped first so every run starts empty.
+    The schema relies on MySQL features (ENUM, INSERT IGNORE, InnoDB foreign
+    keys), so a real server — e.g. `docker run -p 3306:3306 mysql:8` — is used.
+    """
+    import mysql.connector
+
+    os.environ["DB_HOST"] = os.getenv("BENCH_DB_HOST", "127.0.0.1")
+    os.environ["DB_USER"] = os.getenv("BENCH_DB_USER", "root")
+    os.environ["DB_PASSWORD"] = os.getenv("BENCH_DB_PASSWORD", "")
+    os.environ["DB_NAME"] = "intellidocs_bench"
+
+    conn = mysql.connector.connect(
+        host=os.environ["DB_HOST"], user=os.environ["DB_USER"], password=os.environ["DB_PASSWORD"]
+    )
+    cursor = conn.cursor()
+    cursor.execute("DROP DATABASE IF EXISTS intellidocs_bench")
+    cursor.execute("CREATE DATABASE intellidocs_bench DEFAULT CHARACTER SET 'utf8mb4'")
+    cursor.close()
+    conn.close()
+
+
+def install_all(ollama_options: dict = None) -> dict:
+    """Starts/installs every stand-in and returns handles for teardown."""
+    scratch = tempfile.mkdtemp(prefix="intellidocs_bench_")
+    os.environ["CHROMA_PATH"] = os.path.join(scratch, "chroma_db")
+    os.environ["VECTOR_SHARD_PATH"] = os.path.join(scratch, "vector_shards")
+    os.environ["VECTOR_FAST_PATH_DIR"] = os.path.join(scratch, "vector_fastpath")
+    os.environ.setdefault("FLASK_SECRET_KEY", "benchmark-secret")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    ollama = FakeOllamaServer(**(ollama_options or {})).start()
+    # The app's own local storage backend stands in for Cloudinary
+    os.environ["STORAGE_BACKEND"] = "local"
+    os.environ["LOCAL_STORAGE_DIR"] = os.path.join(scratch, "objects")
+    mongo_kind = install_mongo()
+    install_mysql()
+    return {"scratch": scratch, "ollama": ollama, "mongo": mongo_kind}
+
+
+def teardown(handles: dict):
+    handles["ollama"].stop()
+    shutil.rmtree(handles["scratch"], ignore_errors=True)
@@ -0,0 +1,175 @@
+"""
+N worker processes on one host, set up the way gunicorn.conf.py does it: the
+embedding model is loaded once before forking, and every vector write goes
+through one vector writer process over a Unix socket.
+
+    python -m benchmarks.workers --workers 1,2,4,8
+    python -m benchmarks.workers --workers 4 --no-preload     # each worker loads its own model
+    VECTOR_INDEX_ENGINE=sharded python -m benchmarks.workers
+
+For each N, every worker inserts its share of --docs documents (seeded random
+embeddings, through vector_store.insert_chunks), waits for the others, then
+runs --searches queries through vector_store.search_document. Reports insert
+and search latency and throughput across all workers. Memory is reported as
+PSS (shared pages split between the processes that map them) and private
+memory per worker, read from /proc/<pid>/smaps_rollup (Linux only).
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks import stats, corpus
+
+VERSION_CHUNKER = "bench"
+
+
+def memory_mb(pid="self") -> dict:
+    """Rss, Pss and private (clean + dirty) memory of a process in MB."""
+    values = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[1].isdigit():
+                    values[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    except OSError:
+        return {}
+    return {
+        "rss_mb": round(values.get("Rss", 0), 1),
+        "pss_mb": round(values.get("Pss", 0), 1),
+        "private_mb": round(values.get("Private_Clean", 0) + values.get("Private_Dirty", 0), 1),
+    }
+
+
+def run_worker(rank, doc_ids, all_doc_ids, chunks, searches, seed, barrier, results):
+    import vector_store
+
+    version = f"{VERSION_CHUNKER}|{vector_store.EMBEDDING_MODEL_NAME}"
+    dim = vector_store.get_model().get_sentence_embedding_dimension()
+    rng = np.random.default_rng(seed + rank)
+    texts = corpus.make_chunks(chunks, seed=seed + rank)
+    questions = corpus.make_queries(searches, seed=seed + rank)
+
+    inserts = []
+    for doc_id in doc_ids:
+        embeddings = rng.standard_normal((chunks, dim), dtype=np.float32)
+        started = time.perf_counter()
+        vector_store.insert_chunks(doc_id, texts, embeddings, version)
+        inserts.append(time.perf_counter() - started)
+
+    barrier.wait()
+    queries = []
+    pick = random.Random(seed + rank)
+    for question in questions:
+        started = time.perf_counter()
+        vector_store.search_document(pick.choice(all_doc_ids), question, 5, version)
+        queries.append(time.perf_counter() - started)
+
+    results.put({"rank": rank, "insert": inserts, "search": queries, "memory": memory_mb()})
+
+
+def run_round(n, args, first_doc, context):
+    doc_ids = list(range(first_doc, first_doc + args.docs))
+    barrier = context.Barrier(n)
+    results = context.Queue()
+    workers = [
+        context.Process(target=run_worker, args=(rank, doc_ids[rank::n], doc_ids, args.chunks_per_doc,
+                                                 args.searches, args.seed, barrier, results))
+        for rank in range(n)
+    ]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    reports = [results.get() for _ in workers]
+    wall = time.perf_counter() - started
+    for worker in workers:
+        worker.join()
+
+    inserts = [s for r in reports for s in r["insert"]]
+    searches = [s for r in reports for s in r["search"]]
+    # Searches start together after the barrier, so their wall time is the slowest worker's total
+    search_wall = max(sum(r["search"]) for r in reports)
+    memory = [r["memory"] for r in reports if r["memory"]]
+    return {
+        "insert": stats.summarize(inserts, max(sum(r["insert"]) for r in reports)),
+        "search": stats.summarize(searches, search_wall),
+        "wall_seconds": round(wall, 2),
+        "workers_pss_mb": round(sum(m["pss_mb"] for m in memory), 1),
+        "worker_private_mb": round(max((m["private_mb"] for m in memory), default=0), 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated worker counts")
+    parser.add_argument("--docs", type=int, default=40, help="documents inserted per round")
+    parser.add_argument("--chunks-per-doc", type=int, default=300)
+    parser.add_argument("--searches", type=int, default=200, help="queries per worker")
+    parser.add_argument("--no-preload", action="store_true", help="spawn workers that load the model themselves")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default=None, help="JSON output path (default benchmarks/results/workers-<time>.json)")
+    args = parser.parse_args(argv)
+
+    scratch = tempfile.mkdtemp(prefix="intellidocs-workers-")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ["VECTOR_WRITER_SOCKET"] = os.path.join(scratch, "vector_writer.sock")
+    os.environ["VECTOR_WRITER_AUTHKEY"] = "benchmark"
+    os.environ["CHROMA_PATH"] = os.path.join(scratch, "chroma")
+    os.environ["VECTOR_SHARD_PATH"] = os.path.join(scratch, "shards")
+    os.environ["VECTOR_FAST_PATH_DIR"] = os.path.join(scratch, "fastpath")
+
+    # As in gunicorn.conf.py: the model is loaded before anything is forked
+    import vector_store
+    import vector_writer
+
+    writer = multiprocessing.get_context("fork").Process(target=vector_writer.main, name="vector-writer")
+    writer.start()
+    while not os.path.exists(vector_store.VECTOR_WRITER_SOCKET):
+        if not writer.is_alive():
+            raise RuntimeError("The vector writer exited during startup.")
+        time.sleep(0.1)
+
+    context = multiprocessing.get_context("spawn" if args.no_preload else "fork")
+    benchmarks = {}
+    writer_memory = {}
+    try:
+        first_doc = 1
+        for n in [int(n) for n in args.workers.split(",")]:
+            summary = run_round(n, args, first_doc, context)
+            first_doc += args.docs
+            benchmarks[f"{n}w/insert"] = summary.pop("insert")
+            benchmarks[f"{n}w/search"] = dict(summary.pop("search"), **summary)
+        writer_memory = memory_mb(writer.pid)
+    finally:
+        writer.terminate()
+        writer.join(10)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    results = {
+        "environment": stats.environment(),
+        "parameters": vars(args),
+        "engine": vector_store.INDEX.name,
+        "writer_memory": writer_memory,
+        "benchmarks": benchmarks,
+    }
+    mode = "spawned, one model each" if args.no_preload else "forked after preloading the model"
+    stats.print_table(f"Workers ({vector_store.INDEX.name}, {mode})", benchmarks)
+    for name, summary in benchmarks.items():
+        if "workers_pss_mb" in summary:
+            print(f"  {name.split('/')[0]:<4} workers PSS {summary['workers_pss_mb']} MB, "
+                  f"largest private {summary['worker_private_mb']} MB per worker")
+    out = args.out or os.path.join(os.path.dirname(__file__), "results", f"workers-{int(time.time())}.json")
+    stats.save_results(out, results)
+    print(f"\nResults written to {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+"""
+Cache for what the dashboard and document pages read from MySQL: a user's
+document listing and tag counts, the ids of the documents they own (checked
+by every protected route before anything else), single document rows and
+their precomputed insights.
+
+Entries live in an in-process LRU, or in Redis when VIEW_CACHE_URL is set, so
+that every worker process shares them and sees the others' invalidations.
+Entries are never updated in place. Each user and each document has a stamp
+(the time in ns its current generation began) that is part of every key.
+Writers call invalidate_user() / invalidate_document() after their change is
+committed, which drops the stamp; the next reader starts a new generation, and
+entries under the old stamp are never read again and age out. The stamp is
+also what pages use for their ETag and Last-Modified headers.
+"""
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+import database
+import telemetry
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = telemetry.get_logger(__name__)
+
+# --- Cache settings ---
+VIEW_CACHE_ENABLED = os.getenv("VIEW_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+VIEW_CACHE_ENTRIES = int(os.getenv("VIEW_CACHE_ENTRIES", 4096))
+# Bounds how long a missed invalidation can go unnoticed
+VIEW_CACHE_TTL = int(os.getenv("VIEW_CACHE_TTL", 300))
+# e.g. redis://localhost:6379/0; needed for correct invalidation with several worker processes
+VIEW_CACHE_URL = os.getenv("VIEW_CACHE_URL", "")
+
+
+class LocalBackend:
+    """LRU of (value, expiry) kept in this process."""
+
+    def __init__(self, max_entries=VIEW_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _live(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key)
+            return entry[0] if entry else None
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def add(self, key, value, ttl):
+        """Stores value unless key is already set; returns whichever value is stored."""
+        with self._lock:
+            entry = self._live(key)
+            if entry:
+                return entry[0]
+        self.set(key, value, ttl)
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class RedisBackend:
+    """Shared by every process pointed at the same Redis; values are pickled."""
+
+    def __init__(self, url):
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        raw = self._client.get(key)
+        return pickle.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl):
+        self._client.set(key, pickle.dumps(value), ex=ttl)
+
+    def add(self, key, value, ttl):
+        if self._client.set(key, pickle.dumps(value), ex=ttl, nx=True):
+            return value
+        stored = self.get(key)
+        return value if stored is None else stored
+
+    def delete(self, key):
+        self._client.delete(key)
+
+
+def _create_backend():
+    if not VIEW_CACHE_ENABLED:
+        return None
+    if VIEW_CACHE_URL:
+        if redis is None:
+            logger.warning("VIEW_CACHE_URL is set but the redis package is not installed; using the in-process cache.")
+        else:
+            return RedisBackend(VIEW_CACHE_URL)
+    return LocalBackend()
+
+
+backend = _create_backend()
+
+
+def _call(operation, *args):
+    """Runs a backend operation; a failing backend behaves like an empty cache."""
+    if backend is None:
+        return None
+    try:
+        return getattr(backend, operation)(*args)
+    except Exception as e:
+        logger.warning("View cache %s failed: %s", operation, e)
+        return None
+
+
+def is_shared() -> bool:
+    """True when entries live in Redis, so every worker process sees the same ones."""
+    return isinstance(backend, RedisBackend)
+
+
+def set_shared(key, value, ttl):
+    """Stores state other worker processes must see (e.g. batch progress); a no-op without Redis."""
+    if is_shared():
+        _call("set", f"shared:{key}", value, ttl)
+
+
+def get_shared(key):
+    """Reads state stored with set_shared(); None if it is missing or there is no Redis."""
+    return _call("get", f"shared:{key}") if is_shared() else None
+
+
+def _stamp(scope) -> int:
+    now = time.time_ns()
+    return _call("add", f"{scope}:stamp", now, VIEW_CACHE_TTL) or now
+
+
+def _get_or_load(scope, stamp, name, load):
+    key = f"{scope}:{stamp}:{name}"
+    value = _call("get", key)
+    if value is not None:
+        return value
+    with telemetry.timed("cache.load"):
+        value = load()
+    if value is not None:
+        _call("set", key, value, VIEW_CACHE_TTL)
+    return value
+
+
+def user_stamp(user_id) -> int:
+    """Stamp of the user's current listing generation, in ns since the epoch."""
+    return _stamp(f"user:{user_id}")
+
+
+def document_stamp(doc_id) -> int:
+    """Stamp of the document row's current generation, in ns since the epoch."""
+    return _stamp(f"doc:{doc_id}")
+
+
+def get_listing(user_id, tag=None, stamp=None) -> tuple:
+    """(documents, tag_counts) for the dashboard, optionally filtered by tag."""
+    stamp = stamp or user_stamp(user_id)
+    return _get_or_load(f"user:{user_id}", stamp, f"listing:{tag or ''}", lambda: (
+        database.get_documents_by_user(user_id, tag=tag),
+        database.get_tag_counts_for_user(user_id),
+    ))
+
+
+def get_document(doc_id, stamp=None):
+    """The documents row, as database.get_document_by_id returns it."""
+    stamp = stamp or document_stamp(doc_id)
+    return _get_or_load(f"doc:{doc_id}", stamp, "row", lambda: database.get_document_by_id(doc_id))
+
+
+def get_insights(doc_id, stamp=None) -> dict:
+    """The document's precomputed questions and section summaries; empty if there are none (yet)."""
+    stamp = stamp or document_stamp(doc_id)
+    return _get_or_load(f"doc:{doc_id}", stamp, "insights", lambda: database.get_document_insights(doc_id)) or {}
+
+
+def get_owned_documents(user_id, stamp=None) -> dict:
+    """{doc_id: index_version} for every document the user owns; empty if it can't be loaded."""
+    stamp = stamp or user_stamp(user_id)
+    return _get_or_load(f"user:{user_id}", stamp, "owned", lambda: database.get_owned_documents(user_id)) or {}
+
+
+def owned_version(user_id, doc_id) -> tuple:
+    """
+    (True, index_version) if the user owns the document, else (False, None).
+    Hits are answered from the cached ownership set. A miss is checked
+    against the documents row before access is denied, because the set can
+    predate an upload (another worker's, with the in-process cache); a
+    confirmed owner gets their cached entries refreshed.
+    """
+    doc_id = int(doc_id)
+    owned = get_owned_documents(user_id)
+    if doc_id in owned:
+        return True, owned[doc_id]
+    row = database.get_document_by_id(doc_id)
+    if row is None or row["user_id"] != user_id:
+        return False, None
+    invalidate_user(user_id)
+    return True, row["index_version"]
+
+
+def owns_document(user_id, doc_id) -> bool:
+    """Ownership check, usually without fetching the document row (see owned_version)."""
+    return owned_version(user_id, doc_id)[0]
+
+
+def invalidate_user(user_id):
+    """Call after a user's documents were added, removed or changed (listing and ownership)."""
+    _call("delete", f"user:{user_id}:stamp")
+
+
+def invalidate_document(doc_id, user_id=None):
+    """Call after a document row changed; pass its owner to refresh their listing as well."""
+    _call("delete", f"doc:{doc_id}:stamp")
+    if user_id is not None:
+        invalidate_user(user_id)
@@ -1,6 +1,19 @@
 import os,dotenv
+import json
+import time
+import threading
+import contextvars
 import mysql.connector
 from mysql.connector import Error,pooling
+import telemetry
+
+logger = telemetry.get_logger(__name__)
+
+# --- Pool configuration (overridable from the environment) ---
+# mysql-connector caps a single pool at 32 connections.
+DB_POOL_SIZE = min(int(os.getenv('DB_POOL_SIZE', 5)), pooling.CNX_POOL_MAXSIZE)
+# Seconds a caller will block waiting for a free connection before giving up.
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
 
 
 # function to be called from app.py after load_dotenv()
@@ -9,39 +22,173 @@ def create_db_pool():
     try:
         pool = pooling.MySQLConnectionPool(
             pool_name="intellidocs_pool",
-            pool_size=5,
+            pool_size=DB_POOL_SIZE,
             host=os.getenv('DB_HOST', 'localhost'),
             user=os.getenv('DB_USER', 'root'),
             password=os.getenv('DB_PASSWORD'),
             database=os.getenv('DB_NAME', 'notes_db') # Connect directly to the DB
         )
-        print("Database connection pool created successfully.")
+        logger.info("Database connection pool created successfully (size=%s).", DB_POOL_SIZE)
         return pool
     except Error as e:
-        print(f"Error creating connection pool: {e}")
+        logger.error("Error creating connection pool: %s", e)
         return None
     
 cnx_pool = create_db_pool()
 
-def get_db_connection():
-    """Gets a connection from the pool."""
-    if cnx_pool is None:
-        print("Connection pool is not available.")
+# MySQLConnectionPool raises immediately when it is exhausted, so callers
+# queue on this semaphore instead and only touch the pool once a slot is free.
+_pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+_pool_stats_lock = threading.Lock()
+_pool_stats = {
+    "in_use": 0,
+    "checkouts": 0,
+    "exhaustion_count": 0,
+    "timeouts": 0,
+    "wait_time_total": 0.0,
+    "wait_time_max": 0.0,
+}
+
+# Holds the connection shared by every database call made while serving a
+# single Flask request (see begin_request_scope / end_request_scope). Each
+# helper still commits or rolls back its own statements; the scope only saves
+# the checkouts, and is not a request-wide transaction.
+_request_scope = contextvars.ContextVar("db_request_scope", default=None)
+
+
+def _checkout_connection():
+    """Blocks (up to DB_POOL_TIMEOUT) for a free slot, then takes a pool connection."""
+    started = time.perf_counter()
+    acquired = _pool_slots.acquire(blocking=False)
+    if not acquired:
+        with _pool_stats_lock:
+            _pool_stats["exhaustion_count"] += 1
+        acquired = _pool_slots.acquire(timeout=DB_POOL_TIMEOUT)
+    waited = time.perf_counter() - started
+
+    with _pool_stats_lock:
+        _pool_stats["wait_time_total"] += waited
+        _pool_stats["wait_time_max"] = max(_pool_stats["wait_time_max"], waited)
+        if not acquired:
+            _pool_stats["timeouts"] += 1
+
+    if not acquired:
+        logger.warning("Timed out after %ss waiting for a database connection.", DB_POOL_TIMEOUT)
         return None
+
     try:
-        # Get a connection from the pool
         conn = cnx_pool.get_connection()
-        return conn
     except Error as e:
-        print(f"Error getting connection from pool: {e}")
+        _pool_slots.release()
+        logger.error("Error getting connection from pool: %s", e)
+        return None
+
+    with _pool_stats_lock:
+        _pool_stats["in_use"] += 1
+        _pool_stats["checkouts"] += 1
+    return conn
+
+
+def _return_connection(conn):
+    """Hands a connection back to the pool and frees its slot."""
+    try:
+        conn.close() # This returns the connection to the pool
+    except Error as e:
+        logger.error("Error returning connection to pool: %s", e)
+    finally:
+        with _pool_stats_lock:
+            _pool_stats["in_use"] -= 1
+        _pool_slots.release()
+
+
+def get_db_connection():
+    """Gets a connection from the pool, reusing the request's connection if there is one."""
+    if cnx_pool is None:
+        logger.warning("Connection pool is not available.")
         return None
 
+    scope = _request_scope.get()
+    if scope is not None and scope.get("conn") is not None:
+        return scope["conn"]
+
+    conn = _checkout_connection()
+    if scope is not None and conn is not None:
+        scope["conn"] = conn
+    return conn
+
+
+def release_db_connection(conn, cursor=None):
+    """
+    Closes the cursor and gives the connection back to the pool.
+    A request-scoped connection stays checked out until end_request_scope().
+    """
+    if cursor is not None:
+        try:
+            cursor.close()
+        except Error:
+            pass
+    if conn is None:
+        return
+
+    scope = _request_scope.get()
+    if scope is not None and scope.get("conn") is conn:
+        return
+    _return_connection(conn)
+
+
+def begin_request_scope():
+    """Starts a request scope; the first database call in it checks out the shared connection."""
+    _request_scope.set({"conn": None})
+
+
+def release_request_connection():
+    """
+    Hands the request's connection back to the pool before slow work (LLM
+    calls, ingestion, password hashing), so the request does not keep it
+    busy meanwhile. A later database call in the request checks one out again.
+    """
+    scope = _request_scope.get()
+    if not scope or scope.get("conn") is None:
+        return
+    conn = scope["conn"]
+    scope["conn"] = None
+    _close_scoped_connection(conn)
+
+
+def end_request_scope(error=None):
+    """Returns the request's connection to the pool."""
+    scope = _request_scope.get()
+    _request_scope.set(None)
+    if not scope or scope.get("conn") is None:
+        return
+    _close_scoped_connection(scope["conn"])
+
+
+def _close_scoped_connection(conn):
+    # Helpers commit their own writes, so this only ends a read's open snapshot
+    try:
+        if conn.is_connected():
+            conn.rollback()
+    except Error as e:
+        logger.error("Error closing request transaction: %s", e)
+    finally:
+        _return_connection(conn)
+
+
+def get_pool_stats():
+    """Returns a snapshot of the connection pool metrics."""
+    with _pool_stats_lock:
+        stats = dict(_pool_stats)
+    stats["pool_size"] = DB_POOL_SIZE
+    stats["wait_timeout"] = DB_POOL_TIMEOUT
+    return stats
+
 def init_db():
     conn = None
     cursor = None
     try:
         # Step 1: Connecting to the server WITHOUT a specific database to create it
-        print("Connecting to MySQL server to ensure database exists...")
+        logger.info("Connecting to MySQL server to ensure database exists...")
         conn = mysql.connector.connect(
             host=os.getenv('DB_HOST', 'localhost'),
             user=os.getenv('DB_USER', 'root'),
@@ -50,10 +197,10 @@ def init_db():
         cursor = conn.cursor()
         db_name = os.getenv('DB_NAME', 'notes_db')
         cursor.execute(f"CREATE DATABASE IF NOT EXISTS {db_name} DEFAULT CHARACTER SET 'utf8mb4'")
-        print(f"Database '{db_name}' is ready.")
+        logger.info("Database '%s' is ready.", db_name)
 
     except Error as e:
-        print(f"Error during initial database creation: {e}")
+        logger.error("Error during initial database creation: %s", e)
     finally:
         if conn and conn.is_connected():
             cursor.close()
@@ -62,12 +209,13 @@ def init_db():
     # Step 2: Using a connection from the pool to create the tables
     conn = get_db_connection()
     if conn is None:
-        print("Could not get DB connection from pool to create tables.")
+        logger.warning("Could not get DB connection from pool to create tables.")
         return
+    cursor = None
     
     try:
         cursor=conn.cursor()
-        print("Ensuring tables are created...")
+        logger.info("Ensuring tables are created...")
         users_table_sql = """
         CREATE TABLE IF NOT EXISTS users (
             id INT AUTO_INCREMENT PRIMARY KEY,
@@ -77,7 +225,7 @@ def init_db():
         ) ENGINE=InnoDB;
         """
         cursor.execute(users_table_sql)
-        print("'users' table is ready.")
+        logger.info("'users' table is ready.")
 
         documents_table_sql=""" 
         CREATE TABLE IF NOT EXISTS documents (
@@ -90,12 +238,53 @@ def init_db():
           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
           tags VARCHAR(512) DEFAULT NULL,
           summary TEXT DEFAULT NULL,
+          storage_status ENUM('PENDING', 'COMPLETED', 'FAILED') NOT NULL DEFAULT 'PENDING',
+          ai_status ENUM('PENDING', 'COMPLETED', 'FAILED') NOT NULL DEFAULT 'PENDING',
+          index_version VARCHAR(191) DEFAULT NULL,
+          INDEX idx_public_id (public_id),
           FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
         ) ENGINE=InnoDB;
         """
     
         cursor.execute(documents_table_sql)
-        print("'documents' table is ready.")
+
+        # Storage and AI/indexing run as separate branches, each with its own
+        # status. Tables created before that get the columns added here;
+        # documents that already finished are marked complete on both.
+        for column in ('storage_status', 'ai_status'):
+            cursor.execute(
+                "SELECT COUNT(*) FROM information_schema.COLUMNS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'documents' AND COLUMN_NAME = %s",
+                (column,)
+            )
+            if cursor.fetchone()[0] == 0:
+                cursor.execute(
+                    f"ALTER TABLE documents ADD COLUMN {column} "
+                    "ENUM('PENDING', 'COMPLETED', 'FAILED') NOT NULL DEFAULT 'PENDING'"
+                )
+                cursor.execute(
+                    f"UPDATE documents SET {column} = 'COMPLETED' WHERE processing_status = 'COMPLETED'"
+                )
+                conn.commit()
+
+        # The index version a document's chunks are searched under (see
+        # processing.INDEX_VERSION); NULL for chunks indexed before versions.
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'documents' AND COLUMN_NAME = 'index_version'"
+        )
+        if cursor.fetchone()[0] == 0:
+            cursor.execute("ALTER TABLE documents ADD COLUMN index_version VARCHAR(191) DEFAULT NULL")
+
+        # Stored files are looked up by public_id when they are served and
+        # when a shared content-addressed file is deleted.
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.STATISTICS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'documents' AND INDEX_NAME = 'idx_public_id'"
+        )
+        if cursor.fetchone()[0] == 0:
+            cursor.execute("ALTER TABLE documents ADD INDEX idx_public_id (public_id)")
+        logger.info("'documents' table is ready.")
 
         password_resets_table_sql=""" 
         CREATE TABLE IF NOT EXISTS password_resets (
@@ -107,23 +296,68 @@ def init_db():
         );"""
     
         cursor.execute(password_resets_table_sql)
-        print("'passwords_resets' table is ready.")
+        logger.info("'passwords_resets' table is ready.")
+
+        # Tags are normalized into their own table so that filtering and
+        # facet counts use indexes instead of LIKE scans over documents.tags.
+        tags_table_sql="""
+        CREATE TABLE IF NOT EXISTS tags (
+         id INT AUTO_INCREMENT PRIMARY KEY,
+         name VARCHAR(64) NOT NULL UNIQUE
+        ) ENGINE=InnoDB;
+        """
+        cursor.execute(tags_table_sql)
+        logger.info("'tags' table is ready.")
+
+        # user_id is copied onto the link rows so per-user filters and facet
+        # counts are answered from idx_user_tag alone.
+        document_tags_table_sql="""
+        CREATE TABLE IF NOT EXISTS document_tags (
+         document_id INT NOT NULL,
+         tag_id INT NOT NULL,
+         user_id INT NOT NULL,
+         position TINYINT UNSIGNED NOT NULL DEFAULT 0,
+         PRIMARY KEY (document_id, tag_id),
+         INDEX idx_user_tag (user_id, tag_id, document_id),
+         FOREIGN KEY (document_id) REFERENCES documents(id) ON DELETE CASCADE,
+         FOREIGN KEY (tag_id) REFERENCES tags(id) ON DELETE CASCADE
+        ) ENGINE=InnoDB;
+        """
+        cursor.execute(document_tags_table_sql)
+        logger.info("'document_tags' table is ready.")
+
+        # Suggested questions and section summaries worked out at ingest
+        # time (see processing.precompute_insights), stored as JSON.
+        document_insights_table_sql="""
+        CREATE TABLE IF NOT EXISTS document_insights (
+         document_id INT PRIMARY KEY,
+         index_version VARCHAR(191) NULL,
+         questions MEDIUMTEXT NOT NULL,
+         sections MEDIUMTEXT NOT NULL,
+         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+         FOREIGN KEY (document_id) REFERENCES documents(id) ON DELETE CASCADE
+        ) ENGINE=InnoDB;
+        """
+        cursor.execute(document_insights_table_sql)
+        logger.info("'document_insights' table is ready.")
 
     except Error as e:
-        print(f"Error during table creation: {e}")
+        logger.error("Error during table creation: %s", e)
     finally:
-        if conn and conn.is_connected():
-            cursor.close()
-            conn.close() # This returns the connection to the pool
-            print("Connection returned to pool.")
+        release_db_connection(conn, cursor)
+        logger.debug("Connection returned to pool.")
+
+    migrate_legacy_tags()
 
 
 # -------To add a user ---------
+@telemetry.timed("mysql.add_user")
 def add_user(email, password_hash):
     """Adds a new user to the users table. Returns True on success, False on failure."""
     conn = get_db_connection()
     if conn is None:
         return False
+    cursor = None
     
     try:
         cursor = conn.cursor()
@@ -137,19 +371,19 @@ def add_user(email, password_hash):
         return new_user_id
     
     except Error as e:
-        print(f"Error adding user: {e}")
+        logger.error("Error adding user: %s", e)
         return False
     finally:
-        if conn.is_connected():
-            cursor.close()
-            conn.close()
+        release_db_connection(conn, cursor)
 
 # --- To retrieve a user by their email ---
+@telemetry.timed("mysql.get_user_by_email")
 def get_user_by_email(email):
 
     """Fetches a single user by email. Returns user data as a dict, or None if not found."""
     conn = get_db_connection()
     if conn is None: return None
+    cursor = None
     try:
         # Use a dictionary cursor to get results as dicts instead of tuples
         cursor = conn.cursor(dictionary=True)
@@ -158,19 +392,19 @@ def get_user_by_email(email):
         user = cursor.fetchone()
         return user
     except Error as e:
-        print(f"Error fetching user: {e}")
+        logger.error("Error fetching user: %s", e)
         return None
     finally:
-        if conn.is_connected():
-            cursor.close()
-            conn.close()
+        release_db_connection(conn, cursor)
 
 
 # ---To add a document's metadata ---
+@telemetry.timed("mysql.add_document")
 def add_document(user_id, filename, url, public_id,tags_string,summary):
     """Adds a new document record to the database. Returns True on success."""
     conn = get_db_connection()
     if conn is None: return False
+    cursor = None
     try:
         cursor = conn.cursor()
         sql = """
@@ -182,44 +416,61 @@ def add_document(user_id, filename, url, public_id,tags_string,summary):
         new_doc_id = cursor.lastrowid 
         return new_doc_id
     except Error as e:
-        print(f"Error adding document: {e}")
+        logger.error("Error adding document: %s", e)
         conn.rollback()
         return None
     finally:
-        if conn.is_connected():
-            cursor.close()
-            conn.close()
+        release_db_connection(conn, cursor)
 
-def get_documents_by_user(user_id):
-    """Fetches all documents for a specific user, ordered by most recent."""
+@telemetry.timed("mysql.get_documents_by_user")
+def get_documents_by_user(user_id, tag=None):
+    """
+    Fetches all documents for a specific user, ordered by most recent.
+    If a tag is given, only documents carrying that tag are returned.
+    Each row's 'tags' is a list of tag names in their generated order.
+    """
     conn = get_db_connection()
     if conn is None: return []
+    cursor = None
     try:
         # Using dictionary=True makes the cursor return rows as dictionaries
         cursor = conn.cursor(dictionary=True)
         
-        # The SQL query to select documents for a specific user
         # 'WHERE user_id = %s' is the crucial part for security and correctness
         # 'ORDER BY created_at DESC' shows the newest documents first
-        sql = "SELECT id, filename, url, created_at, tags FROM documents WHERE user_id = %s ORDER BY created_at DESC"
-        
-        cursor.execute(sql, (user_id,))
+        if tag:
+            sql = """
+                SELECT d.id, d.filename, d.url, d.created_at, d.processing_status, d.storage_status, d.ai_status
+                FROM document_tags dt
+                JOIN tags t ON t.id = dt.tag_id
+                JOIN documents d ON d.id = dt.document_id
+                WHERE dt.user_id = %s AND t.name = %s
+                ORDER BY d.created_at DESC
+            """
+            cursor.execute(sql, (user_id, normalize_tag(tag)))
+        else:
+            sql = "SELECT id, filename, url, created_at, processing_status, storage_status, ai_status FROM documents WHERE user_id = %s ORDER BY created_at DESC"
+            cursor.execute(sql, (user_id,))
         
         # fetchall() gets all the rows that match the query
         documents = cursor.fetchall()
-        return documents
     except Error as e:
-        print(f"Error fetching documents: {e}")
+        logger.error("Error fetching documents: %s", e)
         return [] # Return an empty list if an error occurs
     finally:
-        if conn.is_connected():
-            cursor.close()
-            conn.close()
+        release_db_connection(conn, cursor)
 
+    tags_by_doc = get_tags_for_documents([doc["id"] for doc in documents])
+    for doc in documents:
+        doc["tags"] = tags_by_doc.get(doc["id"], [])
+    return documents
+
+@telemetry.timed("mysql.get_document_by_id")
 def get_document_by_id(doc_id):
     """Fetches a single document by its primary key ID."""
     conn = get_db_connection()
     if conn is None: return None
+    cursor = None
     try:
         cursor = conn.cursor(dictionary=True)
         sql = "SELECT * FROM documents WHERE id = %s"
@@ -227,42 +478,102 @@ def get_document_by_id(doc_id):
         document = cursor.fetchone()
         return document
     except Error as e:
-        print(f"Error fetching document by id: {e}")
+        logger.error("Error fetching document by id: %s", e)
         return None
     finally:
-        if conn.is_connected():
-            cursor.close()
-            conn.close()
+        release_db_connection(conn, cursor)
 
-def delete_document_record(doc_id):
+@telemetry.timed("mysql.get_owned_documents")
+def get_owned_documents(user_id):
+    """
+    Maps the id of every document the user owns to its index_version: the
+    ownership index that protected routes check before fetching a row.
+    Returns None on error, so a failed lookup never grants access.
+    """
+    conn = get_db_connection()
+    if conn is None: return None
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        sql = "SELECT id, index_version FROM documents WHERE user_id = %s"
+        cursor.execute(sql, (user_id,))
+        return {doc_id: index_version for doc_id, index_version in cursor.fetchall()}
+    except Error as e:
+        logger.error("Error fetching document ownership: %s", e)
+        return None
+    finally:
+        release_db_connection(conn, cursor)
 
-    """Deletes a document record from the database by its ID."""
+@telemetry.timed("mysql.delete_document_record")
+def delete_document_record(doc_id, release_file=None):
+    """
+    Deletes a document record from the database by its ID.
+    If given, release_file(public_id, references) is called first, inside the
+    same transaction: `references` counts the documents pointing at the
+    stored file (this one included), and their rows stay locked until the
+    delete commits. An ingest recording the same content-addressed file waits
+    for that, so it cannot slip in between the count and the file's removal
+    (and afterwards finds the file missing and stores it again). If
+    release_file raises, nothing is deleted and the exception propagates.
+    """
     conn = get_db_connection()
     if conn is None: return False
+    cursor = None
     try:
         cursor = conn.cursor()
+        if release_file is not None:
+            cursor.execute("SELECT public_id FROM documents WHERE id = %s FOR UPDATE", (doc_id,))
+            row = cursor.fetchone()
+            if row is None:
+                conn.rollback()
+                return False
+            public_id = row[0]
+            # Locks every row (and the index gap) for this public_id
+            cursor.execute("SELECT id FROM documents WHERE public_id = %s FOR UPDATE", (public_id,))
+            release_file(public_id, len(cursor.fetchall()))
         sql = "DELETE FROM documents WHERE id = %s"
         cursor.execute(sql, (doc_id,))
         conn.commit()
         return True
     except Error as e:
-        print(f"Error deleting document record: {e}")
+        logger.error("Error deleting document record: %s", e)
         conn.rollback()
         return False
+    except Exception:
+        conn.rollback()
+        raise
     finally:
-        if conn.is_connected():
-            cursor.close()
-            conn.close()
+        release_db_connection(conn, cursor)
+
+@telemetry.timed("mysql.get_filename_for_public_id")
+def get_filename_for_public_id(user_id, public_id):
+    """Filename of a document the user has stored under public_id, or None if they have none."""
+    conn = get_db_connection()
+    if conn is None: return None
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        sql = "SELECT filename FROM documents WHERE public_id = %s AND user_id = %s LIMIT 1"
+        cursor.execute(sql, (public_id, user_id))
+        row = cursor.fetchone()
+        return row[0] if row else None
+    except Error as e:
+        logger.error("Error checking file ownership: %s", e)
+        return None
+    finally:
+        release_db_connection(conn, cursor)
 
+@telemetry.timed("mysql.update_document_status")
 def update_document_status(doc_id: int, status: str):
     """Updates the processing_status for a specific document."""
     conn = get_db_connection()
     if conn is None: return False
+    cursor = None
     try:
         # A list of valid statuses to prevent incorrect values
         valid_statuses = ['PENDING', 'PROCESSING', 'COMPLETED', 'FAILED']
         if status not in valid_statuses:
-            print(f"Invalid status provided: {status}")
+            logger.warning("Invalid status provided: %s", status)
             return False
 
         cursor = conn.cursor()
@@ -271,20 +582,302 @@ def update_document_status(doc_id: int, status: str):
         conn.commit()
         return True
     except Error as e:
-        print(f"Error updating document status: {e}")
+        logger.error("Error updating document status: %s", e)
         conn.rollback()
         return False
     finally:
-        if conn.is_connected():
-            cursor.close()
-            conn.close()
+        release_db_connection(conn, cursor)
+
+
+# Columns the ingestion pipeline may fill in once its branches have joined
+INGEST_FIELDS = {'url', 'public_id', 'tags', 'summary', 'processing_status', 'storage_status', 'ai_status',
+                 'index_version'}
+
+@telemetry.timed("mysql.update_document_ingest")
+def update_document_ingest(doc_id: int, fields: dict):
+    """Updates several ingestion columns of a document in one statement."""
+    unknown = set(fields) - INGEST_FIELDS
+    if unknown or not fields:
+        logger.warning("Invalid ingest fields provided: %s", unknown or fields)
+        return False
+
+    conn = get_db_connection()
+    if conn is None: return False
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        # Column names come from the whitelist above, values are parameterized
+        assignments = ", ".join(f"{column} = %s" for column in fields)
+        sql = f"UPDATE documents SET {assignments} WHERE id = %s"
+        cursor.execute(sql, (*fields.values(), doc_id))
+        conn.commit()
+        return True
+    except Error as e:
+        logger.error("Error updating document ingest fields: %s", e)
+        conn.rollback()
+        return False
+    finally:
+        release_db_connection(conn, cursor)
+
+
+# --- Re-indexing ---
+
+@telemetry.timed("mysql.count_documents_to_reindex")
+def count_documents_to_reindex(version):
+    """Counts indexed documents whose chunks are not yet at `version`."""
+    conn = get_db_connection()
+    if conn is None: return None
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        sql = """
+            SELECT COUNT(*) FROM documents
+            WHERE ai_status = 'COMPLETED' AND NOT (index_version <=> %s)
+        """
+        cursor.execute(sql, (version,))
+        return cursor.fetchone()[0]
+    except Error as e:
+        logger.error("Error counting documents to re-index: %s", e)
+        return None
+    finally:
+        release_db_connection(conn, cursor)
+
+@telemetry.timed("mysql.get_documents_to_reindex")
+def get_documents_to_reindex(version, after_id=0, limit=20):
+    """Next batch (by id, after `after_id`) of indexed documents not yet at `version`."""
+    conn = get_db_connection()
+    if conn is None: return []
+    cursor = None
+    try:
+        cursor = conn.cursor(dictionary=True)
+        sql = """
+            SELECT id, user_id, filename, url, public_id, index_version FROM documents
+            WHERE ai_status = 'COMPLETED' AND NOT (index_version <=> %s) AND id > %s
+            ORDER BY id
+            LIMIT %s
+        """
+        cursor.execute(sql, (version, after_id, limit))
+        return cursor.fetchall()
+    except Error as e:
+        logger.error("Error fetching documents to re-index: %s", e)
+        return []
+    finally:
+        release_db_connection(conn, cursor)
+
+@telemetry.timed("mysql.switch_index_version")
+def switch_index_version(doc_id, old_version, new_version):
+    """
+    Points a document at new_version, but only if it is still at old_version.
+    Returns True if this call made the switch.
+    """
+    conn = get_db_connection()
+    if conn is None: return False
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        sql = "UPDATE documents SET index_version = %s WHERE id = %s AND index_version <=> %s"
+        cursor.execute(sql, (new_version, doc_id, old_version))
+        conn.commit()
+        return cursor.rowcount == 1
+    except Error as e:
+        logger.error("Error switching index version: %s", e)
+        conn.rollback()
+        return False
+    finally:
+        release_db_connection(conn, cursor)
+
+
+# --- Precomputed document insights ---
+
+@telemetry.timed("mysql.save_document_insights")
+def save_document_insights(doc_id, index_version, questions, sections):
+    """Stores (or replaces) a document's suggested questions and section summaries. Returns True on success."""
+    conn = get_db_connection()
+    if conn is None: return False
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        sql = """
+            INSERT INTO document_insights (document_id, index_version, questions, sections)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE index_version = VALUES(index_version), questions = VALUES(questions),
+                                    sections = VALUES(sections), created_at = CURRENT_TIMESTAMP
+        """
+        cursor.execute(sql, (doc_id, index_version, json.dumps(questions), json.dumps(sections)))
+        conn.commit()
+        return True
+    except Error as e:
+        logger.error("Error saving document insights: %s", e)
+        conn.rollback()
+        return False
+    finally:
+        release_db_connection(conn, cursor)
+
+@telemetry.timed("mysql.get_document_insights")
+def get_document_insights(doc_id):
+    """
+    Returns {'index_version', 'questions', 'sections'} for a document, an
+    empty dict if none were stored yet, or None on error.
+    """
+    conn = get_db_connection()
+    if conn is None: return None
+    cursor = None
+    try:
+        cursor = conn.cursor(dictionary=True)
+        sql = "SELECT index_version, questions, sections FROM document_insights WHERE document_id = %s"
+        cursor.execute(sql, (doc_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return {}
+        return {"index_version": row["index_version"],
+                "questions": json.loads(row["questions"]),
+                "sections": json.loads(row["sections"])}
+    except (Error, ValueError) as e:
+        logger.error("Error fetching document insights: %s", e)
+        return None
+    finally:
+        release_db_connection(conn, cursor)
+
+
+# --- Normalized tag storage ---
+MAX_TAG_LENGTH = 64
+
+def normalize_tag(tag):
+    """Lowercases and trims a tag so the same label always maps to one row."""
+    return tag.strip().lower()[:MAX_TAG_LENGTH]
+
+@telemetry.timed("mysql.set_document_tags")
+def set_document_tags(doc_id, user_id, tags):
+    """Replaces the tags linked to a document. Returns True on success."""
+    names = []
+    for tag in tags:
+        name = normalize_tag(tag)
+        if name and name not in names:
+            names.append(name)
+
+    conn = get_db_connection()
+    if conn is None: return False
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM document_tags WHERE document_id = %s", (doc_id,))
+
+        if names:
+            # INSERT IGNORE lets concurrent uploads race on the same new tag safely.
+            cursor.executemany("INSERT IGNORE INTO tags (name) VALUES (%s)", [(name,) for name in names])
+
+            placeholders = ", ".join(["%s"] * len(names))
+            cursor.execute(f"SELECT id, name FROM tags WHERE name IN ({placeholders})", names)
+            tag_ids = {name: tag_id for tag_id, name in cursor.fetchall()}
+
+            link_sql = "INSERT INTO document_tags (document_id, tag_id, user_id, position) VALUES (%s, %s, %s, %s)"
+            cursor.executemany(link_sql, [
+                (doc_id, tag_ids[name], user_id, position)
+                for position, name in enumerate(names) if name in tag_ids
+            ])
+        conn.commit()
+        return True
+    except Error as e:
+        logger.error("Error setting document tags: %s", e)
+        conn.rollback()
+        return False
+    finally:
+        release_db_connection(conn, cursor)
+
+@telemetry.timed("mysql.get_tags_for_documents")
+def get_tags_for_documents(doc_ids):
+    """Fetches the tags of many documents in one query. Returns {doc_id: [tag, ...]}."""
+    if not doc_ids:
+        return {}
+    conn = get_db_connection()
+    if conn is None: return {}
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        placeholders = ", ".join(["%s"] * len(doc_ids))
+        sql = f"""
+            SELECT dt.document_id, t.name
+            FROM document_tags dt
+            JOIN tags t ON t.id = dt.tag_id
+            WHERE dt.document_id IN ({placeholders})
+            ORDER BY dt.document_id, dt.position
+        """
+        cursor.execute(sql, list(doc_ids))
+        tags_by_doc = {}
+        for doc_id, name in cursor.fetchall():
+            tags_by_doc.setdefault(doc_id, []).append(name)
+        return tags_by_doc
+    except Error as e:
+        logger.error("Error fetching document tags: %s", e)
+        return {}
+    finally:
+        release_db_connection(conn, cursor)
+
+@telemetry.timed("mysql.get_tag_counts_for_user")
+def get_tag_counts_for_user(user_id):
+    """Returns [{'name': ..., 'count': ...}] for every tag the user has, most used first."""
+    conn = get_db_connection()
+    if conn is None: return []
+    cursor = None
+    try:
+        cursor = conn.cursor(dictionary=True)
+        sql = """
+            SELECT t.name, c.doc_count AS count
+            FROM (
+                SELECT tag_id, COUNT(*) AS doc_count
+                FROM document_tags
+                WHERE user_id = %s
+                GROUP BY tag_id
+            ) c
+            JOIN tags t ON t.id = c.tag_id
+            ORDER BY c.doc_count DESC, t.name
+        """
+        cursor.execute(sql, (user_id,))
+        return cursor.fetchall()
+    except Error as e:
+        logger.error("Error fetching tag counts: %s", e)
+        return []
+    finally:
+        release_db_connection(conn, cursor)
+
+def migrate_legacy_tags():
+    """
+    One-off backfill of document_tags from the old comma-joined documents.tags
+    column. Only documents without any linked tags are touched, so it is cheap
+    to run on every start-up.
+    """
+    conn = get_db_connection()
+    if conn is None: return
+    cursor = None
+    try:
+        cursor = conn.cursor(dictionary=True)
+        sql = """
+            SELECT d.id, d.user_id, d.tags
+            FROM documents d
+            LEFT JOIN document_tags dt ON dt.document_id = d.id
+            WHERE d.tags IS NOT NULL AND d.tags <> '' AND dt.document_id IS NULL
+        """
+        cursor.execute(sql)
+        pending = cursor.fetchall()
+    except Error as e:
+        logger.error("Error reading legacy tags: %s", e)
+        return
+    finally:
+        release_db_connection(conn, cursor)
+
+    for doc in pending:
+        set_document_tags(doc["id"], doc["user_id"], doc["tags"].split(','))
+    if pending:
+        logger.info("Migrated legacy tags for %s documents.", len(pending))
 
 
 # --- To store a new password reset token ---
+@telemetry.timed("mysql.store_reset_token")
 def store_reset_token(user_id, token_hash, expires_at):
     """Saves the hashed reset token to the password_resets table."""
     conn = get_db_connection()
     if conn is None: return False
+    cursor = None
     try:
         cursor = conn.cursor()
         
@@ -297,19 +890,19 @@ def store_reset_token(user_id, token_hash, expires_at):
         conn.commit()
         return True
     except Error as e:
-        print(f"Error storing reset token: {e}")
+        logger.error("Error storing reset token: %s", e)
         conn.rollback()
         return False
     finally:
-        if conn.is_connected():
-            cursor.close()
-            conn.close()
+        release_db_connection(conn, cursor)
 
 # --- To retrieve a token's details ---
+@telemetry.timed("mysql.get_reset_token_details")
 def get_reset_token_details(token_hash):
     """Fetches reset token details by the token_hash. Returns a dict or None."""
     conn = get_db_connection()
     if conn is None: return None
+    cursor = None
     try:
         cursor = conn.cursor(dictionary=True)
         sql = "SELECT * FROM password_resets WHERE token_hash = %s"
@@ -317,18 +910,18 @@ def get_reset_token_details(token_hash):
         token_data = cursor.fetchone()
         return token_data
     except Error as e:
-        print(f"Error fetching reset token: {e}")
+        logger.error("Error fetching reset token: %s", e)
         return None
     finally:
-        if conn.is_connected():
-            cursor.close()
-            conn.close()
+        release_db_connection(conn, cursor)
 
 # --- To update a user's password ---
+@telemetry.timed("mysql.update_user_password")
 def update_user_password(user_id, new_hashed_password):
     """Updates the user's password_hash in the users table."""
     conn = get_db_connection()
     if conn is None: return False
+    cursor = None
     try:
         cursor = conn.cursor()
         sql = "UPDATE users SET password_hash = %s WHERE id = %s"
@@ -336,19 +929,19 @@ def update_user_password(user_id, new_hashed_password):
         conn.commit()
         return True
     except Error as e:
-        print(f"Error updating user password: {e}")
+        logger.error("Error updating user password: %s", e)
         conn.rollback()
         return False
     finally:
-        if conn.is_connected():
-            cursor.close()
-            conn.close()
+        release_db_connection(conn, cursor)
 
 # --- To delete a token after use ---
+@telemetry.timed("mysql.delete_reset_token")
 def delete_reset_token(token_hash):
     """Deletes a password reset token from the table after it has been used."""
     conn = get_db_connection()
     if conn is None: return False
+    cursor = None
     try:
         cursor = conn.cursor()
         sql = "DELETE FROM password_resets WHERE token_hash = %s"
@@ -356,11 +949,9 @@ def delete_reset_token(token_hash):
         conn.commit()
         return True
     except Error as e:
-        print(f"Error deleting reset token: {e}")
+        logger.error("Error deleting reset token: %s", e)
         conn.rollback()
         return False
     finally:
-        if conn.is_connected():
-            cursor.close()
-            conn.close()
+        release_db_connection(conn, cursor)
 
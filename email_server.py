@@ -1,34 +1,241 @@
+"""
+Outbound mail. Messages are queued and sent by one background thread that
+keeps a single SMTP connection open between messages (reopening it when the
+server drops it), sends everything queued in one batch over that connection,
+retries failures with exponential backoff and caps how many messages one
+recipient can get per hour. Callers never wait on SMTP.
+
+Point SMTP_HOST/SMTP_PORT at MailHog, a real relay, or a local aiosmtpd sink
+(see benchmarks/mail.py).
+"""
+import heapq
+import itertools
+import queue
 import smtplib
+import threading
+import time
+from collections import deque
 from email.message import EmailMessage
 import os,dotenv
+import telemetry
+
+logger = telemetry.get_logger(__name__)
 
 # Load environment variables from .env file
 dotenv.load_dotenv()
 SMTP_HOST = os.getenv("SMTP_HOST", "localhost")
 SMTP_PORT = int(os.getenv("SMTP_PORT", 1025))
+SMTP_USERNAME = os.getenv("SMTP_USERNAME", "")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD", "")
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "").lower() in ("1", "true", "yes")
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", 10))
+# An unused connection is closed after this long
+SMTP_IDLE_SECONDS = float(os.getenv("SMTP_IDLE_SECONDS", 30))
+MAIL_FROM = os.getenv("MAIL_FROM", "no-reply@my-local-app.com")
+
+# --- Queue settings ---
+MAIL_QUEUE_SIZE = int(os.getenv("MAIL_QUEUE_SIZE", 1000))
+# Messages sent per wake-up of the sender, over one connection
+MAIL_BATCH_SIZE = int(os.getenv("MAIL_BATCH_SIZE", 20))
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", 5))
+# Delay before the first retry; doubled for every further attempt
+MAIL_RETRY_SECONDS = float(os.getenv("MAIL_RETRY_SECONDS", 2))
+MAIL_PER_RECIPIENT_PER_HOUR = int(os.getenv("MAIL_PER_RECIPIENT_PER_HOUR", 5))
+RATE_WINDOW_SECONDS = 3600
 # ------------------------------------------
 
+
+class MailQueue:
+    """A bounded outbox with one sender thread, started on the first submit()."""
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, batch_size=MAIL_BATCH_SIZE,
+                 max_attempts=MAIL_MAX_ATTEMPTS, retry_seconds=MAIL_RETRY_SECONDS,
+                 per_recipient_per_hour=MAIL_PER_RECIPIENT_PER_HOUR,
+                 idle_seconds=SMTP_IDLE_SECONDS, queue_size=MAIL_QUEUE_SIZE):
+        self.host = host
+        self.port = port
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.per_recipient_per_hour = per_recipient_per_hour
+        self.idle_seconds = idle_seconds
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.connections = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        # (due, seq, attempt, message) for messages waiting to be retried
+        self._retries = []
+        self._seq = itertools.count()
+        self._recent = {}  # recipient -> send times within the rate window
+        self._rate_lock = threading.Lock()
+        self._smtp = None
+        self._last_used = 0.0
+        self._pending = 0
+        self._idle = threading.Condition()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def submit(self, message) -> bool:
+        """Queues a message. False if the recipient is over their rate limit or the queue is full."""
+        recipient = message['To']
+        if not self._allow(recipient):
+            logger.warning("Not emailing %s: over %s messages per hour.", recipient, self.per_recipient_per_hour)
+            self.dropped += 1
+            return False
+        with self._idle:
+            self._pending += 1
+        try:
+            self._queue.put_nowait((0, message))
+        except queue.Full:
+            logger.error("Mail queue is full; dropping the message to %s.", recipient)
+            self.dropped += 1
+            self._finish()
+            return False
+        telemetry.set_gauge("intellidocs_mail_queue_depth", self._queue.qsize())
+        self._ensure_started()
+        return True
+
+    def flush(self, timeout=None) -> bool:
+        """Waits until every queued message was sent or given up on. False on timeout."""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._disconnect()
+
+    def _allow(self, recipient) -> bool:
+        key = (recipient or "").strip().lower()
+        now = time.monotonic()
+        with self._rate_lock:
+            recent = self._recent.setdefault(key, deque())
+            while recent and recent[0] <= now - RATE_WINDOW_SECONDS:
+                recent.popleft()
+            if len(recent) >= self.per_recipient_per_hour:
+                return False
+            recent.append(now)
+            if len(self._recent) > 10000:
+                self._recent = {k: v for k, v in self._recent.items() if v and v[-1] > now - RATE_WINDOW_SECONDS}
+            return True
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="mail-sender", daemon=True)
+                self._thread.start()
+
+    def _finish(self):
+        with self._idle:
+            self._pending -= 1
+            if self._pending == 0:
+                self._idle.notify_all()
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if not batch:
+                if self._smtp is not None and time.monotonic() - self._last_used > self.idle_seconds:
+                    self._disconnect()
+                continue
+            for attempt, message in batch:
+                self._deliver(attempt, message)
+            telemetry.set_gauge("intellidocs_mail_queue_depth", self._queue.qsize())
+        self._disconnect()
+
+    def _next_batch(self) -> list:
+        """Due retries first, then up to batch_size queued messages. Blocks until one is due or queued."""
+        batch = []
+        now = time.monotonic()
+        while self._retries and self._retries[0][0] <= now and len(batch) < self.batch_size:
+            _, _, attempt, message = heapq.heappop(self._retries)
+            batch.append((attempt, message))
+        if not batch:
+            timeout = min(self.idle_seconds, 1.0)
+            if self._retries:
+                timeout = min(timeout, max(self._retries[0][0] - now, 0.0))
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                return batch
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _connection(self):
+        if self._smtp is None:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+            if SMTP_STARTTLS:
+                smtp.starttls()
+            if SMTP_USERNAME:
+                smtp.login(SMTP_USERNAME, SMTP_PASSWORD)
+            self._smtp = smtp
+            self.connections += 1
+        return self._smtp
+
+    def _disconnect(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except Exception:
+            self._smtp.close()
+        self._smtp = None
+
+    def _send(self, message):
+        reused = self._smtp is not None
+        try:
+            self._connection().send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            # The server dropped an idle connection: reconnect once right away
+            self._disconnect()
+            if not reused:
+                raise
+            self._connection().send_message(message)
+        self._last_used = time.monotonic()
+
+    def _deliver(self, attempt, message):
+        try:
+            with telemetry.timed("smtp.send"):
+                self._send(message)
+        except Exception as e:
+            self._disconnect()
+            permanent = isinstance(e, smtplib.SMTPRecipientsRefused) or \
+                (isinstance(e, smtplib.SMTPResponseException) and 500 <= e.smtp_code < 600)
+            if permanent or attempt + 1 >= self.max_attempts:
+                logger.error("Giving up on the email to %s after %s attempts: %s", message['To'], attempt + 1, e)
+                self.failed += 1
+                self._finish()
+                return
+            delay = self.retry_seconds * 2 ** attempt
+            logger.warning("Email to %s failed (attempt %s), retrying in %.0fs: %s", message['To'], attempt + 1, delay, e)
+            heapq.heappush(self._retries, (time.monotonic() + delay, next(self._seq), attempt + 1, message))
+            return
+        self.sent += 1
+        self._finish()
+
+
+mail_queue = MailQueue()
+
+
 def send_reset_email(recipient_email, reset_link):
     """
-    Connects to MailHog and sends the reset email.
+    Queues the reset email and returns at once; delivery happens on the
+    mail sender thread. Returns False if it could not be queued.
     """
     # 1. Create the Email Message
     msg = EmailMessage()
     msg.set_content(f"Click this link to reset your password: {reset_link}")
     msg['Subject'] = 'Your Password Reset Link'
-    msg['From'] = 'no-reply@my-local-app.com'
+    msg['From'] = MAIL_FROM
     msg['To'] = recipient_email
 
-    try:
-        # 2. Connect to MailHog (the fake server)
-        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
-        
-        server.send_message(msg)
-        server.quit()
-        
-        print(f"Successfully sent reset email to MailHog for: {recipient_email}")
-        return True
-
-    except Exception as e:
-        print(f"Error: Failed to send email via MailHog. {e}")
-        return False
+    # 2. Hand it to the sender thread
+    return mail_queue.submit(msg)
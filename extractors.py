@@ -0,0 +1,245 @@
+"""
+Text extractors, one per supported file type, looked up by extension or MIME
+type. Every extractor is a generator that yields a document's text a page or
+section at a time, so processing can chunk a file of any size without holding
+its whole text:
+
+  pdf   one section per page (PyMuPDF); scanned pages go through ocr.py
+  docx  sections split at headings, read straight from word/document.xml
+  txt   blocks of about SECTION_CHARS characters
+  md    sections split at headings
+  html  visible text, sections split at headings
+
+`source` is a file path, or the file's raw bytes.
+"""
+import io
+import os
+import zipfile
+from collections import deque
+from html.parser import HTMLParser
+from xml.etree import ElementTree
+
+import fitz
+
+import ocr
+import telemetry
+
+logger = telemetry.get_logger(__name__)
+
+# Sections are cut at the next natural boundary after this many characters
+SECTION_CHARS = int(os.getenv("EXTRACT_SECTION_CHARS", 64 * 1024))
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class Extractor:
+    def __init__(self, name, extensions, mimetypes, extract):
+        self.name = name
+        self.extensions = extensions
+        self.mimetypes = mimetypes
+        self.extract = extract
+
+    @property
+    def mimetype(self):
+        return self.mimetypes[0]
+
+
+_by_extension = {}
+_by_mimetype = {}
+
+
+def register(name, extensions, mimetypes):
+    """Registers the decorated generator function as the extractor for `extensions` and `mimetypes`."""
+    def decorator(extract):
+        extractor = Extractor(name, tuple(extensions), tuple(mimetypes), extract)
+        for extension in extractor.extensions:
+            _by_extension[extension] = extractor
+        for mimetype in extractor.mimetypes:
+            _by_mimetype[mimetype] = extractor
+        return extract
+    return decorator
+
+
+def lookup(filename=None, mimetype=None):
+    """The extractor for a file name's extension, else for its MIME type; None if unsupported."""
+    if filename:
+        extractor = _by_extension.get(os.path.splitext(filename)[1].lower())
+        if extractor is not None:
+            return extractor
+    if mimetype:
+        return _by_mimetype.get(mimetype.split(";")[0].strip().lower())
+    return None
+
+
+def extensions() -> list[str]:
+    return sorted(_by_extension)
+
+
+def _open_binary(source):
+    if isinstance(source, (bytes, bytearray)):
+        return io.BytesIO(source)
+    return open(source, "rb")
+
+
+def _open_text(source):
+    # utf-8-sig drops a BOM; undecodable bytes become U+FFFD rather than failing the upload
+    return io.TextIOWrapper(_open_binary(source), encoding="utf-8-sig", errors="replace")
+
+
+@register("pdf", [".pdf"], ["application/pdf"])
+def extract_pdf(source):
+    """
+    One section per page. Pages without a text layer are handed to OCR as
+    they are found; pages after one are held back until it is read, so
+    sections stay in page order while OCR runs in the background.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        doc = fitz.open(stream=source, filetype="pdf")
+    else:
+        doc = fitz.open(source, filetype="pdf")
+    with doc, ocr.PageReader(source) as reader:
+        held = deque()  # (page text, OCR handle or None)
+        for page in doc:
+            text = page.get_text()
+            if ocr.OCR_ENABLED and ocr.needs_ocr(page, text):
+                held.append((text, reader.submit(page.number, ocr.page_key(doc, page))))
+            elif held:
+                held.append((text, None))
+            else:
+                yield text
+            while held and (held[0][1] is None or reader.done(held[0][1])):
+                text, handle = held.popleft()
+                yield (reader.text(handle) or text) if handle else text
+        while held:
+            text, handle = held.popleft()
+            yield (reader.text(handle) or text) if handle else text
+
+
+@register("txt", [".txt", ".text"], ["text/plain"])
+def extract_txt(source):
+    """Blocks of about SECTION_CHARS characters, cut at a line end."""
+    with _open_text(source) as f:
+        section = []
+        size = 0
+        for line in f:
+            section.append(line)
+            size += len(line)
+            if size >= SECTION_CHARS:
+                yield "".join(section)
+                section, size = [], 0
+        if section:
+            yield "".join(section)
+
+
+@register("md", [".md", ".markdown"], ["text/markdown", "text/x-markdown"])
+def extract_md(source):
+    """Sections start at every heading line, or after SECTION_CHARS characters."""
+    with _open_text(source) as f:
+        section = []
+        size = 0
+        in_code = False
+        for line in f:
+            if line.lstrip().startswith("```"):
+                in_code = not in_code
+            heading = not in_code and line.startswith("#")
+            if section and (heading or size >= SECTION_CHARS):
+                yield "".join(section)
+                section, size = [], 0
+            section.append(line)
+            size += len(line)
+        if section:
+            yield "".join(section)
+
+
+class _HTMLText(HTMLParser):
+    """Collects visible text, starting a new section at each heading."""
+
+    SKIP = {"script", "style", "noscript", "template", "svg"}
+    BLOCKS = {"p", "div", "br", "li", "tr", "td", "th", "section", "article", "pre",
+              "blockquote", "title", "ul", "ol", "table", "hr"}
+    HEADINGS = {"h1", "h2", "h3", "h4", "h5", "h6"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.sections = []
+        self._current = []
+        self._size = 0
+        self._skip_depth = 0
+
+    def _cut(self):
+        if self._current:
+            self.sections.append("".join(self._current))
+            self._current, self._size = [], 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self._skip_depth += 1
+        elif tag in self.HEADINGS or self._size >= SECTION_CHARS:
+            self._cut()
+        if tag in self.BLOCKS or tag in self.HEADINGS:
+            self._current.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP and self._skip_depth:
+            self._skip_depth -= 1
+        elif tag in self.BLOCKS or tag in self.HEADINGS:
+            self._current.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self._current.append(data)
+            self._size += len(data)
+
+    def close(self):
+        super().close()
+        self._cut()
+
+
+@register("html", [".html", ".htm"], ["text/html", "application/xhtml+xml"])
+def extract_html(source):
+    """Visible text (scripts and styles dropped), in sections split at h1-h6."""
+    parser = _HTMLText()
+    with _open_text(source) as f:
+        for block in iter(lambda: f.read(READ_CHUNK_SIZE), ""):
+            parser.feed(block)
+            while parser.sections:
+                yield parser.sections.pop(0)
+    parser.close()
+    yield from parser.sections
+
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+@register("docx", [".docx"], ["application/vnd.openxmlformats-officedocument.wordprocessingml.document"])
+def extract_docx(source):
+    """
+    Paragraph text from word/document.xml, parsed incrementally. Sections
+    start at Heading/Title paragraphs, or after SECTION_CHARS characters.
+    """
+    with _open_binary(source) as raw, zipfile.ZipFile(raw) as archive, archive.open("word/document.xml") as xml:
+        section = []
+        size = 0
+        for event, elem in ElementTree.iterparse(xml, events=("start", "end")):
+            tag = elem.tag
+            if event == "start":
+                if tag == f"{_W}p" and size >= SECTION_CHARS:
+                    yield "".join(section)
+                    section, size = [], 0
+                continue
+            if tag == f"{_W}pStyle":
+                style = elem.get(f"{_W}val", "")
+                if section and (style.startswith("Heading") or style == "Title"):
+                    yield "".join(section)
+                    section, size = [], 0
+            elif tag == f"{_W}t" and elem.text:
+                section.append(elem.text)
+                size += len(elem.text)
+            elif tag in (f"{_W}tab", f"{_W}tc"):
+                section.append(" ")
+            elif tag in (f"{_W}br", f"{_W}cr"):
+                section.append("\n")
+            elif tag == f"{_W}p":
+                section.append("\n")
+                elem.clear()
+        if section:
+            yield "".join(section)
@@ -0,0 +1,96 @@
+"""
+Production server profile. From the project directory:
+
+    gunicorn app:app
+
+(gunicorn reads this file from the working directory.)
+
+  * The embedding model is loaded here, in the master, before the workers
+    are forked, so they share its memory copy-on-write instead of each
+    loading a copy. The app itself is imported by each worker after the
+    fork (no preload_app), so MySQL pools, Mongo clients and background
+    threads are never shared between processes.
+  * One vector writer process (vector_writer.py) is started next to the
+    workers and is the only one writing the vector index; workers reach it
+    over the Unix socket VECTOR_WRITER_SOCKET.
+  * With more than one worker, Redis is required (VIEW_CACHE_URL and the
+    redis package): cache invalidations, document ownership, batch progress,
+    live progress and login throttles must be seen by every worker.
+"""
+import gc
+import multiprocessing
+import os
+import secrets
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Both must be in the environment before vector_store is imported, here and in every worker
+os.environ.setdefault("VECTOR_WRITER_SOCKET", os.path.abspath("./run/vector_writer.sock"))
+os.environ.setdefault("VECTOR_WRITER_AUTHKEY", secrets.token_hex(16))
+
+bind = os.getenv("WEB_BIND", "127.0.0.1:8000")
+workers = int(os.getenv("WEB_WORKERS", multiprocessing.cpu_count()))
+# Chat and upload requests mostly wait on Ollama and MySQL, so each worker serves several at once.
+# An open /events/ingestion stream holds a thread too; at most half of them
+# are given to streams (PROGRESS_MAX_STREAMS, see progress.py).
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", 8))
+# Long enough for an upload of MAX_UPLOAD_MB and a slow LLM reply
+timeout = int(os.getenv("WEB_TIMEOUT", 300))
+graceful_timeout = 30
+preload_app = False
+
+if workers > 1:
+    try:
+        import redis  # noqa: F401
+    except ImportError:
+        redis = None
+    if redis is None or not os.getenv("VIEW_CACHE_URL") or \
+            os.getenv("VIEW_CACHE_ENABLED", "true").lower() not in ("1", "true", "yes"):
+        raise RuntimeError("Several workers need shared state: install redis, set VIEW_CACHE_URL "
+                           "and keep VIEW_CACHE_ENABLED on (or run with WEB_WORKERS=1).")
+
+import vector_store  # noqa: E402  (loads the embedding model once, in the master)
+
+# Keep the garbage collector from touching (and so copying) the model's objects in the workers
+gc.collect()
+gc.freeze()
+
+_writer = None
+
+
+def _start_writer(log):
+    global _writer
+    import vector_writer
+
+    _writer = multiprocessing.get_context("fork").Process(target=vector_writer.main, name="vector-writer")
+    _writer.start()
+    deadline = time.monotonic() + 60
+    while not os.path.exists(vector_store.VECTOR_WRITER_SOCKET) and time.monotonic() < deadline:
+        if not _writer.is_alive():
+            raise RuntimeError("The vector writer exited during startup.")
+        time.sleep(0.1)
+    log.info("Vector writer running (pid %s) on %s", _writer.pid, vector_store.VECTOR_WRITER_SOCKET)
+
+
+def on_starting(server):
+    # Remove a stale socket first, so the wait above sees this run's writer
+    if os.path.exists(vector_store.VECTOR_WRITER_SOCKET):
+        os.unlink(vector_store.VECTOR_WRITER_SOCKET)
+    _start_writer(server.log)
+
+
+def on_reload(server):
+    # Workers come back on HUP; the writer keeps running unless it died
+    if _writer is None or not _writer.is_alive():
+        server.log.warning("The vector writer is not running; restarting it.")
+        _start_writer(server.log)
+
+
+def on_exit(server):
+    if _writer is not None and _writer.is_alive():
+        _writer.terminate()
+        _writer.join(10)
@@ -0,0 +1,464 @@
+import os
+import secrets
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import ai_utils
+import cache
+import database
+import extractors
+import processing
+import progress
+import storage
+import telemetry
+import vector_store
+
+logger = telemetry.get_logger(__name__)
+
+# --- Pipeline limits ---
+# Each stage has its own concurrency limit. A file moves to the next stage as
+# soon as a slot frees up, so while file N is being embedded, file N+1 can be
+# extracted and file N+2 can be waiting on the LLM.
+EXTRACT_CONCURRENCY = int(os.getenv("INGEST_EXTRACT_CONCURRENCY", 2))
+LLM_CONCURRENCY = int(os.getenv("INGEST_LLM_CONCURRENCY", 1))
+STORAGE_CONCURRENCY = int(os.getenv("INGEST_STORAGE_CONCURRENCY", 4))
+EMBED_CONCURRENCY = int(os.getenv("INGEST_EMBED_CONCURRENCY", 1))
+# Attempts per storage upload before the storage branch is marked FAILED.
+STORAGE_UPLOAD_ATTEMPTS = int(os.getenv("STORAGE_UPLOAD_ATTEMPTS", 3))
+# Files whose ingestion partly failed are kept here for retry_document().
+RETRY_DIR = os.getenv("INGEST_RETRY_DIR", os.path.join(processing.UPLOAD_TMP_DIR, "intellidocs_retry"))
+# Files of a batch being worked on (and spooled to disk) at any one time.
+BATCH_IN_FLIGHT = int(os.getenv("INGEST_BATCH_IN_FLIGHT", 8))
+# Finished batches kept around for the progress endpoint.
+BATCH_HISTORY = int(os.getenv("INGEST_BATCH_HISTORY", 100))
+# With a shared cache (Redis), batch progress is also stored there for this
+# long, so any worker process can answer /upload/batch/<id>.
+BATCH_SHARED_TTL = int(os.getenv("INGEST_BATCH_SHARED_TTL", 86400))
+# MAX_UPLOAD_MB only limits the compressed request, so what zip archives
+# unpack to is limited separately: per member, and in total per batch.
+ZIP_MEMBER_MAX_BYTES = int(os.getenv("INGEST_ZIP_MEMBER_MAX_MB", 200)) * 1024 * 1024
+ZIP_BATCH_MAX_BYTES = int(os.getenv("INGEST_ZIP_BATCH_MAX_MB", 2048)) * 1024 * 1024
+
+_stage_slots = {
+    "extract": threading.BoundedSemaphore(EXTRACT_CONCURRENCY),
+    "llm": threading.BoundedSemaphore(LLM_CONCURRENCY),
+    "embed": threading.BoundedSemaphore(EMBED_CONCURRENCY),
+}
+# Storage uploads run here, alongside the AI stages of the same file.
+_storage_pool = ThreadPoolExecutor(max_workers=max(STORAGE_CONCURRENCY, 1), thread_name_prefix="storage")
+
+
+class IngestionError(Exception):
+    """A file could not be ingested; the message is safe to show to the user."""
+
+
+# Helper function to check for allowed file types: anything with a registered extractor
+ALLOWED_EXTENSIONS = {extension.lstrip('.') for extension in extractors.extensions()}
+def allowed_file(filename):
+    return '.' in filename and \
+           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+def generate_unique_public_id(original_filename):
+    """
+    Takes a filename, sanitizes it, and adds a unique suffix.
+    Returns a string suitable for a storage public_id.
+    """
+    # 1. Get the original filename and separate its name and extension
+    filename_without_ext, file_ext = os.path.splitext(os.path.basename(original_filename))
+
+    # 2. Sanitize the base filename (replace non-alphanumeric chars with '_')
+    sanitized_filename = "".join(c if c.isalnum() else "_" for c in filename_without_ext)
+
+    # 3. Create a unique suffix using 4 random bytes (8 hex characters)
+    unique_suffix = secrets.token_hex(4)
+
+    # 4. Construct and return the final, unique public_id
+    return f"{sanitized_filename}_{unique_suffix}"
+
+
+@contextmanager
+def _stage(name, on_stage=None):
+    """Waits for a free slot in stage `name`, reporting the stage once it starts."""
+    with _stage_slots[name]:
+        if on_stage:
+            on_stage(name)
+        yield
+
+
+def _upload_to_storage(path, public_id) -> dict:
+    """Storage branch: hands the file on disk to the storage backend, retried with backoff."""
+    for attempt in range(1, STORAGE_UPLOAD_ATTEMPTS + 1):
+        try:
+            return storage.save_file(path, public_id)
+        except Exception as e:
+            if attempt == STORAGE_UPLOAD_ATTEMPTS:
+                raise
+            logger.warning("Storage upload of %s failed (attempt %s): %s", public_id, attempt, e)
+            time.sleep(2 ** (attempt - 1))
+
+
+def _run_ai_branch(doc_id, path, filename, on_stage=None, on_progress=None):
+    """
+    AI branch: extract and chunk, LLM tags and summary, then embed and index.
+    Returns (tags, summary). on_progress(done, total) reports chunks embedded.
+    Suggested questions and section summaries are then worked out in the
+    background (processing.schedule_insights), taking "llm" stage slots
+    like any other file so they never hold up ingestion's own LLM calls.
+    """
+    with _stage("extract", on_stage):
+        # Only the beginning of the text is kept whole, for the LLM prompts
+        text_content, chunks = processing.read_document(path, filename)
+    if not chunks:
+        raise IngestionError("No text could be extracted from the document.")
+
+    # --- AI LOGIC ---
+    with _stage("llm", on_stage):
+        tags_list = ai_utils.generate_tags_for_text(text_content)
+        summary = ai_utils.generate_summary_for_text(text_content)
+
+    with _stage("embed", on_stage):
+        if not processing.process_and_index_document(doc_id, path, filename, chunks=chunks, update_status=False,
+                                                     on_progress=on_progress):
+            raise IngestionError("Indexing the document for search failed.")
+    processing.schedule_insights(doc_id, summary, chunks, llm_slot=lambda: _stage_slots["llm"])
+    return tags_list, summary
+
+
+def _retry_path(doc_id):
+    return os.path.join(RETRY_DIR, f"{doc_id}.pdf")
+
+
+def discard_retry_file(doc_id):
+    """Removes the copy of a failed document's file kept for retry_document(), if there is one."""
+    try:
+        os.remove(_retry_path(doc_id))
+    except FileNotFoundError:
+        pass
+
+
+def _run_branches(doc_id, user_id, path, filename, public_id, run_storage=True, run_ai=True, on_stage=None):
+    """
+    Runs the storage upload and the AI/index work side by side, then records
+    both outcomes on the documents row in a single update. Storage only needs
+    the raw file, so it no longer waits for the Ollama calls to finish.
+    Returns (storage_error, ai_error); None means that branch succeeded or
+    was not run.
+    """
+    storage_future = _storage_pool.submit(_upload_to_storage, path, public_id) if run_storage else None
+    fields = {}
+    storage_error = ai_error = None
+
+    # Every stage change is pushed to the user's open dashboards (see progress.py)
+    def on_ai_stage(name):
+        progress.publish(user_id, doc_id, filename, stage=name, percent=progress.stage_percent(name))
+        if on_stage:
+            on_stage(name)
+
+    def on_embedded(done, total):
+        progress.publish(user_id, doc_id, filename, stage="embed",
+                         percent=progress.stage_percent("embed", done, total))
+
+    if run_ai:
+        try:
+            tags_list, summary = _run_ai_branch(doc_id, path, filename, on_ai_stage, on_embedded)
+            fields.update(tags=",".join(tags_list), summary=summary, ai_status='COMPLETED',
+                          index_version=processing.INDEX_VERSION)
+            database.set_document_tags(doc_id, user_id, tags_list)
+        except Exception as e:
+            logger.error("AI processing failed for doc_id %s: %s", doc_id, e)
+            ai_error = e
+            fields['ai_status'] = 'FAILED'
+
+    # --- Join ---
+    if storage_future is not None:
+        if not run_ai:
+            progress.publish(user_id, doc_id, filename, stage="storage")
+        try:
+            upload_result = storage_future.result()
+            fields.update(url=upload_result['url'], public_id=upload_result['public_id'],
+                          storage_status='COMPLETED')
+        except Exception as e:
+            logger.error("Storage upload failed for doc_id %s: %s", doc_id, e)
+            storage_error = e
+            fields['storage_status'] = 'FAILED'
+
+    fields['processing_status'] = 'FAILED' if (storage_error or ai_error) else 'COMPLETED'
+    database.update_document_ingest(doc_id, fields)
+    if fields.get('storage_status') == 'COMPLETED':
+        try:
+            storage.ensure_stored(path, fields['public_id'])
+        except Exception as e:
+            logger.error("Could not store the file of doc_id %s again: %s", doc_id, e)
+    cache.invalidate_document(doc_id, user_id)
+    progress.publish(user_id, doc_id, filename, status=fields['processing_status'],
+                     percent=100 if fields['processing_status'] == 'COMPLETED' else None,
+                     tags=tags_list if fields.get('ai_status') == 'COMPLETED' else None,
+                     # A branch that was not re-run had already completed
+                     storage_status=fields.get('storage_status', 'COMPLETED'),
+                     ai_status=fields.get('ai_status', 'COMPLETED'))
+    return storage_error, ai_error
+
+
+def _failure_message(storage_error, ai_error):
+    parts = []
+    if storage_error:
+        parts.append(f"the storage upload failed ({storage_error})")
+    if ai_error:
+        parts.append(f"AI processing failed ({ai_error})")
+    return f"The document was saved, but {' and '.join(parts)}. You can retry it from the dashboard."
+
+
+def ingest_file(user_id, upload, on_stage=None) -> int:
+    """
+    Runs one spooled upload through the pipeline and returns the new document
+    id. The documents row is created first; storage and AI/indexing then run
+    as independent branches. If either fails the file is kept for
+    retry_document() and IngestionError is raised.
+    on_stage(name) is called as the file enters each AI stage.
+    """
+    filename = os.path.basename(upload.filename)
+    public_id = generate_unique_public_id(filename)
+
+    # The url is filled in once the storage branch has finished
+    new_doc_id = database.add_document(user_id, filename, '', public_id, None, None)
+    if not new_doc_id:
+        raise IngestionError('Failed to save file information to the database.')
+    database.update_document_status(new_doc_id, 'PROCESSING')
+    cache.invalidate_user(user_id)
+    progress.publish(user_id, new_doc_id, filename, stage="queued", percent=0)
+
+    storage_error, ai_error = _run_branches(new_doc_id, user_id, upload.path, filename, public_id,
+                                               on_stage=on_stage)
+    if storage_error or ai_error:
+        os.makedirs(RETRY_DIR, exist_ok=True)
+        os.replace(upload.path, _retry_path(new_doc_id))
+        upload.path = None
+        raise IngestionError(_failure_message(storage_error, ai_error))
+    return new_doc_id
+
+
+def retry_document(document) -> int:
+    """
+    Re-runs only the failed branch(es) of a FAILED document, using the copy of
+    the file kept when it first failed.
+    """
+    doc_id = document['id']
+    path = _retry_path(doc_id)
+    if not os.path.exists(path):
+        raise IngestionError("The original file is no longer available. Please upload it again.")
+
+    run_storage = document['storage_status'] != 'COMPLETED'
+    run_ai = document['ai_status'] != 'COMPLETED'
+    if run_ai:
+        # Drop whatever a half-finished indexing run left behind
+        vector_store.delete_document_chunks(doc_id)
+
+    database.update_document_status(doc_id, 'PROCESSING')
+    cache.invalidate_document(doc_id, document['user_id'])
+    progress.publish(document['user_id'], doc_id, document['filename'], stage="queued", percent=0)
+    storage_error, ai_error = _run_branches(
+        doc_id, document['user_id'], path, document['filename'], document['public_id'],
+        run_storage=run_storage, run_ai=run_ai
+    )
+    if storage_error or ai_error:
+        raise IngestionError(_failure_message(storage_error, ai_error))
+
+    os.remove(path)
+    return doc_id
+
+
+# --- Batches ---
+
+class Batch:
+    """Progress of one multi-file or zip upload."""
+
+    def __init__(self, user_id):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.items = []
+        self.started_at = time.time()
+        self.finished_at = None
+        self.feeding = True
+        self.lock = threading.Lock()
+
+    def add_item(self, filename, status="queued", error=None):
+        with self.lock:
+            item = {"filename": filename, "status": status, "stage": None, "doc_id": None, "error": error}
+            self.items.append(item)
+        self.share()
+        return item
+
+    def update(self, item, **changes):
+        with self.lock:
+            item.update(changes)
+            self._check_finished()
+        self.share()
+
+    def done_feeding(self):
+        with self.lock:
+            self.feeding = False
+            self._check_finished()
+        self.share()
+
+    def share(self):
+        """Publishes the progress to the shared cache, for the other worker processes."""
+        if cache.is_shared():
+            cache.set_shared(f"batch:{self.id}", (self.user_id, self.to_dict()), BATCH_SHARED_TTL)
+
+    def _check_finished(self):
+        if not self.feeding and self.finished_at is None and \
+                all(item["status"] in ("completed", "failed", "skipped") for item in self.items):
+            self.finished_at = time.time()
+            logger.info("Batch %s finished: %s", self.id, self.summary_counts())
+
+    def summary_counts(self) -> dict:
+        counts = {"queued": 0, "processing": 0, "completed": 0, "failed": 0, "skipped": 0}
+        for item in self.items:
+            counts[item["status"]] += 1
+        return counts
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            counts = self.summary_counts()
+            elapsed = (self.finished_at or time.time()) - self.started_at
+            return {
+                "batch_id": self.id,
+                "status": "completed" if self.finished_at else "running",
+                "total": len(self.items),
+                **counts,
+                "elapsed_seconds": round(elapsed, 1),
+                "docs_per_min": round(counts["completed"] / elapsed * 60, 2) if elapsed > 0 else 0.0,
+                "items": [dict(item) for item in self.items],
+            }
+
+
+_batches = {}
+_batches_lock = threading.Lock()
+# Shared by every batch; the per-stage semaphores decide what actually runs.
+_file_pool = ThreadPoolExecutor(max_workers=max(BATCH_IN_FLIGHT, 1), thread_name_prefix="ingest")
+
+
+def get_batch(batch_id):
+    with _batches_lock:
+        return _batches.get(batch_id)
+
+
+def get_batch_status(batch_id, user_id):
+    """
+    Progress of one of the user's batches (Batch.to_dict()), or None. Batches
+    run in the worker process that accepted them; the others read the copy
+    in the shared cache.
+    """
+    batch = get_batch(batch_id)
+    if batch is not None:
+        return batch.to_dict() if batch.user_id == user_id else None
+    shared = cache.get_shared(f"batch:{batch_id}")
+    if shared is None or shared[0] != user_id:
+        return None
+    return shared[1]
+
+
+def _register(batch):
+    with _batches_lock:
+        _batches[batch.id] = batch
+        finished = sorted((b for b in _batches.values() if b.finished_at), key=lambda b: b.finished_at)
+        while len(_batches) > BATCH_HISTORY and finished:
+            del _batches[finished.pop(0).id]
+
+
+def _iter_sources(uploads, archives):
+    """
+    Yields (filename, spooled upload or None, error) for every file and every
+    supported file inside the zips; the upload is None when the file is
+    skipped, with the reason in error. Zip members are spooled at most
+    ZIP_MEMBER_MAX_BYTES each and ZIP_BATCH_MAX_BYTES in total, counting the
+    bytes actually read rather than the sizes the archive claims. Uploads and
+    archives not reached when iteration stops early are cleaned up.
+    """
+    uploads, archives = list(uploads), list(archives)
+    budget = ZIP_BATCH_MAX_BYTES
+    try:
+        while uploads:
+            upload = uploads.pop(0)
+            yield upload.filename, upload, None
+        while archives:
+            archive = archives.pop(0)
+            try:
+                with zipfile.ZipFile(archive.path) as zf:
+                    for info in zf.infolist():
+                        name = info.filename
+                        if info.is_dir() or name.startswith("__MACOSX/"):
+                            continue
+                        if not allowed_file(name):
+                            yield name, None, "Unsupported file type."
+                            continue
+                        limit = min(ZIP_MEMBER_MAX_BYTES, budget)
+                        if info.file_size > limit:
+                            yield name, None, "File is too large once unpacked."
+                            continue
+                        try:
+                            with zf.open(info) as member:
+                                upload = processing.SpooledUpload.from_stream(member, name, max_bytes=limit)
+                        except processing.UploadTooLarge:
+                            yield name, None, "File is too large once unpacked."
+                            continue
+                        budget -= upload.size
+                        yield name, upload, None
+            except zipfile.BadZipFile:
+                yield archive.filename, None, "Not a valid zip archive."
+            finally:
+                archive.cleanup()
+    finally:
+        # Only reached with sources left when the batch stopped early
+        for source in uploads + archives:
+            source.cleanup()
+
+
+def start_batch(user_id, uploads, archives, skipped=()) -> Batch:
+    """
+    Ingests spooled uploads plus every supported file inside the spooled zip archives
+    in the background and returns the Batch to poll. `skipped` names files
+    the caller already rejected, so they show up in the progress report. Zip members are spooled
+    lazily, at most BATCH_IN_FLIGHT at a time, so large archives never have to
+    be unpacked up front. The batch owns the spooled files from here on.
+    """
+    batch = Batch(user_id)
+    for filename in skipped:
+        batch.add_item(filename, status="skipped", error="Unsupported file type.")
+    _register(batch)
+    in_flight = threading.BoundedSemaphore(max(BATCH_IN_FLIGHT, 1))
+
+    def run_one(item, upload):
+        try:
+            batch.update(item, status="processing")
+            doc_id = ingest_file(user_id, upload, on_stage=lambda stage: batch.update(item, stage=stage))
+            batch.update(item, status="completed", stage=None, doc_id=doc_id)
+        except Exception as e:
+            logger.error("Batch %s: failed to ingest %s: %s", batch.id, item["filename"], e)
+            batch.update(item, status="failed", error=str(e))
+        finally:
+            upload.cleanup()
+            in_flight.release()
+
+    def feed():
+        sources = _iter_sources(uploads, archives)
+        try:
+            for filename, upload, error in sources:
+                if upload is None:
+                    batch.add_item(filename, status="skipped", error=error)
+                    continue
+                in_flight.acquire()
+                _file_pool.submit(run_one, batch.add_item(filename), upload)
+        except Exception as e:
+            logger.error("Batch %s: stopped reading uploads: %s", batch.id, e)
+        finally:
+            # Cleans up whatever was not yet handed to a worker
+            sources.close()
+            batch.done_feeding()
+
+    threading.Thread(target=feed, name=f"batch-{batch.id[:8]}", daemon=True).start()
+    return batch
@@ -1,7 +1,11 @@
 import os
-from pymongo import MongoClient
+from datetime import datetime, timedelta
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReturnDocument
 from pymongo.errors import ConnectionFailure
 from dotenv import load_dotenv
+import telemetry
+
+logger = telemetry.get_logger(__name__)
 
 # Load variables from .env file
 load_dotenv()
@@ -23,59 +27,172 @@ try:
     # Get the database
     db = client[MONGO_DB_NAME]
     
-    # Get the collection (like a table) where histories will be stored
+    # Legacy layout: one document per document id with an ever-growing 'messages'
+    # array. Only cleared by migrate_legacy_histories().
     chat_history_collection = db["chat_histories"]
 
-    print("Successfully connected to MongoDB Atlas.")
+    # Current layout: one document per message, read back by (session_id, ts).
+    chat_messages_collection = db["chat_messages"]
+
+    # One small document per chat session holding its message count and last activity.
+    chat_sessions_collection = db["chat_sessions"]
+
+    logger.info("Successfully connected to MongoDB Atlas.")
 
 except ConnectionFailure as e:
-    print(f"Could not connect to MongoDB: {e}")
+    logger.warning("Could not connect to MongoDB: %s", e)
     # You might want to exit the app if the DB connection fails
     # sys.exit(1) 
 except Exception as e:
-    print(f"An error occurred during DB initialization: {e}")
+    logger.error("An error occurred during DB initialization: %s", e)
 # --- End of Connection ---
 
 
+# How many recent messages a chat turn reads back by default.
+CHAT_HISTORY_LIMIT = int(os.getenv("CHAT_HISTORY_LIMIT", 20))
+# Sessions (and their messages) idle for longer than this are removed by Mongo's TTL monitor.
+CHAT_SESSION_TTL_SECONDS = int(os.getenv("CHAT_SESSION_TTL_SECONDS", 7 * 24 * 3600))
+# A session's messages have their expiry pushed back at most this often, so a
+# message can expire up to this long before the session has been idle for the full TTL.
+CHAT_SESSION_REFRESH_SECONDS = CHAT_SESSION_TTL_SECONDS // 10
+# Hard cap on stored messages per session; the oldest are trimmed at write time.
+CHAT_SESSION_MAX_MESSAGES = int(os.getenv("CHAT_SESSION_MAX_MESSAGES", 200))
+
+
+def chat_session_key(user_id, doc_id, chat_session: str) -> str:
+    """Builds the session_id for one user's chat about one document."""
+    return f"{user_id}:{doc_id}:{chat_session}"
+
+
+def init_chat_store():
+    """
+    Creates the indexes the chat history queries rely on and drops any
+    sessions still stored in the legacy layout. Safe to call on every start.
+    """
+    try:
+        chat_messages_collection.create_index(
+            [("session_id", ASCENDING), ("ts", ASCENDING)],
+            name="session_ts"
+        )
+        # Messages expire with their session's last activity, not their own
+        # write time, so an active session never loses its early messages.
+        # 'active' is refreshed for the whole session by _record_session_writes().
+        if "ts_ttl" in chat_messages_collection.index_information():
+            # Messages written before 'active' existed start from their own time
+            chat_messages_collection.update_many({"active": {"$exists": False}}, [{"$set": {"active": "$ts"}}])
+            chat_messages_collection.drop_index("ts_ttl")
+        chat_messages_collection.create_index(
+            "active", name="active_ttl", expireAfterSeconds=CHAT_SESSION_TTL_SECONDS
+        )
+        chat_sessions_collection.create_index(
+            "last_active", name="last_active_ttl", expireAfterSeconds=CHAT_SESSION_TTL_SECONDS
+        )
+        migrate_legacy_histories()
+    except Exception as e:
+        logger.error("Error initialising chat history store: %s", e)
+
+
+@telemetry.timed("mongo.write")
 def save_message_to_history(session_id: str, role: str, content: str):
     """
     Saves a single message (from user or assistant) to a chat history.
-    
-    If the session_id doesn't exist, it creates a new document.
-    If it does exist, it appends the message to the 'messages' array.
+    Each message is its own document, so a session never grows one record.
     """
     try:
-        # The message to be added
-        message = {"role": role, "content": content}
-        
-        # Find document by session_id and add the message to the 'messages' array
-        # 'upsert=True' creates the document if it doesn't exist.
-        chat_history_collection.update_one(
-            {"session_id": session_id},
-            {"$push": {"messages": message}},
-            upsert=True
-        )
-        print(f"Saved message for session: {session_id}")
+        now = datetime.utcnow()
+        chat_messages_collection.insert_one({
+            "session_id": session_id,
+            "role": role,
+            "content": content,
+            "ts": now,
+            "active": now,
+        })
+        _record_session_writes(session_id, 1)
+        logger.debug("Saved message for session: %s", session_id)
     except Exception as e:
-        print(f"Error saving message: {e}")
+        logger.error("Error saving message: %s", e)
+
+@telemetry.timed("mongo.write")
+def save_exchange_to_history(session_id: str, user_content: str, assistant_content: str):
+    """
+    Saves a user question and the assistant's reply in a single round trip.
+    The reply gets a later timestamp so the pair always reads back in order.
+    """
+    try:
+        now = datetime.utcnow()
+        chat_messages_collection.insert_many([
+            {"session_id": session_id, "role": "user", "content": user_content, "ts": now, "active": now},
+            {"session_id": session_id, "role": "assistant", "content": assistant_content,
+             "ts": now + timedelta(milliseconds=1), "active": now},
+        ], ordered=True)
+        _record_session_writes(session_id, 2)
+        logger.debug("Saved exchange for session: %s", session_id)
+    except Exception as e:
+        logger.error("Error saving exchange: %s", e)
+
+def _record_session_writes(session_id: str, added: int):
+    """
+    Bumps the session's message count and last activity, pushes back the
+    expiry of its older messages (at most every CHAT_SESSION_REFRESH_SECONDS),
+    then trims the oldest messages if the session has gone over
+    CHAT_SESSION_MAX_MESSAGES.
+    """
+    now = datetime.utcnow()
+    chat_session = chat_sessions_collection.find_one_and_update(
+        {"_id": session_id},
+        {"$inc": {"message_count": added}, "$set": {"last_active": now}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
 
-def get_chat_history(session_id: str) -> list:
+    refreshed = chat_session.get("messages_refreshed")
+    if refreshed is None or now - refreshed > timedelta(seconds=CHAT_SESSION_REFRESH_SECONDS):
+        chat_messages_collection.update_many({"session_id": session_id}, {"$set": {"active": now}})
+        chat_sessions_collection.update_one({"_id": session_id}, {"$set": {"messages_refreshed": now}})
+
+    overflow = chat_session.get("message_count", 0) - CHAT_SESSION_MAX_MESSAGES
+    if overflow <= 0:
+        return
+
+    oldest_ids = [
+        message["_id"] for message in chat_messages_collection.find(
+            {"session_id": session_id}, {"_id": 1}
+        ).sort("ts", ASCENDING).limit(overflow)
+    ]
+    if oldest_ids:
+        removed = chat_messages_collection.delete_many({"_id": {"$in": oldest_ids}}).deleted_count
+        chat_sessions_collection.update_one({"_id": session_id}, {"$inc": {"message_count": -removed}})
+
+@telemetry.timed("mongo.read")
+def get_chat_history(session_id: str, limit: int = CHAT_HISTORY_LIMIT) -> list:
     """
-    Retrieves the full chat history (the 'messages' array) for a session.
+    Retrieves the most recent messages for a session, oldest first.
     Returns an empty list if the session is not found.
     """
     try:
-        history_doc = chat_history_collection.find_one(
-            {"session_id": session_id}
-        )
-        
-        if history_doc:
-            # Return just the 'messages' array, or [] if it doesn't exist
-            return history_doc.get("messages", [])
-        else:
-            # No history found for this session
-            return []
+        # Walk the (session_id, ts) index backwards so only the tail is read.
+        cursor = chat_messages_collection.find(
+            {"session_id": session_id},
+            {"_id": 0, "role": 1, "content": 1}
+        ).sort("ts", DESCENDING).limit(limit)
+
+        messages = list(cursor)
+        messages.reverse()
+        return messages
             
     except Exception as e:
-        print(f"Error retrieving history: {e}")
-        return []
\ No newline at end of file
+        logger.error("Error retrieving history: %s", e)
+        return []
+
+def migrate_legacy_histories():
+    """
+    Removes sessions stored in the legacy layout (one document per document id
+    with a 'messages' array). They are dropped rather than converted: their
+    session_id is the bare document id, shared by every login, while history
+    is now read per user and login session (see chat_session_key), so converted
+    messages could never be read again. Deleting is idempotent, so an
+    interrupted start simply finishes the job on the next one.
+    """
+    removed = chat_history_collection.delete_many({"messages": {"$exists": True}}).deleted_count
+    if removed:
+        logger.info("Dropped %s legacy chat histories (keyed by document only; not readable per session).", removed)
@@ -0,0 +1,194 @@
+"""
+OCR for PDF pages without a text layer (scans, photographed pages).
+
+Only pages whose extracted text is (nearly) empty and that show an image are
+read. Each one is rendered with pdf2image at OCR_DPI and read by a locally
+installed Tesseract, one page per task in a process pool. Results are cached
+on disk under a hash of the page's content, so a scan that is uploaded again
+or re-indexed is not read twice.
+"""
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack, contextmanager
+
+import telemetry
+
+try:
+    import pdf2image
+    import pytesseract
+except ImportError:
+    pdf2image = None
+    pytesseract = None
+
+logger = telemetry.get_logger(__name__)
+
+# --- OCR settings ---
+OCR_ENABLED = os.getenv("OCR_ENABLED", "true").lower() in ("1", "true", "yes")
+OCR_DPI = int(os.getenv("OCR_DPI", 300))
+OCR_LANG = os.getenv("OCR_LANG", "eng")
+# Pages with fewer characters of text than this are treated as scanned
+OCR_MIN_CHARS = int(os.getenv("OCR_MIN_CHARS", 20))
+# Processes rendering and reading pages; each holds one rendered page in memory
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+OCR_PAGE_TIMEOUT = int(os.getenv("OCR_PAGE_TIMEOUT", 120))
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", "./ocr_cache")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def available() -> bool:
+    """True if OCR is enabled and pdf2image, pytesseract and the tesseract binary are installed."""
+    if not OCR_ENABLED or pytesseract is None or pdf2image is None:
+        return False
+    return shutil.which(pytesseract.pytesseract.tesseract_cmd) is not None
+
+
+def needs_ocr(page, text: str) -> bool:
+    """A page needs OCR when it has (almost) no text but does show an image."""
+    return len(text.strip()) < OCR_MIN_CHARS and bool(page.get_images())
+
+
+def page_key(doc, page) -> str:
+    """
+    Hash of what a page looks like: its content stream, the raw bytes of the
+    images it draws, its geometry and the OCR settings. Identical pages in
+    different files share a key.
+    """
+    digest = hashlib.sha256(f"{OCR_DPI}|{OCR_LANG}|{page.rect}|{page.rotation}|".encode())
+    digest.update(page.read_contents())
+    for image in page.get_images(full=True):
+        digest.update(doc.xref_stream_raw(image[0]) or b"")
+    return digest.hexdigest()
+
+
+def _cache_path(key):
+    return os.path.join(OCR_CACHE_DIR, key[:2], f"{key}.txt")
+
+
+def _cache_get(key):
+    try:
+        with open(_cache_path(key), encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _cache_put(key, text):
+    path = _cache_path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Could not cache OCR text for page %s: %s", key, e)
+
+
+def _get_pool():
+    """
+    Workers are spawned, not forked: a fork would copy this process with its
+    loaded model, MySQL/Mongo connections and whatever locks other threads hold
+    at that moment. Spawned workers start a fresh interpreter and import only
+    what they need (plus the entry script, which is gunicorn's in production).
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=OCR_WORKERS,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        _pool = None
+
+
+def _ocr_page(pdf_path, page_number, dpi, lang) -> str:
+    """Runs in a pool process: renders one page and reads it."""
+    images = pdf2image.convert_from_path(pdf_path, dpi=dpi, first_page=page_number + 1,
+                                         last_page=page_number + 1, grayscale=True)
+    return "\n".join(pytesseract.image_to_string(image, lang=lang).strip() for image in images) + "\n"
+
+
+@contextmanager
+def _as_path(source):
+    """pdf2image reads from a file; raw bytes are written to a temp file first."""
+    if not isinstance(source, (bytes, bytearray)):
+        yield source
+        return
+    fd, tmp_path = tempfile.mkstemp(suffix=".pdf", prefix="ocr_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(source)
+        yield tmp_path
+    finally:
+        os.remove(tmp_path)
+
+
+class PageReader:
+    """
+    OCRs the scanned pages of one PDF while the rest is still being read:
+    submit() starts a page in the pool (or answers it from the cache) and
+    text() waits for it. Use it as a context manager, so the temp copy of an
+    in-memory PDF is removed at the end.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self._stack = ExitStack()
+        self._path = None
+        self._available = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._stack.close()
+
+    def submit(self, number, key):
+        """Starts reading page `number` (0-based) with page_key() `key`; returns a handle for text()."""
+        cached = _cache_get(key)
+        if cached is not None:
+            return number, key, cached
+        if self._available is None:
+            self._available = available()
+            if not self._available:
+                logger.warning("Pages without a text layer found, but OCR is unavailable "
+                               "(needs pdf2image, pytesseract and the tesseract binary).")
+        if not self._available:
+            return number, key, None
+        if self._path is None:
+            self._path = self._stack.enter_context(_as_path(self.source))
+        return number, key, _get_pool().submit(_ocr_page, self._path, number, OCR_DPI, OCR_LANG)
+
+    def done(self, handle) -> bool:
+        """True once text() would return without waiting."""
+        return not isinstance(handle[2], Future) or handle[2].done()
+
+    def text(self, handle):
+        """The page's text, or None if it could not be read."""
+        number, key, result = handle
+        if not isinstance(result, Future):
+            return result
+        try:
+            with telemetry.timed("pdf.ocr"):
+                text = result.result(timeout=OCR_PAGE_TIMEOUT)
+        except BrokenProcessPool as e:
+            logger.error("OCR worker pool died: %s", e)
+            _reset_pool()
+            return None
+        except Exception as e:
+            logger.warning("OCR of page %s failed: %s", number + 1, e)
+            return None
+        _cache_put(key, text)
+        return text
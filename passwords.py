@@ -0,0 +1,304 @@
+"""
+Password hashing and login throttling.
+
+bcrypt is slow on purpose, so it does not run on the request thread. It runs
+on a pool of PASSWORD_HASH_WORKERS threads (bcrypt releases the GIL while it
+works). A burst of logins can then occupy at most that many cores, and the
+chat and search requests served by the same process keep the rest. At most
+PASSWORD_HASH_QUEUE jobs may wait for a thread. Beyond that, callers get
+PasswordHasherBusy straight away rather than piling up behind the flood.
+
+BCRYPT_ROUNDS sets the cost of new hashes. A stored hash with a different
+cost is replaced with one at the current cost the next time its owner logs
+in (verify_password returns the new hash).
+
+Login attempts are throttled before any of that work is done. Each client IP
+gets LOGIN_ATTEMPTS_PER_IP attempts per LOGIN_THROTTLE_WINDOW. Each account
+gets LOGIN_FAILURES_PER_ACCOUNT failed attempts in that window, and a
+successful login resets its count. Password reset requests are throttled
+the same way: RESET_REQUESTS_PER_IP per window and client, and at most
+RESET_EMAILS_PER_ACCOUNT reset emails per address and hour, checked before a
+token is issued. The counters are kept in Redis when
+VIEW_CACHE_URL is set, so every worker process counts the same attempts;
+otherwise they are kept per process.
+"""
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import bcrypt
+
+import telemetry
+from cache import VIEW_CACHE_URL
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = telemetry.get_logger(__name__)
+
+# --- Hashing settings ---
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+# Hash jobs allowed to wait for a worker before new ones are turned away
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", 32))
+PASSWORD_HASH_TIMEOUT = float(os.getenv("PASSWORD_HASH_TIMEOUT", 10))
+
+# --- Throttling settings ---
+LOGIN_THROTTLE_WINDOW = int(os.getenv("LOGIN_THROTTLE_WINDOW", 900))
+LOGIN_ATTEMPTS_PER_IP = int(os.getenv("LOGIN_ATTEMPTS_PER_IP", 50))
+LOGIN_FAILURES_PER_ACCOUNT = int(os.getenv("LOGIN_FAILURES_PER_ACCOUNT", 5))
+RESET_REQUESTS_PER_IP = int(os.getenv("RESET_REQUESTS_PER_IP", 10))
+RESET_EMAILS_PER_ACCOUNT = int(os.getenv("RESET_EMAILS_PER_ACCOUNT", 3))
+RESET_EMAIL_WINDOW = 3600
+# ------------------------------------------
+
+# bcrypt only looks at the first 72 bytes; bcrypt>=5 raises instead of ignoring the rest
+_MAX_PASSWORD_BYTES = 72
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many hash jobs are already waiting for a worker, or one took too long."""
+
+
+def _encode(password) -> bytes:
+    return password.encode("utf-8")[:_MAX_PASSWORD_BYTES]
+
+
+def hash_rounds(password_hash) -> int:
+    """The cost a stored hash was made with, e.g. 12 for '$2b$12$...'."""
+    try:
+        return int(password_hash.split("$")[2])
+    except (AttributeError, IndexError, ValueError):
+        return 0
+
+
+class PasswordHasher:
+    """Runs bcrypt on a bounded pool of worker threads."""
+
+    def __init__(self, rounds=BCRYPT_ROUNDS, workers=PASSWORD_HASH_WORKERS,
+                 max_waiting=PASSWORD_HASH_QUEUE, timeout=PASSWORD_HASH_TIMEOUT):
+        self.rounds = rounds
+        self.timeout = timeout
+        self.rejected = 0
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._slots = threading.BoundedSemaphore(workers + max_waiting)
+        self._dummy_hash = None
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            telemetry.set_gauge("intellidocs_bcrypt_rejected_total", self.rejected)
+            raise PasswordHasherBusy()
+        try:
+            future = self._pool.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            # The job keeps its slot until it finishes; the caller answers 503
+            raise PasswordHasherBusy() from None
+
+    def _hash(self, password) -> str:
+        with telemetry.timed("bcrypt.hash"):
+            return bcrypt.hashpw(_encode(password), bcrypt.gensalt(self.rounds)).decode("utf-8")
+
+    def _check(self, password_hash, password):
+        with telemetry.timed("bcrypt.check"):
+            ok = bcrypt.checkpw(_encode(password), password_hash.encode("utf-8"))
+        if ok and hash_rounds(password_hash) != self.rounds:
+            return ok, self._hash(password)
+        return ok, None
+
+    def hash(self, password) -> str:
+        return self._run(self._hash, password)
+
+    def verify(self, password_hash, password) -> tuple:
+        """
+        (matches, new_hash). new_hash is set when the password matched but the
+        stored hash has a different cost; store it in place of the old one.
+        With no stored hash (unknown account) a dummy hash is checked, so the
+        answer takes as long as for a real account.
+        """
+        if not password_hash:
+            if self._dummy_hash is None:
+                self._dummy_hash = self._run(self._hash, os.urandom(16).hex())
+            self._run(self._check, self._dummy_hash, password)
+            return False, None
+        try:
+            return self._run(self._check, password_hash, password)
+        except ValueError as e:
+            logger.error("Unreadable password hash: %s", e)
+            return False, None
+
+
+class Throttle:
+    """Sliding-window event counts per key, kept in this process."""
+
+    def __init__(self, limit, window=LOGIN_THROTTLE_WINDOW):
+        self.limit = limit
+        self.window = window
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def _recent(self, key, now):
+        events = self._events.get(key)
+        if events is None:
+            return ()
+        while events and events[0] <= now - self.window:
+            events.popleft()
+        if not events:
+            del self._events[key]
+        return events
+
+    def retry_after(self, key) -> float:
+        """Seconds until `key` may try again; 0 when it is under the limit."""
+        now = time.monotonic()
+        with self._lock:
+            events = self._recent(key, now)
+            if len(events) < self.limit:
+                return 0
+            return events[0] + self.window - now
+
+    def hit(self, key):
+        now = time.monotonic()
+        with self._lock:
+            self._events.setdefault(key, deque()).append(now)
+            if len(self._events) > 100000:
+                for stale in [k for k, v in self._events.items() if v[-1] <= now - self.window]:
+                    del self._events[stale]
+
+    def reset(self, key):
+        with self._lock:
+            self._events.pop(key, None)
+
+
+class RedisThrottle:
+    """
+    Sliding-window event counts per key, kept in Redis (a sorted set of event
+    times per key) so every worker process shares them. If Redis cannot be
+    reached, attempts are let through rather than locking everyone out.
+    """
+
+    def __init__(self, name, limit, window=LOGIN_THROTTLE_WINDOW, url=VIEW_CACHE_URL):
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self._client = redis.Redis.from_url(url)
+
+    def _key(self, key) -> str:
+        return f"throttle:{self.name}:{key}"
+
+    def retry_after(self, key) -> float:
+        """Seconds until `key` may try again; 0 when it is under the limit."""
+        now = time.time()
+        try:
+            pipe = self._client.pipeline()
+            pipe.zremrangebyscore(self._key(key), 0, now - self.window)
+            pipe.zrange(self._key(key), 0, 0, withscores=True)
+            pipe.zcard(self._key(key))
+            _, oldest, count = pipe.execute()
+        except Exception as e:
+            logger.warning("Login throttle %s unavailable: %s", self.name, e)
+            return 0
+        if count < self.limit or not oldest:
+            return 0
+        return max(oldest[0][1] + self.window - now, 0)
+
+    def hit(self, key):
+        now = time.time()
+        try:
+            pipe = self._client.pipeline()
+            pipe.zadd(self._key(key), {f"{now}:{uuid.uuid4().hex[:8]}": now})
+            pipe.expire(self._key(key), self.window)
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Login throttle %s unavailable: %s", self.name, e)
+
+    def reset(self, key):
+        try:
+            self._client.delete(self._key(key))
+        except Exception as e:
+            logger.warning("Login throttle %s unavailable: %s", self.name, e)
+
+
+def create_throttle(name, limit, window=LOGIN_THROTTLE_WINDOW):
+    """A RedisThrottle when VIEW_CACHE_URL is set (and redis is installed), else a per-process Throttle."""
+    if VIEW_CACHE_URL and redis is not None:
+        return RedisThrottle(name, limit, window)
+    return Throttle(limit, window)
+
+
+hasher = PasswordHasher()
+_ip_attempts = create_throttle("login_ip", LOGIN_ATTEMPTS_PER_IP)
+_account_failures = create_throttle("login_account", LOGIN_FAILURES_PER_ACCOUNT)
+_reset_requests = create_throttle("reset_ip", RESET_REQUESTS_PER_IP)
+_reset_emails = create_throttle("reset_account", RESET_EMAILS_PER_ACCOUNT, RESET_EMAIL_WINDOW)
+
+
+def _account_key(email) -> str:
+    return (email or "").strip().lower()
+
+
+def hash_password(password) -> str:
+    """bcrypt hash at the current cost. Raises PasswordHasherBusy when the pool is saturated."""
+    return hasher.hash(password)
+
+
+def verify_password(password_hash, password) -> tuple:
+    """(matches, new_hash); see PasswordHasher.verify. Raises PasswordHasherBusy."""
+    return hasher.verify(password_hash, password)
+
+
+def login_retry_after(ip, email=None) -> int:
+    """
+    Whole seconds the client must wait before trying again, or 0. Counts the
+    attempt against the IP when it is let through, so call it once per attempt
+    and before any hashing.
+    """
+    wait = _ip_attempts.retry_after(ip)
+    if email is not None:
+        wait = max(wait, _account_failures.retry_after(_account_key(email)))
+    if wait:
+        logger.info("Throttled login attempt from %s for %s.", ip, email)
+        return int(wait) + 1
+    _ip_attempts.hit(ip)
+    return 0
+
+
+def record_login(email, succeeded):
+    """Counts a failed attempt against the account, or clears its count after a success."""
+    if succeeded:
+        _account_failures.reset(_account_key(email))
+    else:
+        _account_failures.hit(_account_key(email))
+
+
+def reset_retry_after(ip) -> int:
+    """Like login_retry_after, for password reset requests from one client."""
+    wait = _reset_requests.retry_after(ip)
+    if wait:
+        logger.info("Throttled password reset request from %s.", ip)
+        return int(wait) + 1
+    _reset_requests.hit(ip)
+    return 0
+
+
+def allow_reset_email(email) -> bool:
+    """
+    True if the address may get another reset email this hour, and counts it.
+    Call it before issuing a token, so a refused request leaves no token behind.
+    """
+    key = _account_key(email)
+    if _reset_emails.retry_after(key):
+        logger.info("Not issuing a reset token for %s: over %s per hour.", key, RESET_EMAILS_PER_ACCOUNT)
+        return False
+    _reset_emails.hit(key)
+    return True
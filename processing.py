@@ -1,54 +1,357 @@
-import fitz
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import numpy as np
+
 import vector_store
 import database
+import ai_utils
+import cache
+import extractors
+import telemetry
+
+logger = telemetry.get_logger(__name__)
+
+# Uploads are spooled here once and every later stage reads the file by path.
+UPLOAD_TMP_DIR = os.getenv("UPLOAD_TMP_DIR", tempfile.gettempdir())
+SPOOL_CHUNK_SIZE = 1024 * 1024
+
+# --- Chunking ---
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE_WORDS", 300))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP_WORDS", 50))
+# Chunks are stored under an index version naming how they were cut and
+# embedded. Changing either half makes reindex.py rebuild every document.
+CHUNKER_VERSION = f"words-{CHUNK_SIZE}-{CHUNK_OVERLAP}"
+INDEX_VERSION = f"{CHUNKER_VERSION}|{vector_store.EMBEDDING_MODEL_NAME}"
+# Leading characters of a document kept for the tag and summary prompts
+LLM_TEXT_CHARS = 16000
+
+# --- Precomputed insights ---
+# Suggested questions (with answers) and section summaries are worked out in
+# the background after a document is indexed; see precompute_insights().
+INSIGHTS_ENABLED = os.getenv("INSIGHTS_ENABLED", "true").lower() in ("1", "true", "yes")
+# Document-specific questions generated on top of the overview and key points
+INSIGHT_QUESTIONS = int(os.getenv("INSIGHT_QUESTIONS", 3))
+# A section is about this many words (the section prompt keeps ~8000 characters)
+INSIGHT_SECTION_WORDS = int(os.getenv("INSIGHT_SECTION_WORDS", 1200))
+# Longer documents get fewer, larger sections rather than more LLM calls
+INSIGHT_MAX_SECTIONS = int(os.getenv("INSIGHT_MAX_SECTIONS", 8))
+# Documents waiting for insights; beyond this new ones are skipped
+INSIGHT_QUEUE = int(os.getenv("INSIGHT_QUEUE", 64))
+
+# Fixed questions, answered from the summary and the section summaries. Each
+# is matched in rag.py by any of its phrasings; the first one is shown.
+OVERVIEW_QUESTIONS = ("What is this document about?", "Give me an overview of this document.",
+                      "Summarize this document.")
+KEY_POINT_QUESTIONS = ("What are the key points?", "What are the main takeaways of this document?",
+                       "List the most important points in this document.")
+
+
+class UploadTooLarge(ValueError):
+    """A stream being spooled went past the byte limit it was given."""
+
+
+class SpooledUpload:
+    """
+    An uploaded file copied to a private temp file in fixed-size chunks, so the
+    request never holds the whole file in memory. The temp file belongs to the
+    ingestion job and is removed by cleanup() (or on leaving a `with` block).
+    """
+
+    def __init__(self, file_storage, suffix=None):
+        self._spool(file_storage.filename, file_storage.save, suffix)
+
+    @classmethod
+    def from_stream(cls, stream, filename, suffix=None, max_bytes=None):
+        """
+        Spools any readable binary stream, e.g. a member of a zip archive.
+        With max_bytes, the copy stops and UploadTooLarge is raised as soon as
+        the stream yields more than that, whatever size it claimed to have.
+        """
+        def write_to(out):
+            if max_bytes is None:
+                shutil.copyfileobj(stream, out, SPOOL_CHUNK_SIZE)
+                return
+            written = 0
+            while True:
+                block = stream.read(min(SPOOL_CHUNK_SIZE, max_bytes - written + 1))
+                if not block:
+                    return
+                written += len(block)
+                if written > max_bytes:
+                    raise UploadTooLarge(f"{filename} is larger than {max_bytes} bytes.")
+                out.write(block)
+
+        upload = cls.__new__(cls)
+        upload._spool(filename, write_to, suffix)
+        return upload
 
+    def _spool(self, filename, write_to, suffix):
+        self.filename = filename
+        if suffix is None:
+            suffix = os.path.splitext(filename or "")[1].lower()
+        fd, self.path = tempfile.mkstemp(suffix=suffix, prefix="upload_", dir=UPLOAD_TMP_DIR)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                write_to(out)
+        except Exception:
+            self.cleanup()
+            raise
+        self.size = os.path.getsize(self.path)
 
-def extract_text_from_pdf(file_bytes:bytes) ->str:
-    text_content=" "
+    def cleanup(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cleanup()
+
+
+def _extractor_for(source, filename):
+    extractor = extractors.lookup(filename or (source if isinstance(source, str) else None))
+    if extractor is None:
+        raise ValueError(f"Unsupported file type: {filename or 'document'}")
+    return extractor
+
+
+def _extractor_name(source, filename):
     try:
-        with fitz.open(stream=file_bytes, filetype="pdf") as doc:
-            for page in doc:
-                text_content += page.get_text()
+        return _extractor_for(source, filename).name
+    except ValueError:
+        return "unknown"
+
+
+def extract_sections(source, filename=None):
+    """
+    Yields a document's text page by page (PDF) or section by section, using
+    the extractor registered for its file type. `source` is a file path or the
+    file's raw bytes; `filename` picks the extractor (default: the path).
+    """
+    return _extractor_for(source, filename).extract(source)
+
+
+def extract_text(source, filename=None) -> str:
+    """The whole text of a document as one string. Ingestion uses read_document() instead."""
+    sections = []
+    try:
+        with telemetry.timed(f"{_extractor_name(source, filename)}.extract"):
+            sections.extend(extract_sections(source, filename))
     except Exception as e:
-        print(f"Error extracting text from PDF: {e}")
-    return text_content
-
-
-def chunk_text(text:str,chunk_size:int=300,overlap:int=50)->list[str]:
-    words=text.split()
-    if not words:
-        return []
-    
-    chunks=[]
-    for i in range(0, len(words), chunk_size - overlap):
-        chunk = words[i:i + chunk_size]
-        chunks.append(" ".join(chunk))
-        
-    return chunks
+        logger.error("Error extracting text from %s: %s", filename or "document", e)
+    return " " + "".join(sections)
+
 
+def iter_chunks(sections, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP):
+    """
+    Chunks a stream of texts exactly as chunk_text() would chunk them joined,
+    while holding only about one chunk's worth of words at a time.
+    """
+    step = chunk_size - overlap
+    words = []
+    start = 0
+    for section in sections:
+        words.extend(section.split())
+        while len(words) - start >= chunk_size:
+            yield " ".join(words[start:start + chunk_size])
+            start += step
+        del words[:start]
+        start = 0
+    while start < len(words):
+        yield " ".join(words[start:start + chunk_size])
+        start += step
+
+
+@telemetry.timed("pdf.chunk")
+def chunk_text(text:str,chunk_size:int=CHUNK_SIZE,overlap:int=CHUNK_OVERLAP)->list[str]:
+    return list(iter_chunks([text], chunk_size, overlap))
+
+
+def read_document(source, filename=None) -> tuple[str, list[str]]:
+    """
+    Streams a document from its extractor straight into the chunker. Returns
+    the first LLM_TEXT_CHARS characters (for the tag and summary prompts) and
+    the chunks; the full text is never joined into one string. If extraction
+    fails part-way, what was read so far is kept and the error is logged.
+    """
+    head = []
+    head_size = 0
+    chunks = []
+
+    def keep_head(sections):
+        nonlocal head_size
+        for section in sections:
+            if head_size < LLM_TEXT_CHARS:
+                head.append(section[:LLM_TEXT_CHARS - head_size])
+                head_size += len(head[-1])
+            yield section
 
-def process_and_index_pdf(doc_id: int, file_bytes: bytes):
-    print(f"--- Starting processing for document ID: {doc_id} ---")
     try:
-        text = extract_text_from_pdf(file_bytes)
-        if not text:
-            raise ValueError("No text could be extracted from the PDF.")
+        with telemetry.timed(f"{_extractor_name(source, filename)}.extract"):
+            chunks.extend(iter_chunks(keep_head(extract_sections(source, filename))))
+    except Exception as e:
+        logger.error("Error extracting text from %s: %s", filename or "document", e)
+    return " " + "".join(head), chunks
+
 
-        chunks = chunk_text(text)
+def process_and_index_document(doc_id: int, source, filename: str = None, chunks: list = None,
+                               update_status: bool = True, on_progress=None) -> bool:
+    """
+    Chunks and indexes a document under INDEX_VERSION. Pass `chunks` when
+    read_document() already ran for the AI step, so the file is not read
+    twice. Returns True on success; with update_status=False the caller
+    records the final status (and documents.index_version). on_progress(done,
+    total) reports chunks embedded so far.
+    """
+    logger.info("Starting processing for document ID: %s", doc_id)
+    try:
+        if chunks is None:
+            _, chunks = read_document(source, filename)
         if not chunks:
-            raise ValueError("Could not create text chunks from the document.")
-            
-        print(f"Created {len(chunks)} text chunks for document {doc_id}.")
+            raise ValueError("No text could be extracted from the document.")
+
+        logger.debug("Created %s text chunks for document %s.", len(chunks), doc_id)
 
         # Store chunks in vector store
-        vector_store.add_document_chunks(doc_id, chunks)
+        if not vector_store.add_document_chunks(doc_id, chunks, version=INDEX_VERSION,
+                                                on_progress=on_progress):
+            raise RuntimeError("Could not add the text chunks to the vector store.")
         
         # If everything succeeds, update the status to COMPLETED
-        database.update_document_status(doc_id, 'COMPLETED')
-        print(f"--- Finished processing successfully for document ID: {doc_id} ---")
+        if update_status:
+            database.update_document_status(doc_id, 'COMPLETED')
+        logger.info("Finished processing successfully for document ID: %s", doc_id)
+        return True
 
     except Exception as e:
-        print(f"An error occurred during processing for doc_id {doc_id}: {e}")
+        logger.error("An error occurred during processing for doc_id %s: %s", doc_id, e)
         # If any error occurs, update the status to FAILED
-        database.update_document_status(doc_id, 'FAILED')
+        if update_status:
+            database.update_document_status(doc_id, 'FAILED')
+        return False
+
+
+
+def _join_chunks(chunks, overlap: int = CHUNK_OVERLAP) -> str:
+    """Undoes the chunk overlap: the text the chunks were cut from."""
+    words = chunks[0].split()
+    for chunk in chunks[1:]:
+        words.extend(chunk.split()[overlap:])
+    return " ".join(words)
+
+
+def split_sections(chunks: list[str]) -> list[dict]:
+    """
+    Groups consecutive chunks into sections of about INSIGHT_SECTION_WORDS
+    words, at most INSIGHT_MAX_SECTIONS of them. Returns
+    [{'first_chunk', 'last_chunk', 'text'}].
+    """
+    step = max(CHUNK_SIZE - CHUNK_OVERLAP, 1)
+    per_section = max(INSIGHT_SECTION_WORDS // step, 1)
+    count = min(-(-len(chunks) // per_section), max(INSIGHT_MAX_SECTIONS, 1))
+    per_section = -(-len(chunks) // max(count, 1))
+    return [
+        {"first_chunk": first, "last_chunk": min(first + per_section, len(chunks)) - 1,
+         "text": _join_chunks(chunks[first:first + per_section])}
+        for first in range(0, len(chunks), per_section)
+    ]
+
+
+def _phrasing_embeddings(phrasings, version) -> list:
+    """Unit-length embeddings of the phrasings, rounded to keep the stored JSON small."""
+    embeddings = vector_store.embed_chunks(list(phrasings), vector_store.model_name_for_version(version))
+    embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    return np.round(embeddings, 4).tolist()
+
+
+@telemetry.timed("insights.precompute")
+def precompute_insights(doc_id: int, summary: str, chunks: list[str], version: str = INDEX_VERSION,
+                        llm_slot=nullcontext) -> dict:
+    """
+    Works out a document's section summaries and suggested questions and
+    stores them with database.save_document_insights(). Every LLM call is
+    made inside llm_slot(), so ingestion can make this wait its turn for the
+    model. Generated questions are answered from the chunks a search for them
+    returns, exactly as a live chat would, so the answers stay grounded.
+    Returns what was stored, or None if nothing could be.
+    """
+    sections = []
+    for section in split_sections(chunks):
+        with llm_slot():
+            section_summary = ai_utils.generate_section_summary(section["text"])
+        if section_summary:
+            sections.append({"first_chunk": section["first_chunk"], "last_chunk": section["last_chunk"],
+                             "summary": section_summary})
+
+    questions = []
+    if summary:
+        questions.append({"kind": "overview", "phrasings": OVERVIEW_QUESTIONS, "answer": summary})
+    if sections:
+        with llm_slot():
+            key_points = ai_utils.generate_key_points([section["summary"] for section in sections])
+        if key_points:
+            questions.append({"kind": "key_points", "phrasings": KEY_POINT_QUESTIONS, "answer": key_points})
+
+        outline = "\n".join([summary or ""] + [section["summary"] for section in sections])
+        with llm_slot():
+            generated = ai_utils.generate_questions_for_text(outline, INSIGHT_QUESTIONS)
+        for question in generated:
+            context_chunks = vector_store.search_document(doc_id, question, top_k=3, version=version)
+            if not context_chunks:
+                continue
+            with llm_slot():
+                answer = ai_utils.generate_grounded_answer(question, context_chunks)
+            if answer:
+                questions.append({"kind": "generated", "phrasings": (question,), "answer": answer})
+
+    if not questions and not sections:
+        logger.warning("No insights could be generated for doc_id %s.", doc_id)
+        return None
+
+    stored = []
+    for item in questions:
+        stored.append({"question": item["phrasings"][0], "answer": item["answer"], "kind": item["kind"],
+                       "embeddings": _phrasing_embeddings(item["phrasings"], version)})
+    if not database.save_document_insights(doc_id, version, stored, sections):
+        return None
+    cache.invalidate_document(doc_id)
+    logger.info("Stored %s suggested questions and %s section summaries for doc_id %s.",
+                len(stored), len(sections), doc_id)
+    return {"index_version": version, "questions": stored, "sections": sections}
+
+
+# One worker: insights are extra, and should take the model from ingestion as little as possible
+_insight_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="insights")
+_insight_slots = threading.BoundedSemaphore(max(INSIGHT_QUEUE, 1))
+
+
+def schedule_insights(doc_id: int, summary: str, chunks: list[str], version: str = INDEX_VERSION,
+                      llm_slot=nullcontext) -> bool:
+    """
+    Queues precompute_insights() for a freshly indexed document and returns
+    at once. Returns False if insights are disabled or INSIGHT_QUEUE
+    documents are already waiting.
+    """
+    if not INSIGHTS_ENABLED or not chunks:
+        return False
+    if not _insight_slots.acquire(blocking=False):
+        logger.warning("Insight queue is full; no suggested questions for doc_id %s.", doc_id)
+        return False
+
+    def run():
+        try:
+            precompute_insights(doc_id, summary, chunks, version, llm_slot)
+        except Exception as e:
+            logger.error("Precomputing insights failed for doc_id %s: %s", doc_id, e)
+        finally:
+            _insight_slots.release()
 
+    _insight_pool.submit(run)
+    return True
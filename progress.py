@@ -0,0 +1,197 @@
+"""
+Live ingestion progress for the dashboard.
+
+Ingestion calls publish() as a document moves through its stages. Each
+update is pushed to the user's open dashboards over Server-Sent Events
+(stream(), served at /events/ingestion), and static/dashboard_script.js
+patches the document's row in place. Nobody has to reload the page, and so
+re-query MySQL, to see a document finish.
+
+Updates go through an in-process broker, or through Redis pub/sub when
+VIEW_CACHE_URL is set, so that a stream served by one worker process sees
+documents ingested by another. The latest update for each document is kept
+for PROGRESS_TTL seconds, so a stream that (re)connects starts from the
+current state. A stream ends once the user has had nothing in progress for
+PROGRESS_IDLE_SECONDS, which frees the worker thread serving it.
+
+Under gunicorn's gthread workers every open stream holds one of the worker's
+WEB_THREADS request threads. At most PROGRESS_MAX_STREAMS streams are served
+per worker at once (half the threads by default), so dashboards left open
+can't starve page, chat and upload requests; further streams are refused
+with a 503 and the browser tries again later.
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+import telemetry
+from cache import VIEW_CACHE_URL
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = telemetry.get_logger(__name__)
+
+# --- Progress settings ---
+PROGRESS_TTL = int(os.getenv("PROGRESS_TTL", 3600))
+PROGRESS_IDLE_SECONDS = int(os.getenv("PROGRESS_IDLE_SECONDS", 30))
+PROGRESS_HEARTBEAT_SECONDS = int(os.getenv("PROGRESS_HEARTBEAT_SECONDS", 15))
+# How long the browser waits before reconnecting a dropped stream
+PROGRESS_RETRY_MS = 3000
+# Streams open at once in this process; each holds a request thread
+PROGRESS_MAX_STREAMS = int(os.getenv("PROGRESS_MAX_STREAMS", max(1, int(os.getenv("WEB_THREADS", 8)) // 2)))
+
+_stream_slots = threading.BoundedSemaphore(PROGRESS_MAX_STREAMS)
+
+# Where each AI stage starts on the 0-100 scale; embedding fills the rest
+STAGE_PERCENT = {"queued": 0, "extract": 5, "llm": 25, "embed": 40}
+
+
+class LocalBroker:
+    """Fans updates out to the streams of this process."""
+
+    def __init__(self):
+        self._subscribers = {}
+        self._latest = {}  # user_id -> {doc_id: (update, expiry)}
+        self._lock = threading.Lock()
+
+    def publish(self, user_id, update):
+        with self._lock:
+            self._latest.setdefault(user_id, {})[update["doc_id"]] = (update, time.monotonic() + PROGRESS_TTL)
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for inbox in subscribers:
+            try:
+                inbox.put_nowait(update)
+            except queue.Full:
+                pass  # a stalled stream; it gets the snapshot when it reconnects
+
+    def snapshot(self, user_id) -> list:
+        now = time.monotonic()
+        with self._lock:
+            latest = self._latest.get(user_id, {})
+            for doc_id in [doc_id for doc_id, (_, expiry) in latest.items() if expiry < now]:
+                del latest[doc_id]
+            return [update for update, _ in latest.values()]
+
+    def subscribe(self, user_id):
+        inbox = queue.Queue(maxsize=1000)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(inbox)
+
+        def close():
+            with self._lock:
+                self._subscribers.get(user_id, set()).discard(inbox)
+
+        def get(timeout):
+            try:
+                return inbox.get(timeout=timeout)
+            except queue.Empty:
+                return None
+
+        return get, close
+
+
+class RedisBroker:
+    """Updates go through Redis, so every worker process sees them."""
+
+    def __init__(self, url):
+        self._client = redis.Redis.from_url(url)
+
+    def publish(self, user_id, update):
+        payload = json.dumps(update)
+        key = f"progress:{user_id}"
+        pipe = self._client.pipeline()
+        pipe.hset(key, update["doc_id"], payload)
+        pipe.expire(key, PROGRESS_TTL)
+        pipe.publish(key, payload)
+        pipe.execute()
+
+    def snapshot(self, user_id) -> list:
+        return [json.loads(raw) for raw in self._client.hgetall(f"progress:{user_id}").values()]
+
+    def subscribe(self, user_id):
+        pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(f"progress:{user_id}")
+
+        def get(timeout):
+            message = pubsub.get_message(timeout=timeout)
+            return json.loads(message["data"]) if message else None
+
+        return get, pubsub.close
+
+
+def _create_broker():
+    if VIEW_CACHE_URL and redis is not None:
+        return RedisBroker(VIEW_CACHE_URL)
+    return LocalBroker()
+
+
+broker = _create_broker()
+
+
+def publish(user_id, doc_id, filename=None, status="PROCESSING", stage=None, percent=None, **fields):
+    """Records and pushes one update for a document; never raises."""
+    update = {"doc_id": int(doc_id), "filename": filename, "status": status,
+              "stage": stage, "percent": percent, "at": time.time(), **fields}
+    try:
+        broker.publish(user_id, update)
+    except Exception as e:
+        logger.warning("Could not publish progress for doc_id %s: %s", doc_id, e)
+
+
+def stage_percent(stage, done=0, total=0) -> int:
+    """Percent complete for a stage; `done` of `total` chunks embedded within the embed stage."""
+    start = STAGE_PERCENT.get(stage, 0)
+    if stage == "embed" and total:
+        return start + (100 - start) * done // total
+    return start
+
+
+def _event(update) -> str:
+    return f"event: document\ndata: {json.dumps(update)}\n\n"
+
+
+def acquire_stream_slot() -> bool:
+    """Claims one of the PROGRESS_MAX_STREAMS slots; False if all are taken."""
+    return _stream_slots.acquire(blocking=False)
+
+
+def release_stream_slot():
+    """Gives back a slot claimed with acquire_stream_slot(), once its response is closed."""
+    _stream_slots.release()
+
+
+def stream(user_id):
+    """The SSE body for one dashboard: current state, then every update for the user's documents."""
+    get, close = broker.subscribe(user_id)
+    try:
+        yield f"retry: {PROGRESS_RETRY_MS}\n\n"
+        in_progress = set()
+        for update in broker.snapshot(user_id):
+            if update["status"] == "PROCESSING":
+                in_progress.add(update["doc_id"])
+            yield _event(update)
+
+        idle_since = time.monotonic()
+        while True:
+            update = get(PROGRESS_HEARTBEAT_SECONDS)
+            if update is None:
+                if not in_progress and time.monotonic() - idle_since >= PROGRESS_IDLE_SECONDS:
+                    yield "event: idle\ndata: {}\n\n"
+                    return
+                yield ": keep-alive\n\n"
+                continue
+            if update["status"] == "PROCESSING":
+                in_progress.add(update["doc_id"])
+            else:
+                in_progress.discard(update["doc_id"])
+            idle_since = time.monotonic()
+            yield _event(update)
+    except Exception as e:
+        logger.warning("Progress stream for user %s ended: %s", user_id, e)
+    finally:
+        close()
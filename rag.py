@@ -1,9 +1,58 @@
+import os
 import ollama
+import numpy as np
 import vector_store
 import mongodb
+import ai_utils
 import json
+import telemetry
+
+logger = telemetry.get_logger(__name__)
 
 MODEL = "qwen2.5:1.5b"
+# Cosine similarity a question needs to a precomputed one to get its stored answer
+INSIGHT_MATCH_THRESHOLD = float(os.getenv("INSIGHT_MATCH_THRESHOLD", 0.85))
+
+
+def _normalize_question(text: str) -> str:
+    return " ".join(text.lower().split()).rstrip("?.! ")
+
+
+def answer_from_insights(insights: dict, user_question: str, index_version: str = None):
+    """
+    First-tier answer: the stored answer of the precomputed question (see
+    processing.precompute_insights) the user's question matches, or None.
+    A suggested question clicked in the chat panel matches on its text; any
+    other question is embedded and compared with every stored phrasing.
+    """
+    questions = (insights or {}).get("questions") or []
+    if not questions:
+        return None
+
+    wanted = _normalize_question(user_question)
+    for item in questions:
+        if _normalize_question(item["question"]) == wanted:
+            return item["answer"]
+
+    # Embeddings from another model are not comparable (the document was reindexed since)
+    model_name = vector_store.model_name_for_version(index_version)
+    if vector_store.model_name_for_version(insights.get("index_version")) != model_name:
+        return None
+    try:
+        with telemetry.timed("embedding.encode_query"):
+            query = vector_store.encode_query(user_question, model_name)
+    except Exception as e:
+        logger.error("Could not embed the question for the insight match: %s", e)
+        return None
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+    best_score, best_answer = -1.0, None
+    for item in questions:
+        for embedding in item.get("embeddings") or ():
+            score = float(np.dot(query, embedding))
+            if score > best_score:
+                best_score, best_answer = score, item["answer"]
+    return best_answer if best_score >= INSIGHT_MATCH_THRESHOLD else None
 
 def get_routing_decision(history: list, user_question: str) -> str:
     
@@ -35,10 +84,11 @@ def get_routing_decision(history: list, user_question: str) -> str:
     """
     
     try:
-        response = ollama.chat(
-            model=MODEL,
-            messages=[{'role': 'user', 'content': prompt}]
-        )
+        with telemetry.timed("llm.router"):
+            response = ollama.chat(
+                model=MODEL,
+                messages=[{'role': 'user', 'content': prompt}]
+            )
         
         decision = response['message']['content'].strip().lower()
         
@@ -48,32 +98,45 @@ def get_routing_decision(history: list, user_question: str) -> str:
             return "chat"
             
     except Exception as e:
-        print(f"Error in router, defaulting to 'search': {e}")
+        logger.error("Error in router, defaulting to 'search': %s", e)
         return "search" # Default to search if router fails
 
-def answer_from_document(doc_id: int, user_question: str):
+def answer_from_document(doc_id: int, user_question: str, session_id: str, index_version: str = None,
+                         insights: dict = None):
     """
     Performs RAG OR simple chat to answer a question.
+    session_id identifies the user's chat session (see mongodb.chat_session_key);
+    index_version is the document's documents.index_version. If the question
+    matches one of the document's precomputed `insights`, the stored answer
+    is returned without calling the router, the vector index or the model.
     """
     
+    # 0. Precomputed answers first
+    with telemetry.timed("rag.insight_match"):
+        stored_answer = answer_from_insights(insights, user_question, index_version)
+    if stored_answer:
+        logger.debug("Answered from the precomputed insights of document %s.", doc_id)
+        return stored_answer
+
     # 1. Get History
-    print("Fetching chat history...")
-    history = mongodb.get_chat_history(str(doc_id))
+    logger.debug("Fetching chat history...")
+    history = mongodb.get_chat_history(session_id)
     
     # 2. Get Routing Decision
-    print("Routing question...")
+    logger.debug("Routing question...")
     decision = get_routing_decision(history, user_question)
-    print(f"Router decision: {decision.upper()}")
+    logger.debug("Router decision: %s", decision.upper())
 
     
     messages = []
     
     if decision == "search":
-        print(f"Searching document {doc_id} for context...")
+        logger.debug("Searching document %s for context...", doc_id)
         context_chunks = vector_store.search_document(
             doc_id=doc_id, 
             query_text=user_question, 
-            top_k=3
+            top_k=3,
+            version=index_version
         )
         
         if not context_chunks:
@@ -81,11 +144,9 @@ def answer_from_document(doc_id: int, user_question: str):
         
         context = "\n\n---\n\n".join(context_chunks)
         
-        system_prompt = """You are an assistant for 'intelliDocs'. Your task is to answer questions based ONLY on the provided context.Do not use any outside knowledge. If the answer is not in the context, state that clearly."""
-        
         # Start building the messages
         messages = [
-            {'role': 'system', 'content': system_prompt}
+            {'role': 'system', 'content': ai_utils.GROUNDED_SYSTEM_PROMPT}
         ]
         
         messages.extend(history)
@@ -101,7 +162,7 @@ def answer_from_document(doc_id: int, user_question: str):
         messages.append({'role': 'user', 'content': final_user_prompt})
 
     else: 
-        print("Answering as a chatbot...")
+        logger.debug("Answering as a chatbot...")
         
         system_prompt = """You are 'intelliDocs', a helpful AI assistant. The user is asking a conversational question. Answer them based on the provided chat history in third person. Be friendly and direct."""
         
@@ -118,14 +179,15 @@ def answer_from_document(doc_id: int, user_question: str):
 
     # 4. Call the Ollama model
     try:
-        print(f"\n... Sending final prompt to {MODEL} ...\n")
-        response = ollama.chat(
-            model=MODEL,
-            messages=messages
-        )
+        logger.debug("Sending final prompt to %s", MODEL)
+        with telemetry.timed("llm.answer"):
+            response = ollama.chat(
+                model=MODEL,
+                messages=messages
+            )
         
         return response['message']['content']
         
     except Exception as e:
-        print(f"Error contacting Ollama: {e}")
+        logger.error("Error contacting Ollama: %s", e)
         return "An error occurred while trying to get an answer from the model."
\ No newline at end of file
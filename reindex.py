@@ -0,0 +1,207 @@
+"""
+Re-indexes documents whose chunks were built with a different chunker or
+embedding model than the current processing.INDEX_VERSION.
+
+    python reindex.py                       # run until every document is current
+    python reindex.py --docs-per-min 10     # gentler on live traffic
+
+Each document is re-chunked and re-embedded from its stored file into the new
+version alongside the old one; searches keep using the old version until
+documents.index_version is switched, in one UPDATE, once the new one is
+complete. The old version's chunks are removed after REINDEX_GRACE_SECONDS so
+requests that already read the old pointer can finish.
+
+Progress lives in the database (documents not yet at the target version), so
+a job that crashed or was stopped simply resumes where it left off.
+"""
+import argparse
+import heapq
+import os
+import sys
+import threading
+import time
+
+import cache
+import database
+import processing
+import storage
+import telemetry
+import vector_store
+
+logger = telemetry.get_logger(__name__)
+
+# Documents fetched per query
+REINDEX_BATCH_SIZE = int(os.getenv("REINDEX_BATCH_SIZE", 20))
+# Upper bound on the re-index rate, so live uploads and searches keep the CPU
+REINDEX_DOCS_PER_MIN = float(os.getenv("REINDEX_DOCS_PER_MIN", 30))
+# How long a replaced version's chunks are kept after the switch. A process-
+# local view cache in other processes can keep serving the old
+# documents.index_version for up to VIEW_CACHE_TTL, so that is added on top.
+_CACHE_LAG = cache.VIEW_CACHE_TTL if isinstance(cache.backend, cache.LocalBackend) else 0
+REINDEX_GRACE_SECONDS = float(os.getenv("REINDEX_GRACE_SECONDS", 30 + _CACHE_LAG))
+
+
+class ReindexJob:
+    """One pass over every document that is not yet at the target version."""
+
+    def __init__(self, target_version=processing.INDEX_VERSION, docs_per_min=REINDEX_DOCS_PER_MIN,
+                 batch_size=REINDEX_BATCH_SIZE, grace_seconds=REINDEX_GRACE_SECONDS):
+        self.target_version = target_version
+        self.docs_per_min = docs_per_min
+        self.batch_size = batch_size
+        self.grace_seconds = grace_seconds
+        self.status = "pending"
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.current_doc_id = None
+        self.started_at = None
+        self.finished_at = None
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        # (due time, doc_id, version kept) for old versions waiting out the grace period
+        self._prunes = []
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        """Runs the job in the calling thread until it finishes or stop() is called."""
+        with self.lock:
+            self.status = "running"
+            self.started_at = time.time()
+        self.total = database.count_documents_to_reindex(self.target_version) or 0
+        logger.info("Re-indexing %s documents to version %s", self.total, self.target_version)
+
+        interval = 60.0 / self.docs_per_min if self.docs_per_min > 0 else 0.0
+        after_id = 0
+        try:
+            while not self._stop.is_set():
+                batch = database.get_documents_to_reindex(self.target_version, after_id, self.batch_size)
+                if not batch:
+                    break
+                for document in batch:
+                    if self._stop.is_set():
+                        break
+                    after_id = document['id']
+                    started = time.monotonic()
+                    self._reindex_one(document)
+                    self._run_due_prunes()
+                    self._report()
+                    # Throttle: never faster than docs_per_min
+                    self._stop.wait(max(0.0, interval - (time.monotonic() - started)))
+        finally:
+            self._run_due_prunes(wait=not self._stop.is_set())
+            with self.lock:
+                self.status = "stopped" if self._stop.is_set() else "completed"
+                self.finished_at = time.time()
+                self.current_doc_id = None
+            self._report()
+            logger.info("Re-index %s: %s", self.status, self.to_dict())
+
+    def _reindex_one(self, document):
+        doc_id = document['id']
+        old_version = document['index_version']
+        with self.lock:
+            self.current_doc_id = doc_id
+        try:
+            with storage.open_file(document['public_id'], document['url']) as path:
+                if not processing.process_and_index_document(doc_id, path, document['filename'],
+                                                             update_status=False):
+                    raise RuntimeError("indexing failed")
+
+            if database.switch_index_version(doc_id, old_version, self.target_version):
+                cache.invalidate_document(doc_id, document['user_id'])
+                heapq.heappush(self._prunes, (time.monotonic() + self.grace_seconds, doc_id, self.target_version))
+            elif database.get_document_by_id(doc_id) is None:
+                # Deleted while we worked on it; drop what we just wrote
+                vector_store.delete_document_chunks(doc_id)
+            with self.lock:
+                self.done += 1
+        except Exception as e:
+            logger.error("Re-index of doc_id %s failed: %s", doc_id, e)
+            with self.lock:
+                self.failed += 1
+
+    def _run_due_prunes(self, wait=False):
+        while self._prunes:
+            due, doc_id, keep_version = self._prunes[0]
+            delay = due - time.monotonic()
+            if delay > 0:
+                if not wait:
+                    return
+                time.sleep(delay)
+            heapq.heappop(self._prunes)
+            vector_store.prune_document_chunks(doc_id, keep_version)
+
+    def _report(self):
+        progress = self.to_dict()
+        telemetry.set_gauge("intellidocs_reindex_remaining", progress["remaining"])
+        telemetry.set_gauge("intellidocs_reindex_done", progress["done"])
+        telemetry.set_gauge("intellidocs_reindex_failed", progress["failed"])
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            elapsed = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0.0
+            processed = self.done + self.failed
+            rate = processed / elapsed * 60 if elapsed > 0 else 0.0
+            remaining = max(self.total - processed, 0)
+            return {
+                "status": self.status,
+                "target_version": self.target_version,
+                "total": self.total,
+                "done": self.done,
+                "failed": self.failed,
+                "remaining": remaining,
+                "current_doc_id": self.current_doc_id,
+                "elapsed_seconds": round(elapsed, 1),
+                "docs_per_min": round(rate, 2),
+                "eta_seconds": round(remaining / rate * 60) if rate > 0 and self.status == "running" else None,
+            }
+
+
+_job = None
+_job_lock = threading.Lock()
+
+
+def get_job():
+    return _job
+
+
+def start_background_job(**options) -> ReindexJob:
+    """Starts a ReindexJob in a daemon thread unless one is already running."""
+    global _job
+    with _job_lock:
+        if _job is not None and _job.status in ("pending", "running"):
+            return _job
+        _job = ReindexJob(**options)
+        threading.Thread(target=_job.run, name="reindex", daemon=True).start()
+        return _job
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs-per-min", type=float, default=REINDEX_DOCS_PER_MIN)
+    parser.add_argument("--batch-size", type=int, default=REINDEX_BATCH_SIZE)
+    parser.add_argument("--grace-seconds", type=float, default=REINDEX_GRACE_SECONDS)
+    args = parser.parse_args(argv)
+
+    job = ReindexJob(docs_per_min=args.docs_per_min, batch_size=args.batch_size,
+                     grace_seconds=args.grace_seconds)
+    worker = threading.Thread(target=job.run, name="reindex")
+    worker.start()
+    try:
+        while worker.is_alive():
+            worker.join(10)
+            p = job.to_dict()
+            print(f"{p['done'] + p['failed']}/{p['total']} re-indexed ({p['failed']} failed), "
+                  f"{p['docs_per_min']} docs/min, eta {p['eta_seconds'] or '-'}s", flush=True)
+    except KeyboardInterrupt:
+        print("Stopping after the current document; run again to resume.")
+        job.stop()
+        worker.join()
+    return 0 if job.failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
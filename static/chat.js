@@ -35,6 +35,46 @@ document.addEventListener("DOMContentLoaded", () => {
 
   const docId = chatForm.dataset.docId;
 
+  // Posts a message to the Flask backend and returns its JSON reply
+  async function postMessage(message) {
+    const response = await fetch(`/chat/${docId}`, {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+        Accept: "application/json",
+      },
+      body: JSON.stringify({ message: message }),
+    });
+
+    if (!response.ok) {
+      const err = await response.json();
+      throw new Error(err.error || "Network response was not ok.");
+    }
+    return response.json();
+  }
+
+  // Suggested questions carry their precomputed answer, so it is shown at
+  // once; the question is still sent so it lands in the chat history.
+  const suggestions = document.getElementById("chat-suggestions");
+  if (suggestions) {
+    suggestions.addEventListener("click", (e) => {
+      const button = e.target.closest(".suggestion");
+      if (!button) return;
+
+      const message = button.textContent.trim();
+      addMessageToChat(message, "user");
+      addMessageToChat(button.dataset.answer, "bot");
+      button.remove();
+      if (!suggestions.querySelector(".suggestion")) {
+        suggestions.remove();
+      }
+
+      postMessage(message).catch((error) => {
+        console.error("Could not record the suggested question:", error);
+      });
+    });
+  }
+
   // 1. Listen for the "Send" button click
   chatForm.addEventListener("submit", async (e) => {
     // 2. Stop the page from reloading
@@ -52,23 +92,8 @@ document.addEventListener("DOMContentLoaded", () => {
     thinkingMessage.classList.add("thinking");
 
     try {
-      // 5. Send the message to your Flask backend
-      const response = await fetch(`/chat/${docId}`, {
-        method: "POST",
-        headers: {
-          "Content-Type": "application/json",
-          Accept: "application/json",
-        },
-        body: JSON.stringify({ message: message }),
-      });
-
-      if (!response.ok) {
-        const err = await response.json();
-        throw new Error(err.error || "Network response was not ok.");
-      }
-
-      // 6. Get the JSON response from Flask
-      const data = await response.json();
+      // 5 & 6. Send the message and get the JSON response from Flask
+      const data = await postMessage(message);
 
       // 7. Replace "Thinking..." with the real answer
       if (data.reply) {
@@ -11,15 +11,23 @@ uploadForm.addEventListener("submit", function (event) {
   // --- 1. Prevent the default page-reloading form submission ---
   event.preventDefault();
 
-  const file = fileInput.files[0];
-  if (!file) {
+  const files = Array.from(fileInput.files);
+  if (files.length === 0) {
     alert("Please select a file to upload.");
     return;
   }
 
+  // Several files or a zip archive go through the batch endpoint instead
+  const isBatch =
+    files.length > 1 || files[0].name.toLowerCase().endsWith(".zip");
+
   // --- 2. Prepare the data for sending ---
   const formData = new FormData();
-  formData.append("file", file);
+  if (isBatch) {
+    files.forEach((f) => formData.append("files", f));
+  } else {
+    formData.append("file", files[0]);
+  }
 
   // --- 3. Create a new XMLHttpRequest to handle the upload ---
   const xhr = new XMLHttpRequest();
@@ -36,9 +44,16 @@ uploadForm.addEventListener("submit", function (event) {
     }
   });
 
+  // The file is on the server now; its row appears once ingestion starts
+  xhr.upload.addEventListener("load", watchIngestion);
+
   // --- 5. Handle completion of the upload ---
   xhr.addEventListener("load", function () {
-    if (xhr.status === 200 || xhr.status === 302) {
+    if (isBatch && xhr.status === 202) {
+      const batch = JSON.parse(xhr.responseText);
+      progressStatus.textContent = "Upload complete! Processing...";
+      pollBatchProgress(batch.progress_url);
+    } else if (xhr.status === 200 || xhr.status === 302) {
       // 302 is for Flask's redirect
       progressStatus.textContent = "Upload complete! Refreshing...";
       // Reload the page to see the new file in the list and any flashed messages
@@ -60,10 +75,176 @@ uploadForm.addEventListener("submit", function (event) {
   progressWrapper.style.display = "block";
   uploadBtn.disabled = true;
   progressStatus.textContent = "Uploading... 0%";
+  watchIngestion();
 
   // Open a POST request to the same URL the form was pointing to
-  xhr.open("POST", uploadForm.action, true);
+  xhr.open("POST", isBatch ? "/upload/batch" : uploadForm.action, true);
 
   // Send the form data
   xhr.send(formData);
 });
+
+// Polls a batch's progress until every file has been processed
+function pollBatchProgress(progressUrl) {
+  fetch(progressUrl, { headers: { Accept: "application/json" } })
+    .then((response) => response.json())
+    .then((batch) => {
+      const processed = batch.completed + batch.failed + batch.skipped;
+      progressBar.value = batch.total
+        ? Math.round((processed / batch.total) * 100)
+        : 0;
+      progressStatus.textContent =
+        `Processed ${processed} of ${batch.total}` +
+        (batch.failed ? ` (${batch.failed} failed)` : "") +
+        ` - ${batch.docs_per_min} docs/min`;
+
+      if (batch.status === "completed") {
+        // The rows were kept up to date by the ingestion stream
+        progressStatus.textContent += " - done";
+        uploadBtn.disabled = false;
+        uploadForm.reset();
+      } else {
+        watchIngestion();
+        setTimeout(() => pollBatchProgress(progressUrl), 2000);
+      }
+    })
+    .catch(() => {
+      progressStatus.textContent = "Lost track of the batch. Refresh to see progress.";
+      uploadBtn.disabled = false;
+    });
+}
+
+// --- Live ingestion status ---
+// /events/ingestion pushes every state change of the user's documents (see
+// progress.py); rows are updated in place instead of reloading the page.
+const documentTable = document.getElementById("document-table");
+const documentRows = document.getElementById("document-rows");
+const emptyState = document.getElementById("empty-state");
+const STAGE_LABELS = {
+  queued: "Queued",
+  extract: "Extracting text",
+  llm: "Tagging and summarizing",
+  embed: "Indexing for search",
+  storage: "Uploading",
+};
+let ingestionEvents = null;
+
+function watchIngestion() {
+  if (ingestionEvents) return;
+  ingestionEvents = new EventSource("/events/ingestion");
+  ingestionEvents.addEventListener("document", (event) =>
+    updateRow(JSON.parse(event.data))
+  );
+  // Sent once the user has had nothing processing for a while
+  ingestionEvents.addEventListener("idle", () => {
+    ingestionEvents.close();
+    ingestionEvents = null;
+  });
+  // A refused connection (503: the server is at its stream limit) is not
+  // retried by the browser itself, so try again a little later
+  ingestionEvents.addEventListener("error", () => {
+    if (ingestionEvents.readyState === EventSource.CLOSED) {
+      ingestionEvents = null;
+      setTimeout(watchIngestion, 10000);
+    }
+  });
+}
+
+function createRow(update) {
+  const row = document.createElement("tr");
+  row.dataset.docId = update.doc_id;
+
+  const nameCell = row.insertCell();
+  const link = document.createElement("a");
+  link.href = `/view/${update.doc_id}`;
+  link.textContent = update.filename;
+  const status = document.createElement("span");
+  status.className = "doc-status";
+  nameCell.append(link, status);
+
+  row.insertCell().textContent = new Date().toLocaleDateString("en-US", {
+    month: "long",
+    day: "2-digit",
+    year: "numeric",
+  });
+  const tagsCell = row.insertCell();
+  tagsCell.className = "doc-tags";
+  tagsCell.textContent = "No tags";
+
+  const actions = document.createElement("div");
+  actions.className = "actions";
+  actions.append(
+    actionForm(`/document/${update.doc_id}/retry`, "Retry", "retry-form"),
+    actionForm(`/delete/${update.doc_id}`, "Delete")
+  );
+  actions.querySelector(".retry-form").hidden = true;
+  const deleteButton = actions.lastChild.querySelector("button");
+  deleteButton.classList.add("btn-delete");
+  deleteButton.addEventListener("click", (event) => {
+    if (!confirm("Are you sure you want to delete this file?")) event.preventDefault();
+  });
+  row.insertCell().appendChild(actions);
+  return row;
+}
+
+function actionForm(action, label, className) {
+  const form = document.createElement("form");
+  form.action = action;
+  form.method = "post";
+  if (className) form.className = className;
+  const button = document.createElement("button");
+  button.type = "submit";
+  button.className = "secondary outline";
+  button.textContent = label;
+  form.appendChild(button);
+  return form;
+}
+
+function updateRow(update) {
+  let row = documentRows.querySelector(`tr[data-doc-id="${update.doc_id}"]`);
+  if (!row) {
+    // New uploads get a row, unless the list is filtered by a tag
+    if (update.status !== "PROCESSING" || documentTable.dataset.activeTag) return;
+    row = createRow(update);
+    documentRows.prepend(row);
+    documentTable.hidden = false;
+    emptyState.hidden = true;
+  }
+  row.dataset.status = update.status;
+
+  const status = row.querySelector(".doc-status");
+  status.textContent = "";
+  if (update.status === "PROCESSING") {
+    const hasPercent = update.percent !== null && update.percent !== undefined;
+    status.textContent =
+      (STAGE_LABELS[update.stage] || "Processing") +
+      (hasPercent ? ` (${update.percent}%)` : "...");
+    const bar = document.createElement("progress");
+    if (hasPercent) {
+      bar.max = 100;
+      bar.value = update.percent;
+    }
+    status.appendChild(bar);
+  } else if (update.status === "FAILED") {
+    status.textContent = "Processing failed";
+  }
+
+  if (update.tags) {
+    row.querySelector(".doc-tags").textContent = update.tags.length
+      ? update.tags.slice(0, 3).join(", ")
+      : "No tags";
+  }
+
+  const retry = row.querySelector(".retry-form");
+  retry.hidden = update.status !== "FAILED";
+  if (update.status === "FAILED") {
+    retry.querySelector("button").title =
+      (update.storage_status === "FAILED" ? "Storage upload failed. " : "") +
+      (update.ai_status === "FAILED" ? "AI processing failed." : "");
+  }
+}
+
+// Documents still processing from an earlier visit keep updating
+if (documentRows.querySelector('tr[data-status="PROCESSING"]')) {
+  watchIngestion();
+}
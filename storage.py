@@ -0,0 +1,181 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import urllib.request
+from contextlib import contextmanager
+
+import cloudinary
+import cloudinary.uploader
+import telemetry
+
+logger = telemetry.get_logger(__name__)
+
+# --- Storage settings ---
+# 'cloudinary' keeps files on Cloudinary; 'local' keeps them on this machine
+# in a content-addressed store and serves them through the /files route.
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'cloudinary').lower()
+LOCAL_STORAGE_DIR = os.getenv('LOCAL_STORAGE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'file_store'))
+# Prefix of the URLs handed out for locally stored files. Point it at a CDN or
+# reverse proxy that forwards to /files/ to serve them from the edge.
+LOCAL_STORAGE_URL_PREFIX = os.getenv('LOCAL_STORAGE_URL_PREFIX', '/files/')
+# Cloudinary receives large files in chunks of this size
+CLOUDINARY_CHUNK_SIZE = int(os.getenv('CLOUDINARY_CHUNK_MB', 20)) * 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class CloudinaryStorage:
+    """Files live on Cloudinary as 'raw' resources under the given public_id."""
+
+    content_addressed = False
+
+    def __init__(self):
+        cloudinary.config(
+            cloud_name=os.getenv('CLOUDINARY_CLOUD_NAME'),
+            api_key=os.getenv('CLOUDINARY_API_KEY'),
+            api_secret=os.getenv('CLOUDINARY_API_SECRET')
+        )
+
+    def save(self, path, public_id) -> dict:
+        # Chunked upload straight from disk; 'raw' because it's a non-image file (PDF)
+        result = cloudinary.uploader.upload_large(
+            path,
+            public_id=public_id,
+            resource_type='raw',
+            chunk_size=CLOUDINARY_CHUNK_SIZE,
+        )
+        return {'url': result.get('secure_url'), 'public_id': result.get('public_id')}
+
+    def delete(self, public_id):
+        cloudinary.uploader.destroy(public_id, resource_type='raw')
+
+    def local_path(self, public_id):
+        return None
+
+
+class LocalStorage:
+    """
+    Content-addressed store on the local filesystem. A file is kept once under
+    the SHA-256 of its bytes (root/ab/cd/<sha256>.pdf), so the same PDF
+    uploaded twice takes the space of one. The hash doubles as public_id and
+    as a strong ETag, and because a path's content never changes it can be
+    cached indefinitely.
+    """
+
+    content_addressed = True
+
+    def __init__(self, root=LOCAL_STORAGE_DIR, url_prefix=LOCAL_STORAGE_URL_PREFIX):
+        self.root = root
+        self.url_prefix = url_prefix
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def file_digest(path) -> str:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def is_valid_id(public_id) -> bool:
+        return len(public_id) == 64 and all(c in '0123456789abcdef' for c in public_id)
+
+    def local_path(self, public_id):
+        if not self.is_valid_id(public_id):
+            return None
+        return os.path.join(self.root, public_id[:2], public_id[2:4], f"{public_id}.pdf")
+
+    def save(self, path, public_id=None) -> dict:
+        """Stores the file under its hash; public_id is ignored."""
+        digest = self.file_digest(path)
+        target = self.local_path(digest)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # Write next to the target and rename, so readers never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.part')
+            os.close(fd)
+            try:
+                shutil.copyfile(path, tmp_path)
+                os.replace(tmp_path, target)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        else:
+            logger.debug("File %s is already stored; reusing it.", digest)
+        return {'url': f"{self.url_prefix}{digest}", 'public_id': digest}
+
+    def delete(self, public_id):
+        target = self.local_path(public_id)
+        if target and os.path.exists(target):
+            os.remove(target)
+
+
+def _create_backend():
+    if STORAGE_BACKEND == 'local':
+        return LocalStorage()
+    if STORAGE_BACKEND != 'cloudinary':
+        logger.warning("Unknown STORAGE_BACKEND '%s'; using Cloudinary.", STORAGE_BACKEND)
+    return CloudinaryStorage()
+
+
+backend = _create_backend()
+
+
+def save_file(path, public_id) -> dict:
+    """Stores the file at `path` and returns {'url', 'public_id'} for the documents row."""
+    with telemetry.timed("storage.upload"):
+        return backend.save(path, public_id)
+
+
+def delete_file(public_id, references=1):
+    """
+    Removes a stored file. `references` is how many documents point at it,
+    including the one being deleted; a content-addressed file shared with
+    another document is kept.
+    """
+    if backend.content_addressed and references > 1:
+        logger.debug("File %s is still used by other documents; keeping it.", public_id)
+        return
+    with telemetry.timed("storage.delete"):
+        backend.delete(public_id)
+
+
+def ensure_stored(path, public_id):
+    """
+    Stores the file at `path` again if its content-addressed copy is gone.
+    Call it after the documents row records public_id: a delete of the last
+    other document sharing the file may have removed it after save_file()
+    found it already there.
+    """
+    if not backend.content_addressed or os.path.exists(backend.local_path(public_id)):
+        return
+    logger.info("File %s was removed while it was being recorded; storing it again.", public_id)
+    save_file(path, public_id)
+
+
+def local_path(public_id):
+    """Path of a locally stored file, or None if the backend does not keep files locally."""
+    return backend.local_path(public_id)
+
+
+@contextmanager
+def open_file(public_id, url):
+    """
+    Yields a local path to a stored file: the file itself for the local
+    backend, otherwise a temporary download of `url` removed afterwards.
+    """
+    path = local_path(public_id)
+    if path and os.path.exists(path):
+        yield path
+        return
+
+    fd, tmp_path = tempfile.mkstemp(suffix=".pdf", prefix="stored_")
+    try:
+        with telemetry.timed("storage.download"):
+            with os.fdopen(fd, "wb") as out, urllib.request.urlopen(url, timeout=60) as response:
+                shutil.copyfileobj(response, out, HASH_CHUNK_SIZE)
+        yield tmp_path
+    finally:
+        os.remove(tmp_path)
@@ -0,0 +1,192 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Logging ---
+# LOG_LEVEL controls everything; hot-path chatter (per message, per query) is
+# logged at DEBUG so the default INFO level keeps request handling quiet.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+logging.basicConfig(
+    level=LOG_LEVEL,
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Returns a module logger configured with the app-wide LOG_LEVEL."""
+    return logging.getLogger(name)
+
+
+logger = get_logger(__name__)
+
+
+# --- Stage timing histograms ---
+# Upper bounds in seconds; sized to cover both millisecond MySQL queries and
+# multi-second Ollama calls.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_histograms_lock = threading.Lock()
+# (stage, outcome) -> {"buckets": [...], "sum": float, "count": int}
+_histograms = {}
+# Callables receiving every raw (stage, outcome, seconds) sample, e.g. the benchmark harness.
+_listeners = []
+
+
+def add_listener(listener):
+    """Registers listener(stage, outcome, seconds) to be called for every timed stage."""
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def _record(stage: str, outcome: str, seconds: float):
+    with _histograms_lock:
+        histogram = _histograms.get((stage, outcome))
+        if histogram is None:
+            histogram = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+            _histograms[(stage, outcome)] = histogram
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+    if _otel_histogram is not None:
+        _otel_histogram.record(seconds, {"stage": stage, "outcome": outcome})
+
+    for listener in list(_listeners):
+        listener(stage, outcome, seconds)
+
+
+@contextmanager
+def timed(stage: str):
+    """
+    Times a block (or, used as a decorator, a function call) and records it
+    under `stage`. Exceptions are recorded with outcome="error" and re-raised.
+    """
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        _record(stage, outcome, elapsed)
+        logger.debug("stage=%s outcome=%s duration_ms=%.2f", stage, outcome, elapsed * 1000)
+
+
+def get_stage_stats() -> dict:
+    """Returns a copy of every stage histogram, keyed by (stage, outcome)."""
+    with _histograms_lock:
+        return {
+            key: {"buckets": list(h["buckets"]), "sum": h["sum"], "count": h["count"]}
+            for key, h in _histograms.items()
+        }
+
+
+# --- Gauges ---
+_gauges_lock = threading.Lock()
+_gauges = {}
+
+
+def set_gauge(name: str, value):
+    with _gauges_lock:
+        _gauges[name] = value
+
+
+def max_gauge(name: str, value):
+    """Keeps the largest value ever reported under `name`."""
+    with _gauges_lock:
+        if value > _gauges.get(name, value - 1):
+            _gauges[name] = value
+
+
+def get_gauges() -> dict:
+    with _gauges_lock:
+        return dict(_gauges)
+
+
+def current_rss_bytes() -> int:
+    """Resident set size of this process (peak RSS where /proc is unavailable)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render_prometheus(gauges: dict = None) -> str:
+    """
+    Renders the stage histograms (plus any extra name -> value gauges) in the
+    Prometheus text exposition format.
+    """
+    lines = [
+        "# HELP intellidocs_stage_duration_seconds Time spent in each pipeline stage.",
+        "# TYPE intellidocs_stage_duration_seconds histogram",
+    ]
+    for (stage, outcome), h in sorted(get_stage_stats().items()):
+        labels = f'stage="{_escape_label(stage)}",outcome="{outcome}"'
+        for bound, count in zip(BUCKETS, h["buckets"]):
+            lines.append(f'intellidocs_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f'intellidocs_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {h["count"]}')
+        lines.append(f'intellidocs_stage_duration_seconds_sum{{{labels}}} {h["sum"]}')
+        lines.append(f'intellidocs_stage_duration_seconds_count{{{labels}}} {h["count"]}')
+
+    all_gauges = get_gauges()
+    all_gauges.update(gauges or {})
+    for name, value in sorted(all_gauges.items()):
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+# --- Optional OTLP export ---
+# Set OTEL_EXPORTER_OTLP_ENDPOINT (e.g. http://localhost:4317) to also push the
+# same histograms to an OpenTelemetry collector.
+_otel_histogram = None
+
+def _init_otlp():
+    endpoint = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+    if not endpoint:
+        return None
+    try:
+        from opentelemetry import metrics
+        from opentelemetry.sdk.metrics import MeterProvider
+        from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
+
+        reader = PeriodicExportingMetricReader(OTLPMetricExporter(endpoint=endpoint))
+        provider = MeterProvider(
+            resource=Resource.create({"service.name": os.getenv("OTEL_SERVICE_NAME", "intellidocs")}),
+            metric_readers=[reader]
+        )
+        metrics.set_meter_provider(provider)
+        meter = metrics.get_meter("intellidocs")
+        logger.info("Exporting stage timings over OTLP to %s", endpoint)
+        return meter.create_histogram(
+            "intellidocs.stage.duration", unit="s",
+            description="Time spent in each pipeline stage."
+        )
+    except Exception as e:
+        logger.warning("OTLP export disabled: %s", e)
+        return None
+
+_otel_histogram = _init_otlp()
@@ -1,74 +1,722 @@
-import chromadb
+import hashlib
+import json
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from multiprocessing.connection import Client
+
+import numpy as np
 from sentence_transformers import SentenceTransformer
+import telemetry
+
+logger = telemetry.get_logger(__name__)
 
 # --- INITIALIZATION ---
-print("Loading embedding model...")
-EMBEDDING_MODEL = SentenceTransformer('all-MiniLM-L6-v2')
-print("Embedding model loaded.")
+# Chunks indexed before index versions existed were embedded with this model.
+LEGACY_EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL", LEGACY_EMBEDDING_MODEL)
+
+logger.info("Loading embedding model...")
+EMBEDDING_MODEL = SentenceTransformer(EMBEDDING_MODEL_NAME)
+logger.info("Embedding model loaded.")
+
+# Other models are loaded on first use: documents not yet re-indexed with the
+# current model must still be queried with the model that embedded them.
+_models = {EMBEDDING_MODEL_NAME: EMBEDDING_MODEL}
+_models_lock = threading.Lock()
+
+# --- Query batching ---
+# Queries embedded by concurrent requests share one forward pass: the first
+# waits up to EMBEDDING_BATCH_WINDOW_MS for others to join, or until
+# EMBEDDING_BATCH_SIZE are waiting. The wait is skipped while the previous
+# batch held a single query, so a lone request is not delayed; queries that
+# arrive during a forward pass are batched together either way.
+EMBEDDING_BATCHING = os.getenv("EMBEDDING_BATCHING", "true").lower() in ("1", "true", "yes")
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", 5))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 32))
+# Chunks embedded per call when the caller wants progress reports
+EMBEDDING_PROGRESS_CHUNKS = int(os.getenv("EMBEDDING_PROGRESS_CHUNKS", 256))
+
+# Which index engine holds the chunk embeddings:
+#   'chroma'  - one ChromaDB collection for every chunk, filtered by doc_id
+#   'sharded' - one memory-mapped NumPy matrix per document (see ShardedIndex)
+VECTOR_INDEX_ENGINE = os.getenv("VECTOR_INDEX_ENGINE", "chroma").lower()
 
-# Initialize the ChromaDB client.
 # We'll use a persistent client that saves the database to a folder named 'chroma_db'
-CHROMA_CLIENT = chromadb.PersistentClient(path="./chroma_db")
+# (CHROMA_PATH lets benchmarks and tests point it at a scratch directory).
+CHROMA_PATH = os.getenv("CHROMA_PATH", "./chroma_db")
+
+# --- Sharded engine settings ---
+VECTOR_SHARD_PATH = os.getenv("VECTOR_SHARD_PATH", "./vector_shards")
+# How shard matrices store each vector:
+#   'float16' - half the size of float32, practically exact
+#   'int8'    - a quarter of the size, one float32 scale per vector
+#   'binary'  - one bit per dimension (1/32 of the size), for coarse search only
+VECTOR_SHARD_DTYPE = os.getenv("VECTOR_SHARD_DTYPE", "float16").lower()
+# Keep the float32 vectors of int8/binary shards on disk (memory-mapped, never
+# loaded) and rescore the best k * VECTOR_RESCORE_FACTOR coarse candidates with
+# them. Off by default: full.npy is twice the size of a float16 shard.
+VECTOR_RESCORE = os.getenv("VECTOR_RESCORE", "false").lower() in ("1", "true", "yes")
+VECTOR_RESCORE_FACTOR = int(os.getenv("VECTOR_RESCORE_FACTOR", 8))
+# Rows widened to float32 at a time when scoring a float16/int8 shard
+SCORE_BLOCK_ROWS = 1024
+# Shards with at least this many chunks also get an HNSW graph (needs hnswlib);
+# smaller ones are searched exactly, which is faster at that size anyway.
+HNSW_MIN_CHUNKS = int(os.getenv("VECTOR_HNSW_MIN_CHUNKS", 20000))
+HNSW_M = int(os.getenv("VECTOR_HNSW_M", 16))
+HNSW_EF_CONSTRUCTION = int(os.getenv("VECTOR_HNSW_EF_CONSTRUCTION", 200))
+HNSW_EF_SEARCH = int(os.getenv("VECTOR_HNSW_EF_SEARCH", 64))
+# Memory for recently searched shards (matrices and HNSW graphs), per index
+VECTOR_CACHE_MB = int(os.getenv("VECTOR_CACHE_MB", 256))
+
+# --- Per-document fast path ---
+# With the Chroma engine, documents of up to VECTOR_FAST_PATH_MAX_CHUNKS chunks
+# also get a float16 shard at ingest time. Searches of those documents are
+# answered from it exactly, and Chroma is only asked about the rest.
+VECTOR_FAST_PATH = os.getenv("VECTOR_FAST_PATH", "true").lower() in ("1", "true", "yes")
+VECTOR_FAST_PATH_DIR = os.getenv("VECTOR_FAST_PATH_DIR", "./vector_fastpath")
+VECTOR_FAST_PATH_MAX_CHUNKS = int(os.getenv("VECTOR_FAST_PATH_MAX_CHUNKS", 5000))
+
+# --- Vector writer ---
+# When set (gunicorn.conf.py does), this process does not open the index for
+# writing: adds, deletes and prunes are sent over this Unix socket to the one
+# vector writer process (vector_writer.py). Chroma is queried through it as
+# well, since its client must not be shared between processes; shards are
+# read directly.
+VECTOR_WRITER_SOCKET = os.getenv("VECTOR_WRITER_SOCKET", "")
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+def version_key(version) -> str:
+    """Short, path- and id-safe key for an index version (see processing.INDEX_VERSION)."""
+    if version is None:
+        return "unversioned"
+    return hashlib.sha1(version.encode("utf-8")).hexdigest()[:12]
+
+
+class ChromaIndex:
+    """
+    All chunks in one Chroma collection; a doc_id metadata filter scopes each
+    query. Chunks written with an index version carry it in their metadata
+    and use '<doc_id>@<version key>' as their filter value, so each version
+    of a document is queried with a single equality filter and the versions
+    never mix. Unversioned chunks keep the plain doc_id.
+    """
+
+    name = "chroma"
+
+    def __init__(self, path=CHROMA_PATH):
+        import chromadb
+        self.client = chromadb.PersistentClient(path=path)
+        # Get or create a "collection" which is like a table in a SQL database.
+        self.collection = self.client.get_or_create_collection(name="documents")
+
+    @staticmethod
+    def _filter_value(doc_id, version) -> str:
+        return str(doc_id) if version is None else f"{doc_id}@{version_key(version)}"
+
+    def add(self, doc_id: int, chunks: list[str], embeddings, version=None):
+        # Metadata is crucial for filtering: we store the document ID so we can
+        # search within a specific document later.
+        filter_value = self._filter_value(doc_id, version)
+        if version is None:
+            metadatas = [{'doc_id': filter_value} for _ in chunks]
+            # Unique IDs for each chunk to store in ChromaDB.
+            ids = [f"{doc_id}_{i}" for i in range(len(chunks))]
+        else:
+            metadatas = [{'doc_id': filter_value, 'doc': int(doc_id), 'version': version} for _ in chunks]
+            ids = [f"{doc_id}_{version_key(version)}_{i}" for i in range(len(chunks))]
+            # Left over from an interrupted run of the same version
+            self.collection.delete(where={"doc_id": filter_value})
+
+        batch = self.client.get_max_batch_size()
+        for start in range(0, len(chunks), batch):
+            self.collection.add(
+                embeddings=embeddings[start:start + batch],
+                documents=chunks[start:start + batch],
+                metadatas=metadatas[start:start + batch],
+                ids=ids[start:start + batch]
+            )
+
+    def delete(self, doc_id: int):
+        """Removes every version of the document."""
+        self.collection.delete(where={"doc_id": str(doc_id)})
+        self.collection.delete(where={"doc": int(doc_id)})
+
+    def prune(self, doc_id: int, keep_version):
+        """Removes every version of the document except keep_version."""
+        if keep_version is not None:
+            self.collection.delete(where={"doc_id": str(doc_id)})
+        keep_prefix = f"{doc_id}_{version_key(keep_version)}_"
+        stale = [chunk_id for chunk_id in self.collection.get(where={"doc": int(doc_id)}, include=[])['ids']
+                 if not chunk_id.startswith(keep_prefix)]
+        if stale:
+            self.collection.delete(ids=stale)
+
+    def search(self, doc_id: int, query_embedding, top_k: int, version=None) -> list[tuple[int, str]]:
+        results = self.collection.query(
+            query_embeddings=[query_embedding],
+            n_results=top_k,
+            # This 'where' clause is the magic: it filters to only search
+            # chunks that belong to the specified document ID.
+            where={"doc_id": self._filter_value(doc_id, version)}
+        )
+        if not results['documents']:
+            return []
+        # The result is a list of lists, so we get the first item.
+        positions = [int(chunk_id.rsplit("_", 1)[1]) for chunk_id in results['ids'][0]]
+        return list(zip(positions, results['documents'][0]))
+
+
+class ShardedIndex:
+    """
+    One shard per document and index version, since every search is scoped
+    to a single document:
+
+        <root>/<doc_id>/<version key>/vectors.npy   normalized embeddings: float16, int8 or packed bits
+                                      scales.npy    per-vector scales (int8 only)
+                                      full.npy      float32 vectors for rescoring (int8/binary with rescore)
+                                      chunks.txt    chunk texts, concatenated as UTF-8
+                                      offsets.npy   byte offsets of each chunk in chunks.txt
+                                      hnsw.bin      HNSW graph, for shards of HNSW_MIN_CHUNKS+
+                                      meta.json     index version and chunk count
+
+    Only the shard of the document being searched is read, and recently
+    searched shards stay loaded (see _open). Small shards are searched exactly
+    with one matrix-vector product; large ones go through the HNSW graph. A
+    shard is written to a scratch directory and renamed into place, so readers
+    never see a half-written one.
+
+    int8 and binary shards are searched in two steps: the compact matrix picks
+    candidates, and only those rows of the memory-mapped full.npy are read to
+    rank them exactly.
+    """
+
+    name = "shards"
+
+    def __init__(self, root=VECTOR_SHARD_PATH, dtype=VECTOR_SHARD_DTYPE, hnsw_min_chunks=HNSW_MIN_CHUNKS,
+                 cache_mb=VECTOR_CACHE_MB, rescore=VECTOR_RESCORE):
+        if dtype not in ("float16", "int8", "binary"):
+            raise ValueError(f"Unsupported VECTOR_SHARD_DTYPE '{dtype}'")
+        self.root = root
+        self.dtype = dtype
+        self.rescore = rescore and dtype != "float16"
+        self.hnsw_min_chunks = hnsw_min_chunks
+        self.cache_bytes = cache_mb * 1024 * 1024
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        if hnswlib is None:
+            logger.info("hnswlib is not installed; every shard will be searched exactly.")
+
+    def _doc_dir(self, doc_id) -> str:
+        return os.path.join(self.root, str(int(doc_id)))
+
+    def _shard_dir(self, doc_id, version=None) -> str:
+        return os.path.join(self._doc_dir(doc_id), version_key(version))
+
+    def _discard(self, path, doc_id):
+        """Renames path out of the way first, so a concurrent reader sees it either whole or gone."""
+        trash = os.path.join(self.root, f".deleted.{int(doc_id)}.{uuid.uuid4().hex}")
+        try:
+            os.replace(path, trash)
+        except FileNotFoundError:
+            return
+        shutil.rmtree(trash, ignore_errors=True)
+
+    def _forget(self, doc_id, keep_key=None):
+        with self._cache_lock:
+            for key in [key for key in self._cache if key[0] == int(doc_id) and key[1] != keep_key]:
+                del self._cache[key]
+
+    def add(self, doc_id: int, chunks: list[str], embeddings, version=None):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        scratch = os.path.join(self.root, f".{int(doc_id)}.{uuid.uuid4().hex}")
+        os.makedirs(scratch)
+        try:
+            if self.dtype == "int8":
+                scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+                np.save(os.path.join(scratch, "vectors.npy"),
+                        np.round(vectors / scales[:, None]).astype(np.int8))
+                np.save(os.path.join(scratch, "scales.npy"), scales.astype(np.float32))
+            elif self.dtype == "binary":
+                np.save(os.path.join(scratch, "vectors.npy"), np.packbits(vectors > 0, axis=1))
+            else:
+                np.save(os.path.join(scratch, "vectors.npy"), vectors.astype(np.float16))
+            if self.rescore:
+                np.save(os.path.join(scratch, "full.npy"), vectors)
+
+            encoded = [chunk.encode("utf-8") for chunk in chunks]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(b) for b in encoded])
+            with open(os.path.join(scratch, "chunks.txt"), "wb") as f:
+                f.write(b"".join(encoded))
+            np.save(os.path.join(scratch, "offsets.npy"), offsets)
+            with open(os.path.join(scratch, "meta.json"), "w") as f:
+                json.dump({"doc_id": int(doc_id), "version": version, "chunks": len(chunks)}, f)
+
+            if hnswlib is not None and len(chunks) >= self.hnsw_min_chunks and self.dtype != "binary":
+                graph = hnswlib.Index(space="ip", dim=vectors.shape[1])
+                graph.init_index(max_elements=len(vectors), ef_construction=HNSW_EF_CONSTRUCTION, M=HNSW_M)
+                graph.add_items(vectors, np.arange(len(vectors)))
+                graph.save_index(os.path.join(scratch, "hnsw.bin"))
+
+            target = self._shard_dir(doc_id, version)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            self._discard(target, doc_id)
+            os.replace(scratch, target)
+        except Exception:
+            shutil.rmtree(scratch, ignore_errors=True)
+            raise
+
+    def delete(self, doc_id: int):
+        """Removes every version of the document."""
+        self._forget(doc_id)
+        self._discard(self._doc_dir(doc_id), doc_id)
+
+    def prune(self, doc_id: int, keep_version):
+        """Removes every version of the document except keep_version."""
+        keep = version_key(keep_version)
+        self._forget(doc_id, keep_key=keep)
+        try:
+            names = os.listdir(self._doc_dir(doc_id))
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name != keep:
+                self._discard(os.path.join(self._doc_dir(doc_id), name), doc_id)
+
+    def remove_version(self, doc_id: int, version):
+        with self._cache_lock:
+            self._cache.pop((int(doc_id), version_key(version)), None)
+        self._discard(self._shard_dir(doc_id, version), doc_id)
+
+    def contains(self, doc_id: int, version=None) -> bool:
+        return os.path.isdir(self._shard_dir(doc_id, version))
+
+    def _open(self, doc_id, version=None):
+        """
+        Returns the _OpenShard for a document, or None if it has no shard.
+        Opened shards stay in an LRU bounded by VECTOR_CACHE_MB. An entry is
+        keyed on the shard directory's inode, so a shard rewritten by another
+        process is picked up on the next query.
+        """
+        key = (int(doc_id), version_key(version))
+        shard = self._shard_dir(doc_id, version)
+        try:
+            inode = os.stat(shard).st_ino
+        except FileNotFoundError:
+            return None
+
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry.inode == inode:
+                self._cache.move_to_end(key)
+                return entry
+
+        try:
+            entry = _OpenShard(shard, inode)
+        except FileNotFoundError:
+            # Deleted or replaced while we were loading it
+            return None
+        with self._cache_lock:
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            total = sum(e.nbytes for e in self._cache.values())
+            while total > self.cache_bytes and len(self._cache) > 1:
+                _, evicted = self._cache.popitem(last=False)
+                total -= evicted.nbytes
+        return entry
+
+    def search(self, doc_id: int, query_embedding, top_k: int, version=None) -> list[tuple[int, str]]:
+        entry = self._open(doc_id, version)
+        if entry is None:
+            return []
+        k = min(top_k, entry.size)
+        if k == 0:
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        if entry.graph is not None:
+            # The graph is shared between threads, so ef stays fixed and caps k
+            labels, _ = entry.graph.knn_query(query, k=min(k, HNSW_EF_SEARCH))
+            top = labels[0]
+        else:
+            # One matrix-vector product, then a partial sort of only the best candidates
+            scores = entry.scores(query)
+            n_candidates = k if entry.full is None else min(entry.size, k * VECTOR_RESCORE_FACTOR)
+            top = np.argpartition(-scores, n_candidates - 1)[:n_candidates]
+            if entry.full is not None:
+                # Sorted, so the memory-mapped rows are read front to back
+                top = np.sort(top)
+                scores = entry.full[top] @ query
+                top = top[np.argsort(-scores)[:k]]
+            else:
+                top = top[np.argsort(-scores[top])]
+        return entry.texts(top)
+
+
+class _OpenShard:
+    """
+    A loaded shard. float16/int8 shards keep their matrix in the stored dtype,
+    so a loaded shard costs what it does on disk; queries widen it to float32
+    SCORE_BLOCK_ROWS rows at a time for BLAS, and int8 scores are then scaled
+    per row. Binary shards keep the packed bits; HNSW shards hold the graph
+    instead. full.npy is only memory-mapped, so it costs page cache rather
+    than cache budget.
+    """
+
+    def __init__(self, shard, inode):
+        self.path = shard
+        self.inode = inode
+        self.offsets = np.load(os.path.join(shard, "offsets.npy"))
+        self.size = len(self.offsets) - 1
+        self.graph = None
+        self.vectors = None
+        self.scales = None
+        self.codes = None
+        full_path = os.path.join(shard, "full.npy")
+        self.full = np.load(full_path, mmap_mode="r") if os.path.exists(full_path) else None
+
+        stored = np.load(os.path.join(shard, "vectors.npy"), mmap_mode="r")
+        if stored.dtype == np.uint8:
+            self.codes = np.array(stored)
+            self.nbytes = self.codes.nbytes
+        elif hnswlib is not None and os.path.exists(os.path.join(shard, "hnsw.bin")):
+            self.graph = hnswlib.Index(space="ip", dim=stored.shape[1])
+            self.graph.load_index(os.path.join(shard, "hnsw.bin"), max_elements=self.size)
+            self.graph.set_ef(HNSW_EF_SEARCH)
+            # Vectors plus roughly 2*M neighbour links per element
+            self.nbytes = self.size * (stored.shape[1] * 4 + HNSW_M * 8)
+        else:
+            self.vectors = np.array(stored)
+            self.nbytes = self.vectors.nbytes
+            if stored.dtype == np.int8:
+                self.scales = np.load(os.path.join(shard, "scales.npy"))
+                self.nbytes += self.scales.nbytes
+        self.nbytes += self.offsets.nbytes
 
-# Get or create a "collection" which is like a table in a SQL database.
-DOCUMENT_COLLECTION = CHROMA_CLIENT.get_or_create_collection(name="documents")
+    def scores(self, query):
+        if self.codes is not None:
+            # Fewer differing bits means a closer vector
+            differing = np.bitwise_count(self.codes ^ np.packbits(query > 0)).sum(axis=1, dtype=np.int32)
+            return -differing
+        scores = np.empty(self.size, dtype=np.float32)
+        for start in range(0, self.size, SCORE_BLOCK_ROWS):
+            block = self.vectors[start:start + SCORE_BLOCK_ROWS].astype(np.float32)
+            np.matmul(block, query, out=scores[start:start + len(block)])
+        if self.scales is not None:
+            scores *= self.scales
+        return scores
+
+    def texts(self, positions) -> list[tuple[int, str]]:
+        results = []
+        with open(os.path.join(self.path, "chunks.txt"), "rb") as f:
+            for position in positions:
+                position = int(position)
+                f.seek(int(self.offsets[position]))
+                text = f.read(int(self.offsets[position + 1] - self.offsets[position])).decode("utf-8")
+                results.append((position, text))
+        return results
+
+
+class RemoteIndex:
+    """
+    Stands in for an index held by the vector writer process. Writes are
+    sent to it over VECTOR_WRITER_SOCKET, one connection per thread. Reads go
+    to `reader`, a ShardedIndex over the same directory, or to the writer
+    when there is none (Chroma).
+    """
+
+    def __init__(self, target, name, reader=None, address=VECTOR_WRITER_SOCKET):
+        self.target = target
+        self.name = name
+        self.reader = reader
+        self.address = address
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            authkey = os.getenv("VECTOR_WRITER_AUTHKEY", "").encode("utf-8") or None
+            connection = self._local.connection = Client(self.address, family="AF_UNIX", authkey=authkey)
+        return connection
+
+    def _call(self, method, *args):
+        for attempt in range(2):
+            try:
+                connection = self._connection()
+                connection.send((self.target, method, args))
+                status, value = connection.recv()
+                break
+            except (EOFError, OSError):
+                # The writer was restarted: reconnect once
+                self._local.connection = None
+                if attempt:
+                    raise
+        if status != "ok":
+            raise RuntimeError(f"vector writer: {value}")
+        return value
+
+    def add(self, doc_id: int, chunks: list[str], embeddings, version=None):
+        self._call("add", doc_id, chunks, np.asarray(embeddings, dtype=np.float32), version)
+
+    def delete(self, doc_id: int):
+        self._call("delete", doc_id)
+
+    def prune(self, doc_id: int, keep_version):
+        self._call("prune", doc_id, keep_version)
+
+    def remove_version(self, doc_id: int, version):
+        self._call("remove_version", doc_id, version)
+
+    def contains(self, doc_id: int, version=None) -> bool:
+        if self.reader is not None:
+            return self.reader.contains(doc_id, version)
+        return self._call("contains", doc_id, version)
+
+    def search(self, doc_id: int, query_embedding, top_k: int, version=None) -> list[tuple[int, str]]:
+        if self.reader is not None:
+            return self.reader.search(doc_id, query_embedding, top_k, version)
+        return self._call("search", doc_id, query_embedding, top_k, version)
+
+
+def _create_index(remote=bool(VECTOR_WRITER_SOCKET)):
+    if VECTOR_INDEX_ENGINE == "sharded":
+        return RemoteIndex("index", ShardedIndex.name, ShardedIndex()) if remote else ShardedIndex()
+    if VECTOR_INDEX_ENGINE != "chroma":
+        logger.warning("Unknown VECTOR_INDEX_ENGINE '%s'; using Chroma.", VECTOR_INDEX_ENGINE)
+    return RemoteIndex("index", ChromaIndex.name) if remote else ChromaIndex()
+
+
+def _create_fast_path(remote=bool(VECTOR_WRITER_SOCKET)):
+    # The sharded engine already answers from per-document matrices
+    if not VECTOR_FAST_PATH or VECTOR_INDEX_ENGINE == "sharded":
+        return None
+    fast_path = ShardedIndex(root=VECTOR_FAST_PATH_DIR, dtype="float16", hnsw_min_chunks=sys.maxsize)
+    return RemoteIndex("fast_path", ShardedIndex.name, fast_path) if remote else fast_path
+
+
+INDEX = _create_index()
+FAST_PATH = _create_fast_path()
+
+
+def open_local_indexes():
+    """
+    Opens INDEX and FAST_PATH in this process, in place of any RemoteIndex.
+    Only the vector writer process calls this.
+    """
+    global INDEX, FAST_PATH
+    INDEX = _create_index(remote=False)
+    FAST_PATH = _create_fast_path(remote=False)
+    return INDEX, FAST_PATH
 
 
 # --- THE MAIN FUNCTIONS ---
 
-def add_document_chunks(doc_id: int, chunks: list[str]):
+def model_name_for_version(version) -> str:
+    """The embedding model an index version was built with ('<chunker>|<model>')."""
+    if version is None:
+        return LEGACY_EMBEDDING_MODEL
+    return version.split("|", 1)[1]
+
+
+def get_model(name: str = None) -> SentenceTransformer:
+    name = name or EMBEDDING_MODEL_NAME
+    with _models_lock:
+        model = _models.get(name)
+        if model is None:
+            logger.info("Loading embedding model %s...", name)
+            model = _models[name] = SentenceTransformer(name)
+        return model
+
+
+class QueryBatcher:
+    """Embeds queries for one model in micro-batches, on a thread started by the first query."""
+
+    def __init__(self, model, window_ms=EMBEDDING_BATCH_WINDOW_MS, max_batch=EMBEDDING_BATCH_SIZE):
+        self.model = model
+        self.window = window_ms / 1000
+        self.max_batch = max(1, max_batch)
+        self.batches = 0
+        self.queries = 0
+        self._last_batch = 0
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def encode(self, text) -> np.ndarray:
+        future = Future()
+        self._queue.put((text, future))
+        if self._thread is None or not self._thread.is_alive():
+            with self._start_lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="query-batcher", daemon=True)
+                    self._thread.start()
+        return future.result()
+
+    def _next_batch(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + (self.window if self._last_batch > 1 else 0)
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                with telemetry.timed("embedding.encode_batch"):
+                    vectors = self.model.encode([text for text, _ in batch], batch_size=len(batch),
+                                                convert_to_numpy=True)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.queries += len(batch)
+            self._last_batch = len(batch)
+            telemetry.set_gauge("intellidocs_embedding_batch_size", len(batch))
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+
+_batchers = {}
+
+
+def get_batcher(name: str = None) -> QueryBatcher:
+    name = name or EMBEDDING_MODEL_NAME
+    model = get_model(name)
+    with _models_lock:
+        batcher = _batchers.get(name)
+        if batcher is None:
+            batcher = _batchers[name] = QueryBatcher(model)
+        return batcher
+
+
+def encode_query(query_text: str, model_name: str = None) -> np.ndarray:
+    """Embeds one search query, batched with concurrent ones unless EMBEDDING_BATCHING is off."""
+    if not EMBEDDING_BATCHING:
+        return get_model(model_name).encode([query_text], convert_to_numpy=True)[0]
+    return get_batcher(model_name).encode(query_text)
+
+
+def embed_chunks(chunks: list[str], model_name: str = None) -> np.ndarray:
+    """Creates embeddings for text chunks in a single batch operation."""
+    with telemetry.timed("embedding.encode"):
+        # Kept as one float32 array all the way into the index
+        return get_model(model_name).encode(chunks, convert_to_numpy=True)
+
+
+def insert_chunks(doc_id: int, chunks: list[str], embeddings: np.ndarray, version: str = None):
+    """Adds already-embedded chunks for one document (and index version) to the vector index."""
+    with telemetry.timed(f"{INDEX.name}.add"):
+        INDEX.add(doc_id, chunks, embeddings, version)
+
+    if FAST_PATH is not None and len(chunks) <= VECTOR_FAST_PATH_MAX_CHUNKS:
+        try:
+            with telemetry.timed("fastpath.add"):
+                FAST_PATH.add(doc_id, chunks, embeddings, version)
+        except Exception as e:
+            # Searches of this document simply go to the main index
+            logger.warning("Could not write the fast-path matrix for doc_id %s: %s", doc_id, e)
+            # The main index already has the chunks; a failed cleanup must not undo that
+            try:
+                FAST_PATH.remove_version(doc_id, version)
+            except Exception as cleanup_error:
+                logger.error("Could not remove the partial fast-path matrix for doc_id %s: %s",
+                             doc_id, cleanup_error)
+
+
+def add_document_chunks(doc_id: int, chunks: list[str], version: str = None, on_progress=None) -> bool:
     """
-    Creates embeddings for a list of text chunks and adds them to the vector store.
+    Creates embeddings for a list of text chunks and adds them to the vector store
+    under `version`, embedding with that version's model. Other versions of the
+    document are left alone. Returns True on success. on_progress(done, total)
+    is called after every EMBEDDING_PROGRESS_CHUNKS chunks embedded.
     """
     if not chunks:
-        print(f"No chunks provided for doc_id {doc_id}. Nothing to add.")
-        return
+        logger.warning("No chunks provided for doc_id %s. Nothing to add.", doc_id)
+        return False
 
-    print(f"Creating {len(chunks)} embeddings for doc_id {doc_id}...")
+    logger.debug("Creating %s embeddings for doc_id %s...", len(chunks), doc_id)
     try:
-        # 1. Create embeddings for each chunk in a single batch operation
-        embeddings = EMBEDDING_MODEL.encode(chunks).tolist()
-        
-        # 2. Prepare metadata for each chunk. This is crucial for filtering.
-        #    We store the document ID so we can search within a specific document later.
-        metadatas = [{'doc_id': str(doc_id)} for _ in chunks]
-        
-        # 3. Create unique IDs for each chunk to store in ChromaDB.
-        ids = [f"{doc_id}_{i}" for i in range(len(chunks))]
-        
-        # 4. Add all the data to the collection.
-        DOCUMENT_COLLECTION.add(
-            embeddings=embeddings,
-            documents=chunks,
-            metadatas=metadatas,
-            ids=ids
-        )
-        print(f"Successfully added {len(chunks)} chunks for doc_id {doc_id} to the vector store.")
+        model_name = model_name_for_version(version) if version else None
+        if on_progress is None:
+            embeddings = embed_chunks(chunks, model_name)
+        else:
+            parts = []
+            for start in range(0, len(chunks), EMBEDDING_PROGRESS_CHUNKS):
+                parts.append(embed_chunks(chunks[start:start + EMBEDDING_PROGRESS_CHUNKS], model_name))
+                on_progress(min(start + EMBEDDING_PROGRESS_CHUNKS, len(chunks)), len(chunks))
+            embeddings = np.concatenate(parts)
+        insert_chunks(doc_id, chunks, embeddings, version)
+        logger.debug("Successfully added %s chunks for doc_id %s to the vector store.", len(chunks), doc_id)
+        return True
 
     except Exception as e:
-        print(f"An error occurred during embedding or adding to vector store: {e}")
+        logger.error("An error occurred during embedding or adding to vector store: %s", e)
+        return False
 
 
-def search_document(doc_id: int, query_text: str, top_k: int = 5) -> list:
+def delete_document_chunks(doc_id: int):
+    """Removes every chunk of a document, in every index version, from the vector store."""
+    try:
+        INDEX.delete(doc_id)
+        if FAST_PATH is not None:
+            FAST_PATH.delete(doc_id)
+    except Exception as e:
+        logger.error("An error occurred while deleting chunks for doc_id %s: %s", doc_id, e)
+
+
+def prune_document_chunks(doc_id: int, keep_version: str):
+    """Removes the chunks of every index version of a document except keep_version."""
+    try:
+        INDEX.prune(doc_id, keep_version)
+        if FAST_PATH is not None:
+            FAST_PATH.prune(doc_id, keep_version)
+    except Exception as e:
+        logger.error("An error occurred while pruning old chunks for doc_id %s: %s", doc_id, e)
+
+
+def search_document(doc_id: int, query_text: str, top_k: int = 5, version: str = None) -> list:
     """
     Searches for the most relevant text chunks within a specific document.
+    `version` is the document's documents.index_version: the query is embedded
+    with that version's model and only that version's chunks are searched.
     """
     try:
         # 1. Create an embedding for the user's query.
-        query_embedding = EMBEDDING_MODEL.encode([query_text]).tolist()
-        
-        # 2. Query the collection.
-        results = DOCUMENT_COLLECTION.query(
-            query_embeddings=query_embedding,
-            n_results=top_k,
-            # This 'where' clause is the magic: it filters to only search
-            # chunks that belong to the specified document ID.
-            where={"doc_id": str(doc_id)}
-        )
-        
-        # The result is a list of lists, so we get the first item.
-        return results['documents'][0] if results['documents'] else []
+        with telemetry.timed("embedding.encode_query"):
+            query_embedding = encode_query(query_text, model_name_for_version(version))
+
+        # 2. Query the document's own matrix if it has one, otherwise the index.
+        if FAST_PATH is not None and FAST_PATH.contains(doc_id, version):
+            with telemetry.timed("fastpath.query"):
+                results = FAST_PATH.search(doc_id, query_embedding, top_k, version)
+        else:
+            with telemetry.timed(f"{INDEX.name}.query"):
+                results = INDEX.search(doc_id, query_embedding, top_k, version)
+
+        return [text for _, text in results]
 
     except Exception as e:
-        print(f"An error occurred during search: {e}")
-        return []
\ No newline at end of file
+        logger.error("An error occurred during search: %s", e)
+        return []
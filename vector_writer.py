@@ -0,0 +1,95 @@
+"""
+The vector writer: the only process that opens the vector index for writing.
+
+With several worker processes, each one opening its own chromadb client on
+the same CHROMA_PATH would corrupt it, and two workers rewriting the same
+shard could race. So when VECTOR_WRITER_SOCKET is set, workers hold a
+vector_store.RemoteIndex instead. It sends every add, delete and prune to
+this process over a Unix socket, and this process applies them one at a
+time. Chroma queries are answered here too. Shards are read by the workers
+directly.
+
+gunicorn.conf.py starts it before forking the web workers. It can also run
+on its own:
+
+    VECTOR_WRITER_SOCKET=./run/vector_writer.sock python vector_writer.py
+"""
+import os
+import sys
+import threading
+from multiprocessing.connection import Listener
+
+import telemetry
+import vector_store
+
+logger = telemetry.get_logger(__name__)
+
+# Methods a worker may call on each index; the rest are refused
+WRITE_METHODS = {"add", "delete", "prune", "remove_version"}
+READ_METHODS = {"contains", "search"}
+
+
+class VectorWriter:
+    """Serves index calls from the workers, one thread per connection."""
+
+    def __init__(self, address=vector_store.VECTOR_WRITER_SOCKET, authkey=None):
+        self.address = os.path.abspath(address)
+        self.authkey = authkey if authkey is not None else \
+            os.getenv("VECTOR_WRITER_AUTHKEY", "").encode("utf-8") or None
+        self._indexes = {}
+        self._write_lock = threading.Lock()
+
+    def serve_forever(self):
+        index, fast_path = vector_store.open_local_indexes()
+        self._indexes = {"index": index, "fast_path": fast_path}
+
+        os.makedirs(os.path.dirname(self.address), exist_ok=True)
+        if os.path.exists(self.address):
+            os.unlink(self.address)  # left behind by a previous run
+        listener = Listener(self.address, family="AF_UNIX", authkey=self.authkey)
+        os.chmod(self.address, 0o600)
+        logger.info("Vector writer (%s) listening on %s", index.name, self.address)
+        try:
+            while True:
+                try:
+                    connection = listener.accept()
+                except Exception as e:
+                    logger.warning("Refused a vector writer connection: %s", e)
+                    continue
+                threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+        finally:
+            listener.close()
+
+    def _serve(self, connection):
+        with connection:
+            while True:
+                try:
+                    target, method, args = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    connection.send(("ok", self._dispatch(target, method, args)))
+                except Exception as e:
+                    logger.error("Vector writer %s.%s failed: %s", target, method, e)
+                    connection.send(("error", f"{type(e).__name__}: {e}"))
+
+    def _dispatch(self, target, method, args):
+        index = self._indexes.get(target)
+        if index is None or method not in WRITE_METHODS | READ_METHODS:
+            raise ValueError(f"unsupported call {target}.{method}")
+        if method in READ_METHODS:
+            return getattr(index, method)(*args)
+        with self._write_lock, telemetry.timed(f"writer.{method}"):
+            return getattr(index, method)(*args)
+
+
+def main():
+    if not vector_store.VECTOR_WRITER_SOCKET:
+        logger.error("Set VECTOR_WRITER_SOCKET to the socket path the workers use.")
+        return 1
+    VectorWriter().serve_forever()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())